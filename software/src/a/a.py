@@ -2,15 +2,54 @@
 
 from __future__ import print_function
 
+import re
 import string
 import sys
 import os
+import mmap
+import multiprocessing
+import subprocess
+import time
 
+import atomicfile
+import buildcache
 import codegen
+import ir
+import lexcache
+import objfile
+import rvc
 
 
+VERSION = "0.0"
+
 # Command-line flags.
 OPT_QUIET = 1
+OPT_CHARLEXER = 2
+OPT_NOCACHE = 4
+OPT_WATCH = 8
+OPT_SWAP = 16
+OPT_SPARSE = 32
+OPT_OBJECT = 64
+OPT_COMPRESS = 128
+OPT_RELAX = 256
+OPT_PEEPHOLE = 512
+OPT_BUILDCACHE = 1024
+OPT_REDO = 2048
+
+# Under these options, the size of an instruction is only settled once the
+# values of its operands are known, and instructions may be removed
+# altogether, so labels are kept symbolic until then.
+OPT_RELAXING = OPT_COMPRESS | OPT_RELAX | OPT_PEEPHOLE
+
+# Relaxation gives up if the sizes of instructions have not settled after
+# this many rounds.
+maxRelaxRounds = 50
+
+# In watch mode, how often (in seconds) to look for changed source files.
+watchInterval = 0.25
+
+# Unless told otherwise, lexed source files are cached here.
+defaultCacheDir = os.path.join(os.path.expanduser("~"), ".cache", "polaris-a")
 
 # The lexer has several contexts in which it operates.
 #
@@ -52,75 +91,18 @@ wordToken = 101
 hwordToken = 102
 byteToken = 103
 advanceToken = 104
-jalToken = 200
-luiToken = 201
-auipcToken = 202
-addiToken = 203
-slliToken = 204
-sltiToken = 205
-sltiuToken = 206
-xoriToken = 207
-srliToken = 208
-sraiToken = 209
-oriToken = 210
-andiToken = 211
-csrrwiToken = 212
-csrrsiToken = 213
-csrrciToken = 214
-addiwToken = 215
-slliwToken = 216
-srliwToken = 217
-sraiwToken = 218
-jalrToken = 219
-lbToken = 220
-lhToken = 221
-lwToken = 222
-ldToken = 223
-lbuToken = 224
-lhuToken = 225
-lwuToken = 226
-sbToken = 227
-shToken = 228
-swToken = 229
-sdToken = 230
-beqToken = 231
-bneToken = 232
-bltToken = 233
-bgeToken = 234
-bltuToken = 235
-bgeuToken = 236
-addToken = 237
-subToken = 238
-sllToken = 239
-sltToken = 240
-sltuToken = 241
-xorToken = 242
-srlToken = 243
-sraToken = 244
-orToken = 245
-andToken = 246
-addwToken = 247
-subwToken = 248
-sllwToken = 249
-srlwToken = 250
-srawToken = 251
-alignToken = 252
-csrrwToken = 253
-csrrsToken = 254
-csrrcToken = 255
-ecallToken = 256
-ebreakToken = 257
-uretToken = 258
-sretToken = 259
-hretToken = 260
-mretToken = 261
-wfiToken = 262
-sfencevmToken = 263
-includeToken = 264
-incbinToken = 265
+alignToken = 105
+includeToken = 106
+incbinToken = 107
+sectionToken = 108
 
 endOfInputToken = 999
 
+# Machine instructions are not given individual token types here.  Instead,
+# each row of the opcode table (see below) is assigned a token type of its own,
+# counting up from firstOpcodeToken.
+firstOpcodeToken = 1000
+
 # When evaluating expressions, we need to know what functions to perform when.
 # These indicate the kind of expression nodes used, so we can invoke the
 # correct functions.
@@ -132,6 +114,9 @@ EN_NEG = 5
 EN_INT = 6
 EN_ID = 7
 EN_STR = 8
+EN_LABEL = 9  # a label whose address is known only after relaxation
+
+binaryKinds = (EN_ADD, EN_SUB, EN_MUL, EN_DIV)
 
 lowercaseLetters = "abcdefghijklmnopqrstuvwxyz"
 uppercaseLetters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -146,6 +131,21 @@ precedenceTable = {
     "+": 10, "-": 10,
 }
 
+# The line lexer tokenizes a complete source line with a single precompiled
+# pattern, rather than walking the lexer contexts above one character at a
+# time.  Each named group corresponds to one of those contexts; the final
+# group catches any other single character, which becomes either a binOpToken
+# or a characterToken.  Both lexers must produce identical token streams.
+lineLexerPattern = re.compile(r"""
+      (?P<ws>[ \t\n\r]+)
+    | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<decimal>[0-9]+)
+    | \$(?P<hex>[0-9A-Fa-f]*)
+    | ;(?P<comment>[^\n\r]*)
+    | "(?P<string>[^"]*)"?
+    | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
 
 def error(msg):
     sys.stderr.write("{}\n".format(msg))
@@ -157,190 +157,542 @@ def syntaxError(asm, tok):
 
 
 class ExprNode(object):
+    __slots__ = ('kind', 'a', 'b')
+
     def __init__(self, kind, a=None, b=None):
         self.kind = kind
         self.a = a
         self.b = b
 
 
-class Advance(object):
-    def __init__(self, nBytes, fill):
-        self.a = nBytes
-        self.b = fill
-        self.c = None
-
-    def asBytes(self, asm):
-        nBytes = evalExpression(asm, self.a)
-        fill = evalExpression(asm, self.b)
-        if nBytes.kind != EN_INT:
-            raise Exception("Expected integer for target")
-        if fill.kind != EN_INT:
-            raise Exception("Expected integer for fill byte")
-        nBytes = nBytes.a
-        fill = fill.a & 0xFF
-        asm.seg.advance(asm.seg.lc + nBytes, fill)
-
-class Declaration(object):
-    def __init__(self, lc, value, size):
-        self.lc = lc
-        self.a = value
-        self.b = None
-        self.c = None
-        self.size = size
-
-    def asBytes(self, asm):
-        bs = []
-        generator = {
-            1: asm.seg.byte, 2: asm.seg.hword,
-            4: asm.seg.word, 8: asm.seg.dword
-        }[self.size]
-      
-        if self.a.kind == EN_STR:
-            for c in self.a.a:
-                generator(ord(c))
+# Expression nodes are never modified once built, so equal nodes may be
+# shared.  exprNode keeps a single instance of each distinct node in the
+# assembler's exprNodes, keyed by its kind and operands.  Since the operands
+# of interior nodes are themselves shared, comparing them by identity is
+# enough.  The table belongs to the assembler, so that its nodes go with it.
+def exprNode(asm, kind, a=None, b=None):
+    """Construct an expression node, or reuse an identical existing one."""
+    key = (kind, a, b)
+    e = asm.exprNodes.get(key)
+    if e is None:
+        e = ExprNode(kind, a, b)
+        asm.exprNodes[key] = e
+    return e
+
+
+def foldBinary(asm, kind, l, r):
+    """
+    Construct a binary operator node, computing its value right away if both
+    operands are already known.  Division by zero is left for pass three to
+    report.
+    """
+    if l.kind == EN_INT and r.kind == EN_INT:
+        if kind == EN_ADD:
+            return exprNode(asm, EN_INT, l.a + r.a)
+        if kind == EN_SUB:
+            return exprNode(asm, EN_INT, l.a - r.a)
+        if kind == EN_MUL:
+            return exprNode(asm, EN_INT, l.a * r.a)
+        if r.a != 0:
+            return exprNode(asm, EN_INT, l.a // r.a)
+    return exprNode(asm, kind, l, r)
+
+
+def foldNegate(asm, e):
+    """Construct a negation node, computing its value if already known."""
+    if e.kind == EN_INT:
+        return exprNode(asm, EN_INT, -e.a)
+    return exprNode(asm, EN_NEG, e)
+
+
+def integerOperand(asm, n, msg):
+    """Retrieve the resolved value of operand n, which must be an integer."""
+    v = asm.operandValues[n]
+    if v is None:
+        raise Exception(msg)
+    return v
+
+
+def emitDeclaration(asm, prog, n):
+    generator = declarators[prog.insn[n]]
+    value = prog.exprs[prog.a[n]]
+
+    if value.kind == EN_STR:
+        for c in value.a:
+            generator(asm.seg, ord(c))
+    else:
+        v = asm.operandValues[prog.a[n]]
+        if v is None:
+            error("Pass 2: unknown constant type {} on line {}".format(
+                evalExpression(asm, value).kind, prog.line[n]
+            ))
+            return
+        generator(asm.seg, v)
+
+
+def emitBlob(asm, prog, n):
+    asm.seg.blob(prog.blobs[prog.insn[n]])
+
+
+def emitSection(asm, prog, n):
+    asm.seg = asm.sections[prog.insn[n]]
+
+
+def emitAdvance(asm, prog, n):
+    target = integerOperand(asm, prog.a[n], "Expected integer for target")
+    if prog.b[n] == ir.NO_OPERAND:
+        asm.seg.skip(target)
+        return
+    fill = integerOperand(asm, prog.b[n], "Expected integer for fill byte")
+    asm.seg.advance(target, fill & 0xFF)
+
+
+def emitLabel(asm, prog, n):
+    """Do nothing; labels lay down no bytes."""
+
+
+def emitDeleted(asm, prog, n):
+    """Do nothing; the peephole pass removed this instruction."""
+
+
+def emitCompressed(asm, prog, n):
+    asm.seg.hword(prog.insn[n])
+
+
+def emitPseudo(asm, prog, n):
+    parts = asm.pseudoParts.get(n)
+    if parts is None:
+        integerOperand(asm, prog.a[n], "Expected integer for register")
+        integerOperand(asm, prog.b[n], "Undefined operand on line {}".format(
+            prog.line[n]
+        ))
+        words = asm._pseudoWords(n, prog.lc[n])
+        parts = padInstructions(
+            [(w, 4) for w in words], asm.pseudoSizes[n], prog.line[n]
+        )
+    for value, width in parts:
+        if width == 2:
+            asm.seg.hword(value)
         else:
-            a = evalExpression(asm, self.a)
-            if a.kind != EN_INT:
-                error("Pass 2: unknown constant type {} on line {}".format(a.kind, self.lc))
-                return []
-            v = a.a
-            generator(v)
+            asm.seg.word(value)
 
 
-class RInsn(object):
-    def __init__(self, insn, rd, rs1, rs2):
-        self.insn = insn
-        self.a = rd
-        self.b = rs1
-        self.c = rs2
-
-    def asBytes(self, asm):
-        bs = []
-        rd = evalExpression(asm, self.a)
-        rs1 = evalExpression(asm, self.b)
-        rs2 = evalExpression(asm, self.c)
-        if rd.kind != EN_INT:
-            raise Exception("Integer expected for destination register")
-        if rs1.kind != EN_INT:
-            raise Exception("Integer expected for src1 register")
-        if rs2.kind != EN_INT:
-            raise Exception("Integer expected for src2 register")
-        rd = rd.a
-        rs1 = rs1.a
-        rs2 = rs2.a
-        asm.seg.putR(self.insn, rd, rs1, rs2)
-
-
-class SInsn(object):
-    def __init__(self, lc, insn, rs1, disp, rs2):
-        self.lc = lc
-        self.insn = insn
-        self.a = rs1
-        self.b = disp
-        self.c = rs2
-
-    def asBytes(self, asm):
-        bs = []
-        rs1 = evalExpression(asm, self.a)
-        rs2 = evalExpression(asm, self.c)
-        disp = evalExpression(asm, self.b)
-
-        if rs1.kind != EN_INT:
-            raise Exception("Integer expected for src1 reg expression")
-        if rs2.kind != EN_INT:
-            raise Exception("Integer expected for src2 reg expression")
-        if disp.kind != EN_INT:
-            error("KIND({})".format(disp.kind), disp.a, disp.b)
-            raise Exception("Integer expected for displacement")
-        rs1 = rs1.a
-        rs2 = rs2.a
-        disp = disp.a
-        asm.seg.putS(self.insn, rs2, rs1, disp)
-
-
-class SBInsn(SInsn):
-    def asBytes(self, asm):
-        bs = []
-        rs1 = evalExpression(asm, self.a)
-        rs2 = evalExpression(asm, self.c)
-        disp = evalExpression(asm, self.b)
-
-        if rs1.kind != EN_INT:
-            raise Exception("Integer expected for src1 reg expression")
-        if rs2.kind != EN_INT:
-            raise Exception("Integer expected for src2 reg expression")
-        if disp.kind != EN_INT:
-            raise Exception("Integer expected for displacement")
-        rs1 = rs1.a
-        rs2 = rs2.a
-        disp = disp.a - self.lc
-        asm.seg.putSB(self.insn, rs1, rs2, disp)
-
-
-class IInsn(object):
-    def __init__(self, insn, rd, rs, imm12):
-        self.insn = insn
-        self.a = rd
-        self.b = rs
-        self.c = imm12
-
-    def asBytes(self, asm):
-        bs = []
-        rd = evalExpression(asm, self.a)
-        rs = evalExpression(asm, self.b)
-        imm12 = evalExpression(asm, self.c)
-
-        if rd.kind != EN_INT:
-            raise Exception("Integer expected for dest reg expression")
-        if rs.kind != EN_INT:
-            raise Exception("Integer expected for src reg expression")
-        if imm12.kind != EN_INT:
-            raise Exception("Integer expected for immediate value")
-        rd = rd.a & 0x1F
-        rs = rs.a & 0x1F
-        imm12 = imm12.a & 0xFFF
-        asm.seg.putI(self.insn, rd, rs, imm12)
-
-
-class IMInsn(IInsn):
-    pass
-
-
-class UInsn(object):
-    def __init__(self, insn, rd, imm20):
-        self.insn = insn
-        self.a = rd
-        self.b = imm20
-        self.c = None
-
-    def asBytes(self, asm):
-        bs = []
-        rd = evalExpression(asm, self.a)
-        imm20 = evalExpression(asm, self.b)
-        if (rd.kind != EN_INT) or (imm20.kind != EN_INT):
-            raise Exception("Pass 2 error: Undefined symbols?")
-        rd = rd.a
-        imm20 = imm20.a
-        asm.seg.putU(self.insn, rd, imm20)
-
-
-class UJInsn(object):
-    def __init__(self, lc, insn, rd, disp):
-        self.lc = lc
-        self.insn = insn
-        self.a = rd
-        self.b = disp
-        self.c = None
+def padInstructions(parts, size, line):
+    """
+    Pad a sequence of (instruction, width in bytes) pairs with no-ops, to
+    fill the size bytes set aside for it.
+    """
+    room = size - sum(width for _, width in parts)
+    if room < 0:
+        raise Exception(
+            "On line {}, operand out of range of the room set aside".format(
+                line
+            )
+        )
+    return parts + [(0x00000013, 4)] * (room // 4) + [(0x0001, 2)] * (
+        room % 4 // 2
+    )
+
+
+def emitAlign(asm, prog, n):
+    boundary = prog.insn[n]
+    asm.seg.advance((asm.seg.lc + (boundary - 1)) & (-boundary), 0)
+
+
+def emitR(asm, prog, n):
+    rd = integerOperand(
+        asm, prog.a[n], "Integer expected for destination register"
+    )
+    rs1 = integerOperand(asm, prog.b[n], "Integer expected for src1 register")
+    rs2 = integerOperand(asm, prog.c[n], "Integer expected for src2 register")
+    asm.seg.putR(prog.insn[n], rd, rs1, rs2)
 
-    def asBytes(self, asm):
-        bs = []
-        rd = evalExpression(asm, self.a)
-        disp = evalExpression(asm, self.b)
-        if (rd.kind != EN_INT) or (disp.kind != EN_INT):
-            raise Exception("Pass 2 error: Undefined symbols?")
-        rd = rd.a & 0x1F
-        disp = (disp.a & 0x3FFFFE) - self.lc
-        asm.seg.putUJ(self.insn, rd, disp)
+
+def emitS(asm, prog, n):
+    rs1 = integerOperand(
+        asm, prog.a[n], "Integer expected for src1 reg expression"
+    )
+    rs2 = integerOperand(
+        asm, prog.c[n], "Integer expected for src2 reg expression"
+    )
+    disp = integerOperand(asm, prog.b[n], "Integer expected for displacement")
+    asm.seg.putS(prog.insn[n], rs2, rs1, disp)
+
+
+def emitSB(asm, prog, n):
+    rs1 = integerOperand(
+        asm, prog.a[n], "Integer expected for src1 reg expression"
+    )
+    rs2 = integerOperand(
+        asm, prog.c[n], "Integer expected for src2 reg expression"
+    )
+    disp = integerOperand(asm, prog.b[n], "Integer expected for displacement")
+    asm.seg.putSB(prog.insn[n], rs1, rs2, disp - prog.lc[n])
+
+
+def emitI(asm, prog, n):
+    rd = integerOperand(
+        asm, prog.a[n], "Integer expected for dest reg expression"
+    )
+    rs = integerOperand(asm, prog.b[n], "Integer expected for src reg expression")
+    imm12 = integerOperand(
+        asm, prog.c[n], "Integer expected for immediate value"
+    )
+    asm.seg.putI(prog.insn[n], rd & 0x1F, rs & 0x1F, imm12 & 0xFFF)
+
+
+def emitU(asm, prog, n):
+    msg = "Pass 2 error: Undefined symbols?"
+    rd = integerOperand(asm, prog.a[n], msg)
+    imm20 = integerOperand(asm, prog.b[n], msg)
+    asm.seg.putU(prog.insn[n], rd, imm20)
+
+
+def emitUJ(asm, prog, n):
+    msg = "Pass 2 error: Undefined symbols?"
+    rd = integerOperand(asm, prog.a[n], msg)
+    disp = integerOperand(asm, prog.b[n], msg)
+    asm.seg.putUJ(prog.insn[n], rd & 0x1F, (disp & 0x3FFFFE) - prog.lc[n])
+
+
+def gatherR(prog, ns, insns, op):
+    return codegen.encodeR(insns, op(prog.a), op(prog.b), op(prog.c))
+
+
+def gatherS(prog, ns, insns, op):
+    return codegen.encodeS(insns, op(prog.c), op(prog.a), op(prog.b))
+
+
+def gatherSB(prog, ns, insns, op):
+    lc = prog.lc
+    disp = [d - lc[n] for d, n in zip(op(prog.b), ns)]
+    return codegen.encodeSB(insns, op(prog.a), op(prog.c), disp)
+
+
+def gatherI(prog, ns, insns, op):
+    return codegen.encodeI(
+        insns,
+        [v & 0x1F for v in op(prog.a)],
+        [v & 0x1F for v in op(prog.b)],
+        [v & 0xFFF for v in op(prog.c)],
+    )
+
+
+def gatherU(prog, ns, insns, op):
+    return codegen.encodeU(insns, op(prog.a), op(prog.b))
+
+
+def gatherUJ(prog, ns, insns, op):
+    lc = prog.lc
+    disp = [(d & 0x3FFFFE) - lc[n] for d, n in zip(op(prog.b), ns)]
+    return codegen.encodeUJ(insns, [v & 0x1F for v in op(prog.a)], disp)
+
+
+# Pass three encodes instructions a format at a time.  Given the numbers of
+# the records to encode and their instruction templates, each gatherer
+# collects their fields, transformed just as the matching emitter would, and
+# encodes them in one batch.  Its op argument yields the values of an operand
+# column for the records listed.
+gatherers = {
+    ir.IR_R: gatherR,
+    ir.IR_I: gatherI,
+    ir.IR_IM: gatherI,
+    ir.IR_S: gatherS,
+    ir.IR_SB: gatherSB,
+    ir.IR_U: gatherU,
+    ir.IR_UJ: gatherUJ,
+}
+
+
+# For each kind of record, the operand column which may hold a relocatable
+# value, and those which must not, being register numbers.
+relocatedFields = {
+    ir.IR_DECL: ("a", ()),
+    ir.IR_R: (None, ("a", "b", "c")),
+    ir.IR_I: ("c", ("a", "b")),
+    ir.IR_IM: ("c", ("a", "b")),
+    ir.IR_S: ("b", ("a", "c")),
+    ir.IR_SB: ("b", ("a", "c")),
+    ir.IR_U: ("b", ("a",)),
+    ir.IR_UJ: ("b", ("a",)),
+}
+
+relocationKinds = {
+    ir.IR_I: objfile.R_I,
+    ir.IR_IM: objfile.R_I,
+    ir.IR_S: objfile.R_S,
+    ir.IR_SB: objfile.R_SB,
+    ir.IR_U: objfile.R_U,
+    ir.IR_UJ: objfile.R_UJ,
+}
+
+
+# Declared constants are laid down with the Segment method for their size.
+declarators = {
+    1: codegen.Segment.byte,
+    2: codegen.Segment.hword,
+    4: codegen.Segment.word,
+    8: codegen.Segment.dword,
+}
+
+# Pass three hands each record of the program to the emitter for its kind.
+emitters = {
+    ir.IR_DECL: emitDeclaration,
+    ir.IR_ADVANCE: emitAdvance,
+    ir.IR_ALIGN: emitAlign,
+    ir.IR_R: emitR,
+    ir.IR_I: emitI,
+    ir.IR_IM: emitI,
+    ir.IR_S: emitS,
+    ir.IR_SB: emitSB,
+    ir.IR_U: emitU,
+    ir.IR_UJ: emitUJ,
+    ir.IR_BLOB: emitBlob,
+    ir.IR_SECTION: emitSection,
+    ir.IR_LABEL: emitLabel,
+    ir.IR_C: emitCompressed,
+    ir.IR_PSEUDO: emitPseudo,
+    ir.IR_DELETED: emitDeleted,
+}
+
+
+
+# The peephole pass offers each instruction, and the one after it if nothing
+# lies between them, to each of these rules in turn.  A rule returns True if
+# it rewrote or removed either one.  Operands are as Assembler.peephole
+# leaves them: None unless their values are settled.
+def signed12(v):
+    """The value of a 12-bit immediate field, sign-extended."""
+    return ((v & 0xFFF) ^ 0x800) - 0x800
+
+
+def peepholeIdentity(asm, prog, n, m):
+    """
+    Remove an immediate operation of zero upon a register, such as
+    addi x, x, 0.  The canonical no-op, addi x0, x0, 0, stays, since code
+    uses it to pad.
+    """
+    ops = asm.operands(n)
+    if prog.kind[n] != ir.IR_I or ops is None:
+        return False
+    rd, rs, imm = ops
+    if prog.insn[n] not in identityTemplates or signed12(imm):
+        return False
+    if rd & 0x1F == 0 or rd & 0x1F != rs & 0x1F:
+        return False
+    asm.delete(n)
+    return True
+
+
+def peepholeReload(asm, prog, n, m):
+    """
+    A load from where the previous instruction stored becomes a move from
+    the register stored.  A doubleword reload of that very register goes;
+    a word reload of it stays as addiw, since on RV64 lw sign-extends the
+    low half, which need not equal the register's old value.
+    """
+    if m is None or prog.kind[n] != ir.IR_S or prog.kind[m] != ir.IR_IM:
+        return False
+    move = reloadMoves.get((prog.insn[n], prog.insn[m]))
+    store, load = asm.operands(n), asm.operands(m)
+    if move is None or store is None or load is None:
+        return False
+    base, disp, rs = store
+    rd, loadBase, loadDisp = load
+    if base & 0x1F != loadBase & 0x1F:
+        return False
+    if signed12(disp) != signed12(loadDisp):
+        return False
+    if rd & 0x1F == rs & 0x1F and move == opcodes["ADDI"].insn:
+        asm.delete(m)
+        return True
+    prog.kind[m] = ir.IR_I
+    prog.insn[m] = move
+    prog.b[m] = prog.c[n]
+    asm.setOperand(m, "c", 0)
+    return True
+
+
+def peepholeAddi(asm, prog, n, m):
+    """
+    Two additions to the same register become one, or none at all if they
+    cancel out.
+    """
+    addi = opcodes["ADDI"].insn
+    if m is None or prog.kind[n] != ir.IR_I or prog.kind[m] != ir.IR_I:
+        return False
+    if prog.insn[n] != addi or prog.insn[m] != addi:
+        return False
+    first, second = asm.operands(n), asm.operands(m)
+    if first is None or second is None:
+        return False
+    rd, rs, a = first
+    rd2, rs2, b = second
+    rd = rd & 0x1F
+    if rd == 0 or rd2 & 0x1F != rd or rs2 & 0x1F != rd:
+        return False
+    total = signed12(a) + signed12(b)
+    if not -2048 <= total < 2048:
+        return False
+    asm.delete(m)
+    if total == 0 and rs & 0x1F == rd:
+        asm.delete(n)
+    else:
+        asm.setOperand(n, "c", total)
+    return True
+
+
+def peepholeJump(asm, prog, n, m):
+    """Remove a jump to the instruction which follows it."""
+    if prog.kind[n] != ir.IR_UJ or prog.insn[n] != opcodes["JAL"].insn:
+        return False
+    rd = asm.operandValues[prog.a[n]]
+    if rd is None or rd & 0x1F:
+        return False
+    target = prog.exprs[prog.b[n]]
+    if target.kind == EN_ID:
+        target = asm.symbols.get(target.a)
+    if target is None or target.kind != EN_LABEL:
+        return False
+    label = asm.labelRecords[target.a]
+    if label <= n:
+        return False
+    for k in range(n + 1, label):
+        if prog.kind[k] not in (ir.IR_LABEL, ir.IR_DELETED):
+            return False
+    asm.delete(n)
+    return True
+
+
+peepholeRules = [
+    ("identity", peepholeIdentity),
+    ("reload", peepholeReload),
+    ("addi", peepholeAddi),
+    ("jump", peepholeJump),
+]
+
+
+def tokenize(line):
+    """Tokenize a single line of source, returning a list of tokens."""
+    tokens = []
+    for m in lineLexerPattern.finditer(line):
+        group = m.lastgroup
+        if group == 'ws':
+            continue
+        s = m.group(group)
+        if group == 'identifier':
+            tokens.append(Token(kindOfIdentifier(s), s))
+        elif group == 'other':
+            if s in precedenceTable:
+                tokens.append(Token(binOpToken, s))
+            else:
+                tokens.append(Token(characterToken, s))
+        elif group == 'decimal':
+            tokens.append(Token(integerToken, int(s)))
+        elif group == 'hex':
+            tokens.append(Token(integerToken, int(s, 16), string=s))
+        elif group == 'comment':
+            tokens.append(Token(commentToken, s))
+        else:
+            tokens.append(Token(stringToken, s))
+    return tokens
+
+
+def mapFile(filename):
+    """
+    Map a file into memory read-only, returning an object supporting the
+    buffer interface.  Empty files cannot be mapped, and yield an empty
+    string instead.
+    """
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def sliceOf(data, offset, length):
+    """A view of part of a buffer, made without copying it."""
+    try:
+        return memoryview(data)[offset:offset + length]
+    except TypeError:
+        # Python 2's mmap supports only the old buffer interface.
+        return buffer(data, offset, length)
+
+
+def alignmentOf(address):
+    """The largest power of two dividing address, up to a page."""
+    return min(address & -address, 4096) if address else 4096
+
+
+def fileSignatures(filenames):
+    """
+    Map each file to a cheap signature of its state on disk, or None if it
+    cannot be found.  A change in signature prompts watch mode to rebuild;
+    whether a file's content actually changed is left to the lexer cache.
+    """
+    signatures = {}
+    for name in filenames:
+        try:
+            st = os.stat(name)
+            signatures[name] = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            signatures[name] = None
+    return signatures
+
+
+def lexFile(path):
+    """
+    Read and lex a whole source file, returning its path, content digest and
+    tokens (as plain tuples, one list per line).  This runs in the worker
+    processes started by Assembler.prelex.  The digest is None if the file
+    fails to lex; pass one then reports the error in the usual way.
+    """
+    with open(path, "r") as f:
+        source = f.read()
+    try:
+        lines = [tokenize(l) for l in lexcache.splitLines(source)]
+    except ValueError:
+        return path, None, None
+    return path, lexcache.digestOf(source), lexcache.asTuples(lines)
+
+
+def includedFiles(path, lines):
+    """List the files named by include directives in a lexed source file."""
+    dirname = os.path.dirname(path)
+    found = []
+    for l in lines:
+        for n in range(len(l) - 1):
+            if l[n].tokenType != includeToken:
+                continue
+            if l[n+1].tokenType != stringToken:
+                continue
+            name = os.path.join(dirname, l[n+1].tokenValue)
+            found.append(os.path.normpath(name))
+    return found
+
+
+def lexerVersion():
+    """
+    Identifies the lexer's output for the purposes of caching: the assembler
+    version, plus a digest of the keyword table, since token types are
+    numbered after it.
+    """
+    table = repr(sorted(keywords.items()))
+    return "{}/{}".format(VERSION, lexcache.digestOf(table))
+
+
+def assemblerVersion():
+    """
+    Identifies the assembler's output for the purposes of the build cache:
+    the version, plus a digest of the source of every module which takes
+    part in assembly, so that changing any of them invalidates old builds.
+    """
+    sources = []
+    for module in (sys.modules[__name__], codegen, ir, objfile, rvc):
+        path = os.path.splitext(module.__file__)[0] + ".py"
+        with open(path, "rb") as f:
+            sources.append(f.read())
+    return "{}/{}".format(VERSION, lexcache.digestOf(b"".join(sources)))
 
 
 class Token(object):
@@ -354,85 +706,19 @@ class Token(object):
 
 
 def kindOfIdentifier(s):
-    s = s.upper()
-    kindMap = {
-        'DWORD': dwordToken,
-        'WORD': wordToken,
-        'HWORD': hwordToken,
-        'BYTE': byteToken,
-        'ADV': advanceToken,
-        'ALIGN': alignToken,
-        'JAL': jalToken,
-        'LUI': luiToken,
-        'AUIPC': auipcToken,
-        'ADDI': addiToken,
-        'SLLI': slliToken,
-        'SLTI': sltiToken,
-        'SLTIU': sltiuToken,
-        'XORI': xoriToken,
-        'SRLI': srliToken,
-        'SRAI': sraiToken,
-        'ORI': oriToken,
-        'ANDI': andiToken,
-        'CSRRW': csrrwToken,
-        'CSRRS': csrrsToken,
-        'CSRRC': csrrcToken,
-        'CSRRWI': csrrwiToken,
-        'CSRRSI': csrrsiToken,
-        'CSRRCI': csrrciToken,
-        'ADDIW': addiwToken,
-        'SLLIW': slliwToken,
-        'SRLIW': srliwToken,
-        'SRAIW': sraiwToken,
-        'JALR': jalrToken,
-        'LB': lbToken,
-        'LH': lhToken,
-        'LW': lwToken,
-        'LD': ldToken,
-        'LBU': lbuToken,
-        'LHU': lhuToken,
-        'LWU': lwuToken,
-        'SB': sbToken,
-        'SH': shToken,
-        'SW': swToken,
-        'SD': sdToken,
-        'BEQ': beqToken,
-        'BNE': bneToken,
-        'BLT': bltToken,
-        'BGE': bgeToken,
-        'BLTU': bltuToken,
-        'BGEU': bgeuToken,
-        'ADD': addToken,
-        'SUB': subToken,
-        'SLL': sllToken,
-        'SLT': sltToken,
-        'SLTU': sltuToken,
-        'XOR': xorToken,
-        'SRL': srlToken,
-        'SRA': sraToken,
-        'OR': orToken,
-        'AND': andToken,
-        'ADDW': addwToken,
-        'SUBW': subwToken,
-        'SLLW': sllwToken,
-        'SRLW': srlwToken,
-        'SRAW': srawToken,
-        'ECALL': ecallToken,
-        'EBREAK': ebreakToken,
-	'URET': uretToken,
-	'SRET': sretToken,
-	'HRET': hretToken,
-	'MRET': mretToken,
-        'WFI': wfiToken,
-        'SFENCEVM': sfencevmToken,
-        'INCLUDE': includeToken,
-        'INCBIN': incbinToken,
-    }
-    return kindMap.get(s, identifierToken)
+    """Classify an identifier as a keyword, mnemonic, or plain identifier.
+    Mnemonics and keywords are case-insensitive; we remember the answer for
+    each distinct spelling, so that classification costs one lookup.
+    """
+    kind = identifierKinds.get(s)
+    if kind is None:
+        kind = keywords.get(s.upper(), identifierToken)
+        identifierKinds[s] = kind
+    return kind
 
 
 def integerExpressionHandler(asm, tok, prec):
-    return ExprNode(EN_INT, tok.tokenValue)
+    return exprNode(asm, EN_INT, tok.tokenValue)
 
 
 def identifierExpressionHandler(asm, tok, prec):
@@ -440,7 +726,7 @@ def identifierExpressionHandler(asm, tok, prec):
     if v is not None:
         return v
     else:
-        return ExprNode(EN_ID, tok.tokenValue)
+        return exprNode(asm, EN_ID, tok.tokenValue)
 
 
 def unaryOperatorHandler(asm, tok, prec):
@@ -448,10 +734,10 @@ def unaryOperatorHandler(asm, tok, prec):
         return expression(asm, precedenceTable['+']+1)
 
     if tok.tokenValue == '-':
-        return ExprNode(EN_NEG, expression(asm, precedenceTable['-']+1))
+        return foldNegate(asm, expression(asm, precedenceTable['-']+1))
 
     if tok.tokenValue == '*':
-        return ExprNode(EN_INT, asm.getLC())
+        return asm.here()
 
     syntaxError(asm, tok)
 
@@ -491,18 +777,16 @@ prefixHandlers = {
     identifierToken: identifierExpressionHandler,
     binOpToken: unaryOperatorHandler,
     characterToken: characterPrefixHandler,
-    stringToken: lambda x, y, z: ExprNode(EN_STR, y.tokenValue),
+    stringToken: lambda x, y, z: exprNode(x, EN_STR, y.tokenValue),
 }
 
 
-def getPrefixHandler(tt):
-    def exprSyntaxError(asm, tok, prec):
-        return syntaxError(asm, tok)
+def exprSyntaxError(asm, tok, prec):
+    return syntaxError(asm, tok)
 
-    if tt not in prefixHandlers:
-        return exprSyntaxError
 
-    return prefixHandlers[tt]
+def getPrefixHandler(tt):
+    return prefixHandlers.get(tt, exprSyntaxError)
 
 
 def commentHandler(asm, tok):
@@ -518,34 +802,34 @@ def evalExpression(asm, root):
         l = evalExpression(asm, root.a)
         r = evalExpression(asm, root.b)
         if l.kind == EN_INT and r.kind == EN_INT:
-            return ExprNode(EN_INT, l.a + r.a)
+            return exprNode(asm, EN_INT, l.a + r.a)
         else:
             return root
     elif root.kind == EN_SUB:
         l = evalExpression(asm, root.a)
         r = evalExpression(asm, root.b)
         if l.kind == EN_INT and r.kind == EN_INT:
-            return ExprNode(EN_INT, l.a - r.a)
+            return exprNode(asm, EN_INT, l.a - r.a)
         else:
             return root
     elif root.kind == EN_MUL:
         l = evalExpression(asm, root.a)
         r = evalExpression(asm, root.b)
         if l.kind == EN_INT and r.kind == EN_INT:
-            return ExprNode(EN_INT, l.a * r.a)
+            return exprNode(asm, EN_INT, l.a * r.a)
         else:
             return root
     elif root.kind == EN_DIV:
         l = evalExpression(asm, root.a)
         r = evalExpression(asm, root.b)
         if l.kind == EN_INT and r.kind == EN_INT:
-            return ExprNode(EN_INT, l.a / r.a)
+            return exprNode(asm, EN_INT, l.a / r.a)
         else:
             return root
     elif root.kind == EN_NEG:
         e = evalExpression(asm, root.a)
         if e.kind == EN_INT:
-            return ExprNode(EN_INT, -e.a)
+            return exprNode(asm, EN_INT, -e.a)
         else:
             return root
     elif root.kind == EN_ID:
@@ -554,27 +838,79 @@ def evalExpression(asm, root):
             return v
         else:
             return root
-    elif root.kind == EN_INT:
+    elif root.kind in (EN_INT, EN_LABEL):
         return root
     else:
         raise Exception("Unhandled expression node type: {}".format(root.kind))
 
 
+def symbolReferences(root):
+    """List the names of the symbols an expression refers to."""
+    names = []
+    stack = [root]
+    while stack:
+        e = stack.pop()
+        if e.kind == EN_ID:
+            names.append(e.a)
+        elif e.kind in binaryKinds:
+            stack.append(e.b)
+            stack.append(e.a)
+        elif e.kind == EN_NEG:
+            stack.append(e.a)
+    return names
+
+
+def evaluate(root, values):
+    """
+    Compute the integer value of an expression, given the values of the
+    symbols it refers to.  Returns None if any of them lacks a value, or the
+    expression is not an integer at all.
+    """
+    kind = root.kind
+    if kind == EN_INT:
+        return root.a
+    if kind == EN_ID or kind == EN_LABEL:
+        return values.get(root.a)
+    if kind == EN_NEG:
+        v = evaluate(root.a, values)
+        return -v if v is not None else None
+    if kind in binaryKinds:
+        l = evaluate(root.a, values)
+        if l is None:
+            return None
+        r = evaluate(root.b, values)
+        if r is None:
+            return None
+        if kind == EN_ADD:
+            return l + r
+        if kind == EN_SUB:
+            return l - r
+        if kind == EN_MUL:
+            return l * r
+        return l // r
+    return None
+
+
 def constantExpression(asm, prec):
     e = evalExpression(asm, expression(asm, prec))
     if e.kind != EN_INT:
         raise Exception("Constant expression expected.")
+    if isinstance(e.a, objfile.Relocatable):
+        raise Exception(
+            "On line {}, absolute expression expected".format(asm.line)
+        )
     return e.a
 
 
-def expression(asm, prec):
-    opTable = {
-        '+': lambda x, y: ExprNode(EN_ADD, x, y),
-        '-': lambda x, y: ExprNode(EN_SUB, x, y),
-        '*': lambda x, y: ExprNode(EN_MUL, x, y),
-        '/': lambda x, y: ExprNode(EN_DIV, x, y),
-    }
+binaryOperators = {
+    '+': lambda asm, x, y: foldBinary(asm, EN_ADD, x, y),
+    '-': lambda asm, x, y: foldBinary(asm, EN_SUB, x, y),
+    '*': lambda asm, x, y: foldBinary(asm, EN_MUL, x, y),
+    '/': lambda asm, x, y: foldBinary(asm, EN_DIV, x, y),
+}
+
 
+def expression(asm, prec):
     t = asm.nextToken()
     lhs = getPrefixHandler(t.tokenType)(asm, t, prec)
 
@@ -582,7 +918,7 @@ def expression(asm, prec):
     while getPrecedence(top.tokenValue) >= prec:
         asm.eatToken()
         rhs = expression(asm, getPrecedence(top.tokenValue)+1)
-        lhs = opTable[top.tokenValue](lhs, rhs)
+        lhs = binaryOperators[top.tokenValue](asm, lhs, rhs)
         top = asm.getToken()
 
     return lhs
@@ -601,8 +937,7 @@ def labelOrAssignmentHandler(asm, tok):
 
     elif t.tokenValue == ':':
         asm.eatToken()
-        v = asm.getLC()
-        asm.setSymbol(tok.tokenValue, ExprNode(EN_INT, v))
+        asm.setSymbol(tok.tokenValue, asm.here(tok.tokenValue))
 
     else:
         syntaxError(asm, tok)
@@ -627,70 +962,96 @@ def declareConstantHandler(asm, tok):
 
 
 def advanceHandler(asm, tok):
-    eTarget = ExprNode(EN_INT, constantExpression(asm, 0))
-    expectCharacter(asm, ",")
-    eFill = expression(asm, 0)
+    eTarget = exprNode(asm, EN_INT, constantExpression(asm, 0))
+    eFill = None
+    t = asm.getToken()
+    if t.tokenType == characterToken and t.tokenValue == ',':
+        asm.eatToken()
+        eFill = expression(asm, 0)
     asm.recordAdvance(eTarget, eFill)
 
 
+def sectionHandler(asm, tok):
+    t = asm.nextToken()
+    if t.tokenType != identifierToken:
+        syntaxError(asm, t)
+        return
+    base = None
+    u = asm.getToken()
+    if u.tokenType == characterToken and u.tokenValue == ',':
+        asm.eatToken()
+        base = constantExpression(asm, 0)
+    asm.enterSection(t.tokenValue, base)
+
+
 def alignHandler(asm, tok):
-    eBoundary = ExprNode(EN_INT, constantExpression(asm, 0))
+    eBoundary = exprNode(asm, EN_INT, constantExpression(asm, 0))
     if eBoundary.kind != EN_INT:
         error("Constant expression expected on line {}".format(asm.line))
         return
     asm.align(eBoundary.a)
 
-def jalHandler(asm, tok):
+def parseR(asm, op):
     rd = expectReg(asm)
-    disp = expression(asm, 0)
-    asm.recordUJ(0x0000006F, rd, disp)
+    rs1 = expectReg(asm)
+    rs2 = expression(asm, 0)
+    return rd, rs1, rs2
 
 
-def genericUHandler(asm, tok, insn):
+def parseI(asm, op):
     rd = expectReg(asm)
-    imm20 = expression(asm, 0)
-    asm.recordU(insn, rd, imm20)
+    rs = expectReg(asm)
+    imm12 = expression(asm, 0)
+    return rd, rs, imm12
 
 
-def genericI1Handler(asm, tok, insn, imm12):
+def parseI1(asm, op):
     rs = expression(asm, 0)
-    asm.recordI(insn, 0, rs, imm12)
-
-def genericIHandler(asm, tok, insn):
-    rd = expectReg(asm)
-    rs = expectReg(asm)
-    imm12 = expression(asm, 0)
-    asm.recordI(insn, rd, rs, imm12)
+    return exprNode(asm, EN_INT, 0), rs, exprNode(asm, EN_INT, op.insn >> 20)
 
 
-def genericIMHandler(asm, tok, insn):
+def parseIM(asm, op):
     rd = expectReg(asm)
     disp, rs1 = expectEA(asm)
-    asm.recordIM(insn, rd, rs1, disp)
+    return rd, rs1, disp
 
 
-def genericSHandler(asm, tok, insn):
+def parseS(asm, op):
     rs2 = expectReg(asm)
     disp, rs1 = expectEA(asm)
-    asm.recordS(insn, rs1, disp, rs2)
+    return rs1, disp, rs2
 
 
-def genericSBHandler(asm, tok, insn):
+def parseSB(asm, op):
     rs1 = expectReg(asm)
     rs2 = expectReg(asm)
     disp = expression(asm, 0)
-    asm.recordSB(insn, rs1, rs2, disp)
+    return rs1, rs2, disp
 
 
-def genericRHandler(asm, tok, insn):
+def parseU(asm, op):
     rd = expectReg(asm)
-    rs1 = expectReg(asm)
-    rs2 = expression(asm, 0)
-    asm.recordR(insn, rd, rs1, rs2,)
+    imm20 = expression(asm, 0)
+    return rd, imm20
+
+
+def parseUJ(asm, op):
+    rd = expectReg(asm)
+    disp = expression(asm, 0)
+    return rd, disp
+
+
+def parseNone(asm, op):
+    return ()
+
+
+def parseCall(asm, op):
+    target = expression(asm, 0)
+    return exprNode(asm, EN_INT, 1), target
 
 
 def placeOpcode(asm, insn):
-    asm.recordWord(ExprNode(EN_INT, insn))
+    asm.recordWord(exprNode(asm, EN_INT, insn))
 
 
 def includeHandler(asm, tok):
@@ -708,7 +1069,17 @@ def incbinHandler(asm, tok):
         raise Exception(
             "On line {}, expected string parameter".format(asm.line)
         )
-    asm.incbin(includedFile.a)
+    offset = 0
+    length = None
+    t = asm.getToken()
+    if t.tokenType == characterToken and t.tokenValue == ',':
+        asm.eatToken()
+        offset = constantExpression(asm, 0)
+        t = asm.getToken()
+        if t.tokenType == characterToken and t.tokenValue == ',':
+            asm.eatToken()
+            length = constantExpression(asm, 0)
+    asm.incbin(includedFile.a, offset, length)
 
 fileScopeHandlers = {
     commentToken: commentHandler,
@@ -719,79 +1090,208 @@ fileScopeHandlers = {
     byteToken: declareConstantHandler,
     advanceToken: advanceHandler,
     alignToken: alignHandler,
-    jalToken: jalHandler,
-    luiToken: lambda a, t: genericUHandler(a, t, 0x00000037),
-    auipcToken: lambda a, t: genericUHandler(a, t, 0x00000017),
-    addiToken: lambda a, t: genericIHandler(a, t, 0x00000013),
-    slliToken: lambda a, t: genericIHandler(a, t, 0x00001013),
-    sltiToken: lambda a, t: genericIHandler(a, t, 0x00002013),
-    sltiuToken: lambda a, t: genericIHandler(a, t, 0x00003013),
-    xoriToken: lambda a, t: genericIHandler(a, t, 0x00004013),
-    srliToken: lambda a, t: genericIHandler(a, t, 0x00005013),
-    sraiToken: lambda a, t: genericIHandler(a, t, 0x40005013),
-    oriToken: lambda a, t: genericIHandler(a, t, 0x00006013),
-    andiToken: lambda a, t: genericIHandler(a, t, 0x00007013),
-    csrrwToken: lambda a, t: genericIHandler(a, t, 0x00001073),
-    csrrsToken: lambda a, t: genericIHandler(a, t, 0x00002073),
-    csrrcToken: lambda a, t: genericIHandler(a, t, 0x00003073),
-    csrrwiToken: lambda a, t: genericIHandler(a, t, 0x00005073),
-    csrrsiToken: lambda a, t: genericIHandler(a, t, 0x00006073),
-    csrrciToken: lambda a, t: genericIHandler(a, t, 0x00007073),
-    addiwToken: lambda a, t: genericIHandler(a, t, 0x0000001B),
-    slliwToken: lambda a, t: genericIHandler(a, t, 0x0000101B),
-    srliwToken: lambda a, t: genericIHandler(a, t, 0x0000501B),
-    sraiwToken: lambda a, t: genericIHandler(a, t, 0x4000501B),
-    jalrToken: lambda a, t: genericIMHandler(a, t, 0x00000067),
-    lbToken: lambda a, t: genericIMHandler(a, t, 0x00000003),
-    lhToken: lambda a, t: genericIMHandler(a, t, 0x00001003),
-    lwToken: lambda a, t: genericIMHandler(a, t, 0x00002003),
-    ldToken: lambda a, t: genericIMHandler(a, t, 0x00003003),
-    lbuToken: lambda a, t: genericIMHandler(a, t, 0x00004003),
-    lhuToken: lambda a, t: genericIMHandler(a, t, 0x00005003),
-    lwuToken: lambda a, t: genericIMHandler(a, t, 0x00006003),
-    sbToken: lambda a, t: genericSHandler(a, t, 0x00000023),
-    shToken: lambda a, t: genericSHandler(a, t, 0x00001023),
-    swToken: lambda a, t: genericSHandler(a, t, 0x00002023),
-    sdToken: lambda a, t: genericSHandler(a, t, 0x00003023),
-    beqToken: lambda a, t: genericSBHandler(a, t, 0x00000063),
-    bneToken: lambda a, t: genericSBHandler(a, t, 0x00001063),
-    bltToken: lambda a, t: genericSBHandler(a, t, 0x00004063),
-    bgeToken: lambda a, t: genericSBHandler(a, t, 0x00005063),
-    bltuToken: lambda a, t: genericSBHandler(a, t, 0x00006063),
-    bgeuToken: lambda a, t: genericSBHandler(a, t, 0x00007063),
-    addToken: lambda a, t: genericRHandler(a, t, 0x00000033),
-    subToken: lambda a, t: genericRHandler(a, t, 0x40000033),
-    sllToken: lambda a, t: genericRHandler(a, t, 0x00001033),
-    sltToken: lambda a, t: genericRHandler(a, t, 0x00002033),
-    sltuToken: lambda a, t: genericRHandler(a, t, 0x00003033),
-    xorToken: lambda a, t: genericRHandler(a, t, 0x00004033),
-    srlToken: lambda a, t: genericRHandler(a, t, 0x00005033),
-    sraToken: lambda a, t: genericRHandler(a, t, 0x40005033),
-    orToken: lambda a, t: genericRHandler(a, t, 0x00006033),
-    andToken: lambda a, t: genericRHandler(a, t, 0x00007033),
-    addwToken: lambda a, t: genericRHandler(a, t, 0x0000003B),
-    subwToken: lambda a, t: genericRHandler(a, t, 0x4000003B),
-    sllwToken: lambda a, t: genericRHandler(a, t, 0x0000103B),
-    srlwToken: lambda a, t: genericRHandler(a, t, 0x0000503B),
-    srawToken: lambda a, t: genericRHandler(a, t, 0x4000503B),
-    ecallToken: lambda a, t: placeOpcode(a, 0x00000073),
-    ebreakToken: lambda a, t: placeOpcode(a, 0x00100073),
-    uretToken: lambda a, t: placeOpcode(a, 0x00200073),
-    sretToken: lambda a, t: placeOpcode(a, 0x10200073),
-    hretToken: lambda a, t: placeOpcode(a, 0x20200073),
-    mretToken: lambda a, t: placeOpcode(a, 0x30200073),
-    wfiToken: lambda a, t: placeOpcode(a, 0x10500073),
-    sfencevmToken: lambda a, t: genericI1Handler(a, t, 0x00000073, 0x104),
-    includeToken: lambda a, t: includeHandler(a, t),
-    incbinToken: lambda a, t: incbinHandler(a, t),
+    includeToken: includeHandler,
+    incbinToken: incbinHandler,
+    sectionToken: sectionHandler,
 }
 
+# Assembler directives are keywords too.  Together with the mnemonics of the
+# opcode table, they form the set of reserved words recognized by the lexer.
+keywords = {
+    'DWORD': dwordToken,
+    'WORD': wordToken,
+    'HWORD': hwordToken,
+    'BYTE': byteToken,
+    'ADV': advanceToken,
+    'ALIGN': alignToken,
+    'INCLUDE': includeToken,
+    'INCBIN': incbinToken,
+    'SECTION': sectionToken,
+}
 
-def fileScopeHandler(tt):
-    if tt not in fileScopeHandlers:
-        return syntaxError
+# Identifiers seen so far, mapped to their token types.  See kindOfIdentifier.
+identifierKinds = {}
+
+# Instruction formats.  Each format names the parser used to read an
+# instruction's operands, and the function which records the instruction for
+# later encoding by the corresponding codegen.Segment.put* method.
+FMT_R = 1
+FMT_I = 2
+FMT_I1 = 3
+FMT_IM = 4
+FMT_S = 5
+FMT_SB = 6
+FMT_U = 7
+FMT_UJ = 8
+FMT_SYS = 9
+FMT_PSEUDO = 10
+FMT_CALL = 11
+
+# Pseudo-instructions stand for the shortest sequence of instructions found
+# for their operands; see codegen.loadImmediate and friends.  Each is given
+# as rd, value, and the address at which the sequence begins.
+PS_LI = 1
+PS_LA = 2
+PS_CALL = 3
+
+pseudoSequences = {
+    PS_LI: lambda rd, value, pc: codegen.loadImmediate(rd, value),
+    PS_LA: codegen.loadAddress,
+    PS_CALL: lambda rd, value, pc: codegen.callSequence(value, pc),
+}
+
+# The most instructions each pseudo-instruction may need, and so the room
+# set aside for it while its operands are unknown.
+pseudoLengths = {
+    PS_LI: 8,
+    PS_LA: 2,
+    PS_CALL: 2,
+}
+
+formats = {
+    FMT_R: (parseR, lambda a, i, o: a.recordR(i, *o)),
+    FMT_I: (parseI, lambda a, i, o: a.recordI(i, *o)),
+    FMT_I1: (parseI1, lambda a, i, o: a.recordI(i, *o)),
+    FMT_IM: (parseIM, lambda a, i, o: a.recordIM(i, *o)),
+    FMT_S: (parseS, lambda a, i, o: a.recordS(i, *o)),
+    FMT_SB: (parseSB, lambda a, i, o: a.recordSB(i, *o)),
+    FMT_U: (parseU, lambda a, i, o: a.recordU(i, *o)),
+    FMT_UJ: (parseUJ, lambda a, i, o: a.recordUJ(i, *o)),
+    FMT_SYS: (parseNone, lambda a, i, o: placeOpcode(a, i)),
+    FMT_PSEUDO: (parseU, lambda a, i, o: a.recordPseudo(i, *o)),
+    FMT_CALL: (parseCall, lambda a, i, o: a.recordPseudo(i, *o)),
+}
+
+pseudoFormats = (FMT_PSEUDO, FMT_CALL)
 
-    return fileScopeHandlers[tt]
+
+class Opcode(object):
+    """Describes a single machine instruction: its mnemonic, its format, and
+    the 32-bit instruction word template into which its operands are encoded.
+    """
+
+    def __init__(self, mnemonic, token, fmt, insn):
+        self.mnemonic = mnemonic
+        self.token = token
+        self.format = fmt
+        self.insn = insn
+        self.parse, self.record = formats[fmt]
+
+    def __call__(self, asm, tok):
+        if self.format in pseudoFormats:
+            # Pseudo-instruction names are not reserved; followed by a colon
+            # or an equals sign, they are labels or symbols like any other.
+            t = asm.getToken()
+            if t.tokenType == characterToken and t.tokenValue in (':', '='):
+                labelOrAssignmentHandler(asm, tok)
+                return
+        self.record(asm, self.insn, self.parse(asm, self))
+
+
+# The opcode table.  Supporting a new instruction, or a whole new RISC-V
+# extension, only requires adding rows here.
+opcodeTable = [
+    # RV32I/RV64I base integer instruction set.
+    ('JAL', FMT_UJ, 0x0000006F),
+    ('LUI', FMT_U, 0x00000037),
+    ('AUIPC', FMT_U, 0x00000017),
+    ('ADDI', FMT_I, 0x00000013),
+    ('SLLI', FMT_I, 0x00001013),
+    ('SLTI', FMT_I, 0x00002013),
+    ('SLTIU', FMT_I, 0x00003013),
+    ('XORI', FMT_I, 0x00004013),
+    ('SRLI', FMT_I, 0x00005013),
+    ('SRAI', FMT_I, 0x40005013),
+    ('ORI', FMT_I, 0x00006013),
+    ('ANDI', FMT_I, 0x00007013),
+    ('ADDIW', FMT_I, 0x0000001B),
+    ('SLLIW', FMT_I, 0x0000101B),
+    ('SRLIW', FMT_I, 0x0000501B),
+    ('SRAIW', FMT_I, 0x4000501B),
+    ('JALR', FMT_IM, 0x00000067),
+    ('LB', FMT_IM, 0x00000003),
+    ('LH', FMT_IM, 0x00001003),
+    ('LW', FMT_IM, 0x00002003),
+    ('LD', FMT_IM, 0x00003003),
+    ('LBU', FMT_IM, 0x00004003),
+    ('LHU', FMT_IM, 0x00005003),
+    ('LWU', FMT_IM, 0x00006003),
+    ('SB', FMT_S, 0x00000023),
+    ('SH', FMT_S, 0x00001023),
+    ('SW', FMT_S, 0x00002023),
+    ('SD', FMT_S, 0x00003023),
+    ('BEQ', FMT_SB, 0x00000063),
+    ('BNE', FMT_SB, 0x00001063),
+    ('BLT', FMT_SB, 0x00004063),
+    ('BGE', FMT_SB, 0x00005063),
+    ('BLTU', FMT_SB, 0x00006063),
+    ('BGEU', FMT_SB, 0x00007063),
+    ('ADD', FMT_R, 0x00000033),
+    ('SUB', FMT_R, 0x40000033),
+    ('SLL', FMT_R, 0x00001033),
+    ('SLT', FMT_R, 0x00002033),
+    ('SLTU', FMT_R, 0x00003033),
+    ('XOR', FMT_R, 0x00004033),
+    ('SRL', FMT_R, 0x00005033),
+    ('SRA', FMT_R, 0x40005033),
+    ('OR', FMT_R, 0x00006033),
+    ('AND', FMT_R, 0x00007033),
+    ('ADDW', FMT_R, 0x0000003B),
+    ('SUBW', FMT_R, 0x4000003B),
+    ('SLLW', FMT_R, 0x0000103B),
+    ('SRLW', FMT_R, 0x0000503B),
+    ('SRAW', FMT_R, 0x4000503B),
+    ('ECALL', FMT_SYS, 0x00000073),
+    ('EBREAK', FMT_SYS, 0x00100073),
+
+    # Zicsr control and status register instructions.
+    ('CSRRW', FMT_I, 0x00001073),
+    ('CSRRS', FMT_I, 0x00002073),
+    ('CSRRC', FMT_I, 0x00003073),
+    ('CSRRWI', FMT_I, 0x00005073),
+    ('CSRRSI', FMT_I, 0x00006073),
+    ('CSRRCI', FMT_I, 0x00007073),
+
+    # Privileged instructions.
+    ('URET', FMT_SYS, 0x00200073),
+    ('SRET', FMT_SYS, 0x10200073),
+    ('HRET', FMT_SYS, 0x20200073),
+    ('MRET', FMT_SYS, 0x30200073),
+    ('WFI', FMT_SYS, 0x10500073),
+    ('SFENCEVM', FMT_I1, 0x10400073),
+
+    # Pseudo-instructions.
+    ('LI', FMT_PSEUDO, PS_LI),
+    ('LA', FMT_PSEUDO, PS_LA),
+    ('CALL', FMT_CALL, PS_CALL),
+]
+
+# Mnemonics mapped to their opcode descriptors.
+opcodes = {}
+
+for n, (mnemonic, fmt, insn) in enumerate(opcodeTable):
+    op = Opcode(mnemonic, firstOpcodeToken + n, fmt, insn)
+    opcodes[mnemonic] = op
+    keywords[mnemonic] = op.token
+    fileScopeHandlers[op.token] = op
+    if fmt in pseudoFormats:
+        prefixHandlers[op.token] = identifierExpressionHandler
+
+# Immediate operations which leave a register as it is, given zero.
+identityTemplates = set(
+    opcodes[m].insn for m in ("ADDI", "ORI", "XORI", "SLLI", "SRLI", "SRAI")
+)
+
+# A store, and a load of the same width from the same place, mapped to the
+# instruction which moves the stored register to the load's destination.
+reloadMoves = {
+    (opcodes["SD"].insn, opcodes["LD"].insn): opcodes["ADDI"].insn,
+    (opcodes["SW"].insn, opcodes["LW"].insn): opcodes["ADDIW"].insn,
+}
+
+
+def fileScopeHandler(tt):
+    return fileScopeHandlers.get(tt, syntaxError)
 
 
 class Assembler(object):
@@ -801,25 +1301,63 @@ class Assembler(object):
     def __init__(self, args):
         """Initializes the assembler to a known good state."""
         self.args = args
+        self.options = 0
         self.lexerState = fileScope
         self.tokenStream = []
         self.cursor = 0
         self.line = 0
         self.symbols = {}
-        self.section = []
+        self.exprNodes = {}
+        self.sections = [codegen.Segment("text", 0)]
+        self.sectionIndex = {"text": 0}
+        self.sectionLCs = [0]
+        self.sectionRelocatable = [False]
+        self.sectionAlign = [1]
+        self.sectionLCAlignments = [4096]
+        self.section = 0
         self.lc = 0
-        self.pass2todo = []
-        self.seg = codegen.Segment()
+        # The largest power of two the location counter is sure to remain a
+        # multiple of, however instructions are later resized.
+        self.lcAlignment = 4096
+        self.insnAlign = 4
+        self.labelRecords = {}
+        self.labelAddresses = {}
+        self.savings = {}
+        self.pseudoSizes = {}
+        self.pseudoParts = {}
+        self.relaxed = 0
+        self.peepholeHits = {}
+        self.program = ir.Program()
+        self.values = {}
+        self.operandValues = []
+        self.cycles = []
+        self.seg = self.sections[0]
         self._filename = "<none>"
         self._filelike = None
+        self.lexCache = None
+        self.buildCache = None
+        self.dependencies = []
 
-    def _defer(self, obj):
+    def _defer(self, kind, insn, a=None, b=None, c=None):
         """This is a two-pass assembler.  While parsing commences in pass one,
         we need to record a list of instructions to execute during pass two.
         The _defer function records a single step for later processing during
         pass two.
         """
-        self.pass2todo = self.pass2todo + [obj]
+        self.program.append(kind, insn, self.lc, self.line, a, b, c)
+
+    def _declare(self, v, size):
+        self._defer(ir.IR_DECL, size, v)
+        sz = size
+        if v.kind == EN_STR:
+            sz = size*len(v.a)
+        self._grow(sz)
+
+    def _grow(self, size):
+        """Move the location counter past size bytes just recorded."""
+        self.lc = self.lc + size
+        if size:
+            self.lcAlignment = min(self.lcAlignment, alignmentOf(size))
 
     def recordDWord(self, dw):
         """Records an arbitrary, 64-bit quantity to the object file.
@@ -827,11 +1365,7 @@ class Assembler(object):
         boundary first.
         """
         self.align(8)
-        self._defer(Declaration(self.line, dw, 8))
-        sz = 8
-        if dw.kind == EN_STR:
-            sz = 8*len(dw.a)
-        self.lc = self.lc + sz
+        self._declare(dw, 8)
 
     def recordWord(self, w):
         """Records an arbitrary, 32-bit quantity to the object file.
@@ -839,11 +1373,7 @@ class Assembler(object):
         boundary first.
         """
         self.align(4)
-        self._defer(Declaration(self.line, w, 4))
-        sz = 4
-        if w.kind == EN_STR:
-            sz = 4*len(w.a)
-        self.lc = self.lc + sz
+        self._declare(w, 4)
 
     def recordHWord(self, h):
         """Records an arbitrary, 16-bit quantity to the object file.
@@ -851,80 +1381,172 @@ class Assembler(object):
         boundary first.
         """
         self.align(2)
-        self._defer(Declaration(self.line, h, 2))
-        sz = 2
-        if h.kind == EN_STR:
-            sz = 2*len(h.a)
-        self.lc = self.lc + sz
+        self._declare(h, 2)
 
     def recordByte(self, b):
         """Records an arbitrary, 8-bit quantity to the object file."""
-        self._defer(Declaration(self.line, b, 1))
-        sz = 1
-        if b.kind == EN_STR:
-            sz = len(b.a)
-        self.lc = self.lc + sz
+        self._declare(b, 1)
 
     def recordAdvance(self, target, fill):
         """When the programmer specifies the ADV mnemonic, this method is
-        called to record its behavior for pass two.
+        called to record its behavior for pass two.  Without a fill value, the
+        bytes skipped are left as a hole in the section.
         """
-        self._defer(Advance(ExprNode(EN_INT, target.a - self.lc), fill))
+        self._defer(ir.IR_ADVANCE, 0, target, fill)
         if self.lc < target.a:
             self.lc = target.a
+            self.lcAlignment = min(self.lcAlignment, alignmentOf(target.a))
+
+    def enterSection(self, name, base=None):
+        """
+        Switch to the named section, creating it if need be.  A new section
+        begins at base or, by default, wherever the location counter stands.
+        Returning to a section resumes assembly where it last left off.  The
+        base of a section may be given again, but only changed while nothing
+        has yet been laid down in it.
+
+        When assembling an object file, a section without a base is
+        relocatable instead: its addresses are offsets from wherever the
+        linker places it.
+        """
+        self.sectionLCs[self.section] = self.lc
+        self.sectionLCAlignments[self.section] = self.lcAlignment
+        i = self.sectionIndex.get(name)
+        if i is None:
+            relocatable = False
+            if base is None:
+                relocatable = bool(self.options & OPT_OBJECT)
+                base = 0 if relocatable else self.lc
+            i = len(self.sections)
+            self.sections.append(codegen.Segment(name, base))
+            self.sectionIndex[name] = i
+            self.sectionLCs.append(base)
+            self.sectionRelocatable.append(relocatable)
+            self.sectionAlign.append(1)
+            self.sectionLCAlignments.append(alignmentOf(base))
+        elif base is not None and (
+            base != self.sections[i].base or self.sectionRelocatable[i]
+        ):
+            seg = self.sections[i]
+            if self.sectionLCs[i] != seg.base:
+                raise Exception(
+                    "On line {}, section {} already begins at {}".format(
+                        self.line, name, seg.base
+                    )
+                )
+            seg.base = seg.lc = base
+            self.sectionLCs[i] = base
+            self.sectionLCAlignments[i] = alignmentOf(base)
+            self.sectionRelocatable[i] = False
+        self.section = i
+        self.lc = self.sectionLCs[i]
+        self.lcAlignment = self.sectionLCAlignments[i]
+        self._defer(ir.IR_SECTION, i)
 
     def align(self, boundary):
-        """Align location counter to the indicated (power of two) boundary."""
+        """Align location counter to the indicated (power of two) boundary.
+        Nothing is recorded if the location counter is already aligned.
+        While relaxing, the location counter may yet move, so padding is
+        recorded unless the location counter is sure to stay aligned.
+        """
+        if boundary > self.sectionAlign[self.section]:
+            self.sectionAlign[self.section] = boundary
         newLC = (self.lc + (boundary - 1)) & (-boundary)
-        self._defer(Advance(ExprNode(EN_INT, newLC - self.lc), ExprNode(EN_INT, 0)))
-        self.lc = newLC
+        if self.options & OPT_RELAXING:
+            aligned = boundary <= self.lcAlignment
+        else:
+            aligned = newLC == self.lc
+        if not aligned:
+            self._defer(ir.IR_ALIGN, boundary)
+            self.lc = newLC
+        self.lcAlignment = max(self.lcAlignment, boundary)
+
+    def _recordInsn(self, kind, insn, a, b, c=None):
+        self.align(self.insnAlign)
+        self._defer(kind, insn, a, b, c)
+        self._grow(4)
+        if self.options & OPT_COMPRESS:
+            self.lcAlignment = min(self.lcAlignment, 2)
+
+    def recordPseudo(self, kind, rd, value):
+        """
+        Records a pseudo-instruction.  If its operands are known, it is given
+        exactly the room its instructions need, else as much as it might
+        need.  While relaxing, only li is sure of its length, since the
+        others depend on where they lie.
+        """
+        if kind != PS_LI and self.sectionRelocatable[self.section]:
+            raise Exception(
+                "On line {}, only li may be used in a relocatable "
+                "section".format(self.line)
+            )
+        self.align(self.insnAlign)
+        length = pseudoLengths[kind]
+        known = rd.kind == EN_INT and value.kind == EN_INT and not (
+            isinstance(value.a, objfile.Relocatable)
+        )
+        if known and (kind == PS_LI or not self.options & OPT_RELAXING):
+            length = len(pseudoSequences[kind](rd.a & 0x1F, value.a, self.lc))
+        self.pseudoSizes[len(self.program)] = 4 * length
+        self._defer(ir.IR_PSEUDO, kind, rd, value)
+        self._grow(4 * length)
+        if self.options & OPT_COMPRESS:
+            self.lcAlignment = min(self.lcAlignment, 2)
 
     def recordR(self, insn, rd, rs1, rs2):
         """Records all 3-register operations"""
-        self.align(4)
-        self._defer(RInsn(insn, rd, rs1, rs2))
-        self.lc = self.lc + 4
+        self._recordInsn(ir.IR_R, insn, rd, rs1, rs2)
 
     def recordSB(self, insn, rs1, rs2, disp):
         """Records all conditional branch instructions."""
-        self.align(4)
-        self._defer(SBInsn(self.lc, insn, rs1, disp, rs2))
-        self.lc = self.lc + 4
+        self._recordInsn(ir.IR_SB, insn, rs1, disp, rs2)
 
     def recordS(self, insn, rs1, disp, rs2):
         """Records all store instructions."""
-        self.align(4)
-        self._defer(SInsn(None, insn, rs1, disp, rs2))
-        self.lc = self.lc + 4
+        self._recordInsn(ir.IR_S, insn, rs1, disp, rs2)
 
     def recordIM(self, insn, rd, rs, disp):
         """Records all loads and the JALR instructions."""
-        self.align(4)
-        self._defer(IMInsn(insn, rd, rs, disp))
-        self.lc = self.lc + 4
+        self._recordInsn(ir.IR_IM, insn, rd, rs, disp)
 
     def recordI(self, insn, rd, rs, imm12):
         """Records all instructions of the general form INSN rd, rs, imm12"""
-        self.align(4)
-        self._defer(IInsn(insn, rd, rs, imm12))
-        self.lc = self.lc + 4
+        self._recordInsn(ir.IR_I, insn, rd, rs, imm12)
 
     def recordU(self, insn, rd, imm20):
         """Records a LUI or AUIPC instruction."""
-        self.align(4)
-        self._defer(UInsn(insn, rd, imm20))
-        self.lc = self.lc + 4
+        self._recordInsn(ir.IR_U, insn, rd, imm20)
 
     def recordUJ(self, insn, rd, disp):
         """Records an unconditional jump."""
-        self.align(4)
-        self._defer(UJInsn(self.lc, insn, rd, disp))
-        self.lc = self.lc + 4
+        self._recordInsn(ir.IR_UJ, insn, rd, disp)
 
     def getLC(self):
-        """Retrieves the current location counter."""
+        """
+        Retrieves the current location counter.  In a relocatable section,
+        its value is only known relative to the start of the section.
+        """
+        if self.sectionRelocatable[self.section]:
+            return objfile.Relocatable.section(
+                self.sections[self.section].name, self.lc
+            )
         return self.lc
 
+    def here(self, name=None):
+        """
+        An expression for the location counter, as the address of the label
+        name if one is given.  While relaxing, addresses are not final until
+        every instruction has its size, so the place is recorded in the
+        program and its address left to be filled in.  Unnamed places get a
+        name no identifier can take.
+        """
+        if not self.options & OPT_RELAXING:
+            return exprNode(self, EN_INT, self.getLC())
+        name = name or "*{}".format(len(self.program))
+        self.labelRecords[name] = len(self.program)
+        self._defer(ir.IR_LABEL, 0)
+        return exprNode(self, EN_LABEL, name)
+
     def setSymbol(self, name, value):
         """Sets a global symbol."""
         assert(type(value).__name__ == "ExprNode")
@@ -1086,63 +1708,574 @@ class Assembler(object):
             self.string = self.string + ch
             return
 
-    def printUndefs(self, e):
-        if e.kind in [EN_ADD, EN_SUB, EN_MUL, EN_DIV]:
-            self.printUndefs(e.a)
-            self.printUndefs(e.b)
+    def lexLine(self, line):
+        """Tokenize an entire line of source at once, appending the resulting
+        tokens to the current input stream.  This is the default lexer; see
+        lexChar for the character-at-a-time equivalent.
+        """
+        self.tokenStream.extend(tokenize(line))
+
+    def printUndefs(self, e, seen=None):
+        if e.kind in binaryKinds:
+            self.printUndefs(e.a, seen)
+            self.printUndefs(e.b, seen)
         elif e.kind == EN_NEG:
-            self.printUndefs(e.a)
+            self.printUndefs(e.a, seen)
         elif e.kind == EN_ID:
             v = self.getSymbol(e.a)
             if v is None:
                 error("ERROR: {} remains undefined.".format(e.a))
-            else:
-                self.printUndefs(v)
+            elif e.a not in self.values:
+                # Defined in terms of something undefined; but beware of
+                # circular definitions, which resolveSymbols reports.
+                seen = seen or set()
+                if e.a not in seen:
+                    seen.add(e.a)
+                    self.printUndefs(v, seen)
         elif e.kind == EN_INT:
             """Do nothing.  Integers are always defined."""
 
+    def resolveSymbols(self):
+        """
+        Once pass one is complete, compute the value of every symbol exactly
+        once.  Symbols are visited in dependency order, so that each is
+        evaluated only after everything it refers to; circular definitions
+        are recorded in self.cycles.  Then every operand of the program is
+        evaluated against those values, leaving pass three nothing to do but
+        read them.
+        """
+        symbols = self.symbols
+        values = dict(self.labelAddresses)
+        done = set()
+        visiting = set()
+        cycles = []
+
+        # An object file may refer to symbols defined by other modules.
+        # Their values stand for addresses fixed when the module is linked.
+        self.imports = []
+        if self.options & OPT_OBJECT:
+            refs = set()
+            for e in set(self.program.exprs) | set(symbols.values()):
+                refs.update(symbolReferences(e))
+            self.imports = sorted(refs - set(symbols))
+            for name in self.imports:
+                values[name] = objfile.Relocatable.symbol(name)
+
+        for root in sorted(symbols):
+            if root in done:
+                continue
+            visiting.add(root)
+            stack = [(root, iter(symbolReferences(symbols[root])))]
+            while stack:
+                name, refs = stack[-1]
+                for ref in refs:
+                    if ref in visiting:
+                        path = [n for n, _ in stack]
+                        cycles.append(path[path.index(ref):] + [ref])
+                    elif ref not in done and ref in symbols:
+                        visiting.add(ref)
+                        stack.append(
+                            (ref, iter(symbolReferences(symbols[ref])))
+                        )
+                        break
+                else:
+                    stack.pop()
+                    visiting.discard(name)
+                    done.add(name)
+                    v = evaluate(symbols[name], values)
+                    if v is not None:
+                        values[name] = v
+
+        self.values = values
+        self.cycles = cycles
+
+        # Identical operands share a single node, so each distinct operand
+        # need only be evaluated once.
+        memo = {}
+        operandValues = []
+        for e in self.program.exprs:
+            try:
+                v = memo[e]
+            except KeyError:
+                v = memo[e] = evaluate(e, values)
+            operandValues.append(v)
+        self.operandValues = operandValues
+
     def pass1line(self, line):
         """Perform a pass-1 assembly step on the given line of code."""
-        for c in line:
-            self.lexChar(c)
+        if self.options & OPT_CHARLEXER:
+            for c in line:
+                self.lexChar(c)
+        else:
+            self.lexLine(line)
         self.lexEOL()
 
     def pass2(self):
         """Identify any symbols which remain undefined, and report them as
         errors.
         """
-        for i in self.pass2todo:
-            self.printUndefs(i.a) if i.a else None
-            self.printUndefs(i.b) if i.b else None
-            self.printUndefs(i.c) if i.c else None
+        for cycle in self.cycles:
+            error("ERROR: circular definition: {}".format(" -> ".join(cycle)))
+        values = self.operandValues
+        for n, e in enumerate(self.program.exprs):
+            if values[n] is None:
+                self.printUndefs(e)
 
     def pass3(self):
         """
         Once we have assembled the first pass of our program, we now ask each
-        instruction in the resulting program to emit its data to a list of
-        bytes.
+        record in the resulting program to emit its data into its section.
+        Instructions are encoded in batches, one per format, and copied into
+        place a run of consecutive instructions at a time.
+        """
+        prog = self.program
+        kinds = prog.kind
+        count = len(prog)
+        self.seg = self.sections[0]
+        if self.options & OPT_OBJECT:
+            self._extractRelocations()
+
+        # Lay down everything but instructions, reserving room for each run
+        # of consecutive instructions as it is met.
+        blocks = []
+        n = 0
+        while n < count:
+            if kinds[n] not in gatherers:
+                emitters[kinds[n]](self, prog, n)
+                n = n + 1
+                continue
+            first = n
+            while n < count and kinds[n] in gatherers:
+                n = n + 1
+            seg = self.seg
+            blocks.append((seg, seg.lc, first, n))
+            seg.advance(seg.lc + 4 * (n - first), 0)
+
+        # Encode the instructions a format at a time, then copy each run of
+        # them into its place.
+        byKind = self._instructionsByKind()
+        self._checkInstructions(byKind)
+        words = self._encodeInstructions(byKind)
+        for seg, at, first, last in blocks:
+            seg.putWords(at, words[first:last])
+
+    def _instructionsByKind(self):
+        """List the numbers of the instruction records of each kind."""
+        kinds = self.program.kind
+        byKind = {}
+        for n in range(len(kinds)):
+            if kinds[n] in gatherers:
+                byKind.setdefault(kinds[n], []).append(n)
+        return byKind
+
+    def _encodeInstructions(self, byKind):
+        """
+        Encode the instructions listed by kind, a format at a time, into an
+        array of words indexed by record number.
+        """
+        prog = self.program
+        values = self.operandValues
+        words = codegen.wordArray(len(prog))
+        for kind, ns in byKind.items():
+            insns = [prog.insn[n] for n in ns]
+            op = lambda column: [values[column[n]] for n in ns]
+            codegen.scatter(words, ns, gatherers[kind](prog, ns, insns, op))
+        return words
+
+    def _defined(self, n):
+        """True if every operand of record n has a value."""
+        prog = self.program
+        values = self.operandValues
+        return all(
+            values[i] is not None for i in (prog.a[n], prog.b[n], prog.c[n])
+            if i != ir.NO_OPERAND
+        )
+
+    def operands(self, n):
+        """The values of the operands of record n, or None if any is unknown."""
+        prog = self.program
+        values = self.operandValues
+        ops = tuple(
+            values[i] for i in (prog.a[n], prog.b[n], prog.c[n])
+            if i != ir.NO_OPERAND
+        )
+        return None if None in ops else ops
+
+    def setOperand(self, n, column, value):
+        """Give record n a new, constant operand in the named column."""
+        prog = self.program
+        getattr(prog, column)[n] = prog.expr(exprNode(self, EN_INT, value))
+        self.operandValues.append(value)
+
+    def delete(self, n):
+        """Remove instruction n from the program."""
+        self.program.kind[n] = ir.IR_DELETED
+
+    def peephole(self):
         """
-        for i in self.pass2todo:
-            i.asBytes(self)
+        Remove redundant instructions from the program, and combine adjacent
+        ones, by the rules in peepholeRules, until none applies.  Since
+        instructions may vanish, this is done before relax settles where
+        labels lie, and no label yet has an address: rules only consider
+        operands which do not depend on one.  An instruction is only ever
+        combined with the next if no label stands between them.
+
+        The pass cannot see code which finds an instruction at an offset
+        from a label, as *+16 does; such code must not span instructions
+        which may be removed.  Nor can it tell memory from memory-mapped
+        I/O: the reload rule assumes a load reads back what was just
+        stored, so peephole must not be used on code which touches device
+        registers.  The number of times each rule applied is kept
+        in self.peepholeHits, by rule name.
+        """
+        prog = self.program
+        kinds = prog.kind
+        count = len(prog)
+        self.resolveSymbols()
+        hits = [0] * len(peepholeRules)
+        again = True
+        while again:
+            again = False
+            for n in range(count):
+                if kinds[n] not in gatherers:
+                    continue
+                m = n + 1
+                while m < count and kinds[m] == ir.IR_DELETED:
+                    m = m + 1
+                if m == count or kinds[m] not in gatherers:
+                    m = None
+                for i, (_, rule) in enumerate(peepholeRules):
+                    if rule(self, prog, n, m):
+                        hits[i] = hits[i] + 1
+                        again = True
+                        break
+        self.peepholeHits = dict(
+            (name, k) for (name, _), k in zip(peepholeRules, hits)
+        )
+        if self.options & OPT_QUIET:
+            return
+        for name, _ in peepholeRules:
+            print("Peephole rule {}: {} applied".format(
+                name, self.peepholeHits[name]
+            ))
+
+    def layout(self, sizes=None):
+        """
+        Work out the address of every record and label, given the size of
+        any instruction or pseudo-instruction which differs from the room
+        set aside for it in pass one.
+        """
+        sizes = sizes or {}
+        prog = self.program
+        kinds, insns, lcs, exprs = prog.kind, prog.insn, prog.lc, prog.exprs
+        ends = [seg.base for seg in self.sections]
+        section = 0
+        lc = ends[0]
+        for n in range(len(prog)):
+            kind = kinds[n]
+            if kind == ir.IR_SECTION:
+                ends[section] = lc
+                section = insns[n]
+                lc = ends[section]
+            lcs[n] = lc
+            if kind in gatherers:
+                lc = lc + sizes.get(n, 4)
+            elif kind == ir.IR_C:
+                lc = lc + 2
+            elif kind == ir.IR_PSEUDO:
+                lc = lc + sizes.get(n, self.pseudoSizes[n])
+            elif kind == ir.IR_DECL:
+                e = exprs[prog.a[n]]
+                lc = lc + insns[n] * (len(e.a) if e.kind == EN_STR else 1)
+            elif kind == ir.IR_ALIGN:
+                lc = (lc + (insns[n] - 1)) & (-insns[n])
+            elif kind == ir.IR_ADVANCE:
+                lc = max(lc, exprs[prog.a[n]].a)
+            elif kind == ir.IR_BLOB:
+                lc = lc + len(prog.blobs[insns[n]])
+        self.labelAddresses = dict(
+            (name, lcs[n]) for name, n in self.labelRecords.items()
+        )
+
+    def _pseudoWords(self, n, pc):
+        """The instruction words pseudo-instruction n stands for at pc."""
+        prog = self.program
+        rd = self.operandValues[prog.a[n]]
+        value = self.operandValues[prog.b[n]]
+        if isinstance(value, objfile.Relocatable):
+            raise Exception(
+                "On line {}, absolute expression expected".format(prog.line[n])
+            )
+        return pseudoSequences[prog.insn[n]](rd & 0x1F, value, pc)
+
+    def _sequences(self, compress):
+        """
+        Yield the number of each record whose size is yet to be settled, with
+        the instruction words it would lay down where it now lies.  Plain
+        instructions are only of interest when compressing.  Records with
+        undefined operands are left for pass two to report.
+        """
+        if compress:
+            byKind = self._instructionsByKind()
+            if None in self.operandValues:
+                for kind, ns in byKind.items():
+                    byKind[kind] = [n for n in ns if self._defined(n)]
+            words = self._encodeInstructions(byKind)
+            for ns in byKind.values():
+                for n in ns:
+                    yield n, [int(words[n])]
+        lc = self.program.lc
+        for n in sorted(self.pseudoSizes):
+            if self._defined(n):
+                yield n, self._pseudoWords(n, lc[n])
+
+    def relax(self):
+        """
+        Settle the size of every instruction and pseudo-instruction, and so
+        the address of every label, then resolve symbols as resolveSymbols
+        does.
+
+        Pass one sets aside four bytes for each instruction, and room for as
+        many instructions as each pseudo-instruction might need.  Each
+        pseudo-instruction is shrunk to the shortest sequence found for its
+        operands and, with the compress option, every instruction with a
+        compressed form to two bytes.  The program is laid out again, until
+        nothing changes size.  Anything which must grow again once others
+        have moved, such as a branch whose target falls out of its reach,
+        never shrinks afterwards, so the process always settles.
+
+        The bytes saved by compression in each section are kept in
+        self.savings, by section name, and the number of instructions saved
+        by shrinking pseudo-instructions in self.relaxed.
+        """
+        prog = self.program
+        compress = bool(self.options & OPT_COMPRESS)
+        self.layout()
+        sizes = {}
+        parts = {}
+        grown = set()
+        for _ in range(maxRelaxRounds):
+            self.resolveSymbols()
+            changed = False
+            for n, words in self._sequences(compress):
+                encoded = [(w, 4) for w in words]
+                if compress and not (n in grown and prog.kind[n] in gatherers):
+                    halves = [rvc.compress(w) for w in words]
+                    encoded = [
+                        (w, 4) if h is None else (h, 2)
+                        for w, h in zip(words, halves)
+                    ]
+                size = sum(width for _, width in encoded)
+                current = sizes.get(n)
+                if current is None:
+                    current = self.pseudoSizes.get(n, 4)
+                if size > current:
+                    grown.add(n)
+                    changed = True
+                elif size < current and n not in grown:
+                    changed = True
+                else:
+                    size = current
+                sizes[n] = size
+                parts[n] = encoded
+            if not changed:
+                break
+            self.layout(sizes)
+        else:
+            raise Exception(
+                "Instruction sizes failed to settle after {} rounds".format(
+                    maxRelaxRounds
+                )
+            )
+
+        # Lay down compressed instructions as such, and pseudo-instructions
+        # as the sequences found for them, counting what was saved.
+        total = [0] * len(self.sections)
+        shrunk = [0] * len(self.sections)
+        relaxed = 0
+        section = 0
+        for n in range(len(prog)):
+            kind = prog.kind[n]
+            if kind == ir.IR_SECTION:
+                section = prog.insn[n]
+            if n not in parts:
+                continue
+            encoded = parts[n]
+            total[section] = total[section] + len(encoded)
+            shrunk[section] = shrunk[section] + sum(
+                1 for _, width in encoded if width == 2
+            )
+            if kind == ir.IR_PSEUDO:
+                padded = padInstructions(encoded, sizes[n], prog.line[n])
+                relaxed = relaxed + self.pseudoSizes[n] // 4 - len(padded)
+                self.pseudoSizes[n] = sizes[n]
+                self.pseudoParts[n] = padded
+            elif encoded[0][1] == 2:
+                prog.kind[n] = ir.IR_C
+                prog.insn[n] = encoded[0][0]
+        self.savings = dict(
+            (seg.name, 2 * k) for seg, k in zip(self.sections, shrunk)
+        )
+        self.relaxed = relaxed
+        if self.options & OPT_QUIET:
+            return
+        if compress:
+            for seg, t, k in zip(self.sections, total, shrunk):
+                if t:
+                    print("Section {}: {} of {} instructions compressed, "
+                          "{} bytes saved".format(seg.name, k, t, 2 * k))
+        if self.pseudoSizes:
+            print("Relaxation saved {} instructions".format(relaxed))
+
+    def _extractRelocations(self):
+        """
+        When assembling an object file, operands which depend on where a
+        relocatable section or an imported symbol lies cannot be encoded yet.
+        Record a relocation for each, and leave a placeholder in its place
+        which the linker will overwrite.  Branches within a section need no
+        relocation, however the section is placed.
+        """
+        prog = self.program
+        values = self.operandValues = list(self.operandValues)
+        self.relocations = [[] for _ in self.sections]
+        Relocatable = objfile.Relocatable
+        section = 0
+
+        def fail(n, what):
+            raise Exception("On line {}, {}".format(prog.line[n], what))
+
+        for n in range(len(prog)):
+            kind = prog.kind[n]
+            if kind == ir.IR_SECTION:
+                section = prog.insn[n]
+                continue
+            if kind not in relocatedFields:
+                continue
+            column, registers = relocatedFields[kind]
+            for reg in registers:
+                if isinstance(values[getattr(prog, reg)[n]], Relocatable):
+                    fail(n, "register operand must be absolute")
+            if column is None:
+                continue
+
+            i = getattr(prog, column)[n]
+            v = values[i]
+            lc = prog.lc[n]
+            seg = self.sections[section]
+            here = lc
+            if self.sectionRelocatable[section]:
+                here = Relocatable.section(seg.name, lc)
+            if kind == ir.IR_SB:
+                disp = v - here
+                if not isinstance(disp, Relocatable):
+                    values[i] = disp + lc
+                    continue
+            elif kind == ir.IR_UJ:
+                if not isinstance(here, Relocatable) and (
+                    not isinstance(v, Relocatable)
+                ):
+                    continue
+            elif not isinstance(v, Relocatable):
+                continue
+
+            target, addend = None, v
+            if isinstance(v, Relocatable):
+                target, addend = v.target(), v.const
+                if target is None:
+                    fail(n, "expression {} cannot be relocated".format(v))
+            if kind == ir.IR_DECL:
+                rkind = objfile.declarationKinds[prog.insn[n]]
+            else:
+                rkind = relocationKinds[kind]
+            self.relocations[section].append(
+                (lc - seg.base, rkind, target, addend)
+            )
+            values[i] = lc if kind == ir.IR_SB else 0
+
+    def objectFile(self):
+        """Collect the sections and symbols of an object file."""
+        obj = objfile.ObjectFile()
+        for i, seg in enumerate(self.sections):
+            s = objfile.Section(
+                seg.name,
+                None if self.sectionRelocatable[i] else seg.base,
+                seg.lc - seg.base,
+                self.sectionAlign[i],
+            )
+            s.segment = seg
+            s.relocations = self.relocations[i]
+            obj.sections.append(s)
+        for name in self.symbols:
+            v = self.values.get(name)
+            if isinstance(v, objfile.Relocatable):
+                if v.target() is None:
+                    continue
+                obj.symbols[name] = (v.target(), v.const)
+            elif v is not None:
+                obj.symbols[name] = (None, v)
+        return obj
+
+    def _checkInstructions(self, byKind):
+        """
+        Make sure every operand of the instructions about to be encoded has a
+        value.  If not, the first instruction at fault is handed to its
+        emitter, which reports the problem.
+        """
+        prog = self.program
+        values = self.operandValues
+        if None not in values:
+            return
+        bad = [
+            n for ns in byKind.values() for n in ns
+            for i in (prog.a[n], prog.b[n], prog.c[n])
+            if i != ir.NO_OPERAND and values[i] is None
+        ]
+        if bad:
+            n = min(bad)
+            emitters[prog.kind[n]](self, prog, n)
 
     def dumpSymbols(self):
         if self.options & OPT_QUIET:
             return
+        for line in self.symbolDump():
+            error(line)
+
+    def symbolDump(self):
+        """List the lines of the symbol dump, in order of value."""
         syms = []
         for i in self.symbols:
-            v = self.symbols[i].a
-            if self.symbols[i].kind == EN_INT:
+            e = self.symbols[i]
+            v = e.a
+            if e.kind == EN_LABEL:
+                v = self.values.get(i)
+            elif e.kind != EN_INT:
+                continue
+            if isinstance(v, objfile.Relocatable):
+                syms.append((i, v, str(v)))
+            elif v is not None:
                 syms.append((i, v, hex(v)))
-        syms.sort(key=lambda x: x[1])
-        for s in syms:
-            name, value, hexval = s
-            error("{} = {} ({})".format(name, value, hexval))
+        # Relocatable values have no order of their own; list them last.
+        syms.sort(key=lambda x: (
+            (1, x[2]) if isinstance(x[1], objfile.Relocatable) else (0, x[1])
+        ))
+        return [
+            "{} = {} ({})".format(name, value, hexval)
+            for name, value, hexval in syms
+        ]
 
     def parseArgs(self):
         """Parse command-line arguments and separate parameters from flags.
         """
         self._from = None
         self._to = None
+        self._cacheDir = defaultCacheDir
+        self._cacheLimit = buildcache.defaultLimit
+        self._deps = None
+        self._jobs = 1
+        self._fill = 0
+        self._exports = {}
+        self._module = None
+        self._width = 1
         self.options = 0
 
         argc = len(self.args)
@@ -1158,11 +2291,74 @@ class Assembler(object):
                     self._to = self.args[i+1]
                     i = i + 2
                     continue
+                elif self.args[i] == "jobs":
+                    self._jobs = int(self.args[i+1])
+                    i = i + 2
+                    continue
+                elif self.args[i] in ["hex", "ihex", "rom"]:
+                    self._exports[self.args[i]] = self.args[i+1]
+                    i = i + 2
+                    continue
+                elif self.args[i] == "module":
+                    self._module = self.args[i+1]
+                    i = i + 2
+                    continue
+                elif self.args[i] == "bytes":
+                    self._width = int(self.args[i+1])
+                    i = i + 2
+                    continue
+                elif self.args[i] == "fill":
+                    self._fill = int(self.args[i+1], 0)
+                    i = i + 2
+                    continue
+                elif self.args[i] == "cache":
+                    self._cacheDir = self.args[i+1]
+                    i = i + 2
+                    continue
+                elif self.args[i] == "deps":
+                    self._deps = self.args[i+1]
+                    i = i + 2
+                    continue
+                elif self.args[i] == "cachelimit":
+                    self._cacheLimit = int(self.args[i+1], 0)
+                    i = i + 2
+                    continue
             if i < argc:
                 if self.args[i] == "quiet":
                     self.options = self.options | OPT_QUIET
+                elif self.args[i] == "charlexer":
+                    self.options = self.options | OPT_CHARLEXER
+                elif self.args[i] == "nocache":
+                    self.options = self.options | OPT_NOCACHE
+                elif self.args[i] == "watch":
+                    self.options = self.options | OPT_WATCH
+                elif self.args[i] in ["swap", "byteswap"]:
+                    self.options = self.options | OPT_SWAP
+                elif self.args[i] == "sparse":
+                    self.options = self.options | OPT_SPARSE
+                elif self.args[i] == "object":
+                    self.options = self.options | OPT_OBJECT
+                elif self.args[i] == "compress":
+                    self.options = self.options | OPT_COMPRESS
+                elif self.args[i] == "relax":
+                    self.options = self.options | OPT_RELAX
+                elif self.args[i] == "peephole":
+                    # Not for code touching I/O; see Assembler.peephole.
+                    self.options = self.options | OPT_PEEPHOLE
+                elif self.args[i] == "buildcache":
+                    self.options = self.options | OPT_BUILDCACHE
+                elif self.args[i] == "redo":
+                    self.options = self.options | OPT_REDO
             i = i + 1
 
+        # Compressed instructions need only be aligned to two bytes.
+        if self.options & OPT_COMPRESS:
+            self.insnAlign = 2
+
+        # In an object file, the text section is relocatable unless given a
+        # base address.
+        self.sectionRelocatable[0] = bool(self.options & OPT_OBJECT)
+
     def pass1(self, filelike, filename):
         """Attempt to perform pass 1 assembly on the indicated file."""
         oldFileLike = self._filelike
@@ -1173,18 +2369,56 @@ class Assembler(object):
         self._filename = filename
         self.tokenStream = []
         self.cursor = 0
-        source = filelike.readlines()
-        for line in source:
-            self.pass1line(line)
+        source = filelike.read()
+        lines = None
+        if self.lexCache and not self.options & OPT_CHARLEXER:
+            try:
+                name = getattr(filelike, "name", filename)
+                lines = self.lexCache.tokens(name, source)
+            except ValueError:
+                # Malformed input; lex it again a line at a time below, so
+                # the error surfaces on the line where it occurs.
+                lines = None
+        if lines is None:
+            for line in lexcache.splitLines(source):
+                self.pass1line(line)
+        else:
+            for tokens in lines:
+                self.tokenStream = tokens
+                self.lexEOL()
         self._filelike = oldFileLike
         self._filename = oldFileName
         self.tokenStream = oldTokenStream
         self.cursor = oldCursor
 
-    def incbin(self, filename):
-        f = file(filename).read()
-        for ch in f:
-            self.recordByte(ExprNode(EN_INT, ord(ch)))
+    def depend(self, filename):
+        """Remember that the output depends on the named file."""
+        filename = os.path.abspath(filename)
+        if filename not in self.dependencies:
+            self.dependencies.append(filename)
+
+    def incbin(self, filename, offset=0, length=None):
+        """
+        Include the contents of a binary file, or length bytes of it starting
+        at offset.  The file is mapped into memory rather than read, and the
+        whole blob is recorded as a single entry in the program; pass three
+        copies it into the segment in one step.
+        """
+        self.depend(filename)
+        data = mapFile(filename)
+        size = len(data)
+        if length is None:
+            length = size - offset
+        if offset < 0 or length < 0 or offset + length > size:
+            raise Exception(
+                "On line {}, range {}+{} lies outside {} ({} bytes)".format(
+                    self.line, offset, length, filename, size
+                )
+            )
+        self._defer(ir.IR_BLOB, self.program.blob(
+            sliceOf(data, offset, length)
+        ))
+        self._grow(length)
 
     def include(self, filename):
         dirname, basename = (os.path.dirname(filename), os.path.basename(filename))
@@ -1195,9 +2429,271 @@ class Assembler(object):
         os.chdir(dirname)
         oldLine = self.line
         self.line = 0
-        self.pass1(open(basename, "r"), filename)
-        os.chdir(oldPath)
-        self.line = oldLine
+        try:
+            self.depend(basename)
+            with open(basename, "r") as f:
+                self.pass1(f, filename)
+        finally:
+            os.chdir(oldPath)
+            self.line = oldLine
+
+    def prelex(self, filename, jobs):
+        """
+        Lex the given file and everything it includes, directly or not, using
+        a pool of worker processes, and enter the results in the lexer cache.
+        Files are discovered a level of the include tree at a time, and each
+        level is lexed in parallel.  Pass one then finds every file already
+        lexed.  Parsing itself remains serial: it depends on the symbols and
+        location counter left behind by everything that came before.
+
+        :param int jobs: How many worker processes to use; zero means one per
+            processor.
+        """
+        pool = multiprocessing.Pool(jobs or None)
+        try:
+            seen = set()
+            pending = [os.path.abspath(filename)]
+            while pending:
+                ready = []
+                unlexed = []
+                for path in pending:
+                    if path in seen:
+                        continue
+                    seen.add(path)
+                    try:
+                        with open(path, "r") as f:
+                            digest = lexcache.digestOf(f.read())
+                    except IOError:
+                        continue
+                    if self.lexCache.cached(path, digest):
+                        ready.append(path)
+                    else:
+                        unlexed.append(path)
+
+                for path, digest, lines in pool.map(lexFile, unlexed):
+                    if digest is not None:
+                        self.lexCache.seed(path, digest, lines)
+                        ready.append(path)
+
+                pending = []
+                for path in ready:
+                    lines = self.lexCache.memory[path][1]
+                    pending.extend(includedFiles(path, lines))
+        finally:
+            pool.close()
+            pool.join()
+
+    def makeLexCache(self):
+        """
+        Create the cache of lexed source files.  The nocache flag forces every
+        file to be lexed again, replacing whatever the cache held for it.
+        """
+        return lexcache.LexCache(
+            tokenize, Token, lexerVersion(), self._cacheDir,
+            refresh=bool(self.options & OPT_NOCACHE)
+        )
+
+    def makeBuildCache(self):
+        """
+        Create the cache of whole builds, kept beside the lexer cache.  The
+        nocache flag forces the build to run, replacing what was cached.
+        """
+        return buildcache.BuildCache(
+            os.path.join(self._cacheDir, "builds"), self._cacheLimit,
+            refresh=bool(self.options & OPT_NOCACHE)
+        )
+
+    def buildKey(self):
+        """
+        Everything deciding the output of this invocation, besides the files
+        it reads.
+        """
+        ignored = OPT_NOCACHE | OPT_WATCH | OPT_BUILDCACHE | OPT_REDO
+        return (
+            assemblerVersion(),
+            self.options & ~ignored,
+            os.path.abspath(self._from),
+            os.path.abspath(self._to),
+            sorted(
+                (kind, os.path.abspath(filename))
+                for kind, filename in self._exports.items()
+            ),
+            self._module,
+            self._width,
+            self._fill,
+        )
+
+    def outputFiles(self):
+        """List the files this invocation writes."""
+        if self.options & OPT_OBJECT:
+            return [self._to]
+        return [self._to] + [filename for filename, _ in self.exporters()]
+
+    def restoreBuild(self):
+        """
+        Restore the outputs of this invocation from the build cache, if its
+        inputs are unchanged since they were cached.  Returns True if so.
+        """
+        key = self.buildKey()
+        entry = self.buildCache.lookup(key)
+        if entry is None:
+            return False
+        symbols = self.buildCache.restore(entry, self.outputFiles())
+        self.dependencies = self.buildCache.manifest(key)
+        sys.stderr.write(symbols)
+        if not self.options & OPT_QUIET:
+            print("Restored {} from the build cache".format(self._to))
+        return True
+
+    def reportDependencies(self):
+        """
+        Write the list of files the build read, one absolute path per line,
+        to the file named by the deps parameter.  With the redo flag, hand
+        them to redo-ifchange as well, so that redo rebuilds the image when
+        any of them changes.  Generated files must still be named to
+        redo-ifchange before assembling, so that they exist to be read.
+        """
+        if self._deps:
+            listing = "".join(name + "\n" for name in self.dependencies)
+            atomicfile.writeAtomically(self._deps, lambda f: f.write(listing.encode()))
+        if self.options & OPT_REDO:
+            subprocess.check_call(["redo-ifchange"] + self.dependencies)
+
+    def assemble(self):
+        """
+        Assemble the program, and write the resulting image.  With the build
+        cache, if nothing the image depends on has changed since it was last
+        built, it is restored from the cache instead, without assembling
+        anything.
+        """
+        if self.buildCache and self.restoreBuild():
+            self.reportDependencies()
+            return
+        parallel = self._jobs != 1 and not self.options & OPT_CHARLEXER
+        if parallel and self.lexCache:
+            self.prelex(self._from, self._jobs)
+        if self.options & OPT_RELAXING and self.options & OPT_OBJECT:
+            raise Exception(
+                "compress, relax and peephole cannot be used with object"
+            )
+        self.include(self._from)
+        if self.options & OPT_PEEPHOLE:
+            self.peephole()
+        if self.options & OPT_RELAXING:
+            self.relax()
+        else:
+            self.resolveSymbols()
+        self.pass2()
+        self.dumpSymbols()
+        self.pass3()
+
+        if self.options & OPT_OBJECT:
+            atomicfile.writeAtomically(self._to, lambda f: self.objectFile().write(f))
+        else:
+            rx = lambda f: codegen.RawExporter(f, self._fill).exportSections(
+                self.sections
+            )
+            atomicfile.writeAtomically(self._to, rx)
+            for filename, exporter in self.exporters():
+                atomicfile.writeAtomically(
+                    filename,
+                    lambda f: exporter(f).exportSections(self.sections)
+                )
+
+        if self.buildCache:
+            symbols = ""
+            if not self.options & OPT_QUIET:
+                symbols = "".join(line + "\n" for line in self.symbolDump())
+            self.buildCache.store(
+                self.buildKey(), self.dependencies, self.outputFiles(),
+                symbols
+            )
+        self.reportDependencies()
+
+    def exporters(self):
+        """
+        List the memory initialization files requested besides the raw
+        image, each paired with a function constructing its exporter given
+        the file to write.
+        """
+        width = self._width
+        swap = bool(self.options & OPT_SWAP)
+        fill = self._fill
+        found = []
+        if "hex" in self._exports:
+            sparse = bool(self.options & OPT_SPARSE)
+            found.append((self._exports["hex"], lambda f: codegen.HexExporter(
+                f, width, swap, fill, sparse
+            )))
+        if "ihex" in self._exports:
+            found.append((
+                self._exports["ihex"],
+                lambda f: codegen.IntelHexExporter(f, width, swap, fill)
+            ))
+        if "rom" in self._exports:
+            rom = self._exports["rom"]
+            name = self._module or os.path.splitext(os.path.basename(rom))[0]
+            found.append((rom, lambda f: codegen.RomExporter(
+                f, name, width, swap, fill
+            )))
+        return found
+
+    def watch(self, builds=None):
+        """
+        Assemble the program, then keep watching the files it was built from,
+        assembling it again whenever any of them changes.  The lexer cache is
+        kept resident between builds, so only changed files are lexed again.
+        Each build runs in a fresh Assembler, so no state leaks between them.
+
+        :param int builds: Stop after this many builds; by default, run until
+            interrupted.
+        """
+        cache = self.lexCache
+        count = 0
+        changed = [os.path.abspath(self._from)]
+        watched = changed
+        while True:
+            # Take signatures before building, so that a file saved while
+            # the build runs still counts as changed once it is done.
+            before = fileSignatures(watched)
+            asm = Assembler(self.args)
+            asm.parseArgs()
+            asm.lexCache = cache
+            start = time.time()
+            try:
+                asm.assemble()
+                status = "Rebuilt {}".format(self._to)
+            except Exception as e:
+                status = "Build failed: {}".format(e)
+            elapsed = time.time() - start
+            print("{} in {:.0f} ms ({} changed: {})".format(
+                status, elapsed * 1000, len(changed),
+                ", ".join(os.path.basename(f) for f in changed)
+            ))
+            sys.stdout.flush()
+
+            count = count + 1
+            if builds is not None and count >= builds:
+                return
+
+            # Files first read by this build have no earlier signature.
+            # Theirs are taken now, unless modified since the build began:
+            # they may have changed after being read, so count them changed.
+            watched = asm.dependencies or [os.path.abspath(self._from)]
+            for f, signature in fileSignatures(
+                f for f in watched if f not in before
+            ).items():
+                if signature is None or signature[0] < start:
+                    before[f] = signature
+                else:
+                    before[f] = ()
+            changed = []
+            while True:
+                after = fileSignatures(watched)
+                changed = [f for f in watched if before[f] != after[f]]
+                if changed:
+                    break
+                time.sleep(watchInterval)
 
     def main(self):
         """This implements the main user interface of Polaris.  It drives the
@@ -1207,20 +2703,23 @@ class Assembler(object):
 
         if not self.options & OPT_QUIET:
             print("This is a, the Polaris RISC-V Assembler")
-            print("Version 0.0")
+            print("Version {}".format(VERSION))
 
         if not self._from:
             error("I need a file to assemble.")
             sys.exit(1)
 
-        self.include(self._from)
-        self.pass2()
-        self.dumpSymbols()
-        self.pass3()
+        self.lexCache = self.makeLexCache()
+        if self.options & OPT_BUILDCACHE:
+            self.buildCache = self.makeBuildCache()
 
-        with open(self._to, "wb") as f:
-            rx = codegen.RawExporter(f)
-            rx.exportSegment(self.seg)
+        if self.options & OPT_WATCH:
+            try:
+                self.watch()
+            except KeyboardInterrupt:
+                pass
+        else:
+            self.assemble()
 
 # Detect if we're executed from the command-line, and if so, create a new
 # assembler instance and let it massage any passed parameters.
@@ -0,0 +1,52 @@
+"""Replacing files atomically, for the assembler, linker and build cache.
+
+Each new file is written or linked under a temporary name in the directory
+of the file it replaces, then renamed over it, so that readers only ever
+see either the old or the complete new file, and a failure leaves neither
+a partial file nor the temporary one behind.
+"""
+
+import os
+import shutil
+import tempfile
+
+
+def writeAtomically(filename, writer):
+    """
+    Create or replace a file by calling writer with a file object, such that
+    readers only ever see either the old or the complete new file.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".a-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer(f)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def linkOrCopy(source, filename):
+    """
+    Replace filename with a hard link to source or, where the file system
+    does not allow one, with a copy of it.  As with writeAtomically, readers
+    of filename only ever see either the old or the complete new file.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".a-", suffix=".tmp")
+    os.close(fd)
+    try:
+        os.unlink(tmp)
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""Micro-benchmarks for the RISC-V assembler.
+
+USAGE: bench.py <benchmark> [<filename> ...]
+
+Each benchmark reports the best of several runs, so the figures are
+comparable from one build of the assembler to the next.
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import timeit
+
+import a
+import codegen
+import ir
+
+
+def readLines(filenames):
+    lines = []
+    for name in filenames:
+        with open(name, "r") as f:
+            lines.extend(f.readlines())
+    return lines
+
+
+def best(fn, repeat=5):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def report(name, seconds, count, unit):
+    print("{:<24} {:10.3f} ms {:10.3f} us/{}".format(
+        name, seconds * 1e3, seconds * 1e6 / max(count, 1), unit
+    ))
+
+
+def benchLexer(args):
+    """Compare the line lexer against the character-at-a-time lexer."""
+    lines = readLines(args)
+
+    def charLexer():
+        asm = a.Assembler([])
+        for line in lines:
+            for c in line:
+                asm.lexChar(c)
+            asm.tokenStream = []
+
+    def lineLexer():
+        asm = a.Assembler([])
+        for line in lines:
+            asm.lexLine(line)
+            asm.tokenStream = []
+
+    report("lexer (charlexer)", best(charLexer), len(lines), "line")
+    report("lexer (line)", best(lineLexer), len(lines), "line")
+
+
+# One line of each instruction format, for benchDispatch.
+dispatchSample = [
+    "\tadd\tx1, x2, x3\n",
+    "\taddi\tx1, x2, 100\n",
+    "\tld\tx1, 8(x2)\n",
+    "\tsd\tx1, 8(x2)\n",
+    "\tbne\tx1, x2, 0\n",
+    "\tlui\tx1, $12345000\n",
+    "\tjal\tx1, 0\n",
+    "\tecall\n",
+]
+
+
+def benchDispatch(args):
+    """Measure identifier classification, and the cost of parsing and
+    recording one instruction of each format from pre-lexed tokens.
+    """
+    iterations = 1000
+    words = ["addi", "ADDI", "Addi", "sfencevm", "loop", "x1"]
+
+    def classify():
+        for _ in range(iterations):
+            for w in words:
+                a.kindOfIdentifier(w)
+
+    report("kindOfIdentifier", best(classify),
+           iterations * len(words), "identifier")
+
+    lexer = a.Assembler([])
+    sample = []
+    for line in dispatchSample:
+        for c in line:
+            lexer.lexChar(c)
+        sample.append(lexer.tokenStream)
+        lexer.tokenStream = []
+
+    def dispatch():
+        asm = a.Assembler([])
+        for _ in range(iterations):
+            for tokens in sample:
+                asm.tokenStream = list(tokens)
+                asm.lexEOL()
+            asm.program = ir.Program()
+
+    report("dispatch", best(dispatch),
+           iterations * len(sample), "instruction")
+
+
+def benchPass1(args):
+    """Time pass one over a synthetic 100,000 line listing, and report the
+    memory its deferred program occupies.
+    """
+    nLines = int(args[0]) if args else 100000
+    lines = []
+    while len(lines) < nLines:
+        lines.append("L{}:\n".format(len(lines)))
+        lines.extend(dispatchSample)
+    lines = lines[:nLines]
+
+    asm = a.Assembler([])
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = timeit.default_timer()
+    for line in lines:
+        asm.pass1line(line)
+    elapsed = timeit.default_timer() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    records = len(asm.program)
+    report("pass1", elapsed, nLines, "line")
+    print("{:<24} {:10d} records {:10.1f} bytes/record (columns)".format(
+        "program", records, asm.program.nbytes() / float(max(records, 1))
+    ))
+    print("{:<24} {:10d} KiB peak RSS growth".format("pass1 memory", rss))
+
+
+def benchPass3(args):
+    """Compare batched instruction encoding in pass three against laying
+    down each record with its scalar emitter, over a synthetic listing.
+    """
+    nLines = int(args[0]) if args else 100000
+    lines = []
+    while len(lines) < nLines:
+        lines.append("L{}:\n".format(len(lines)))
+        lines.extend(dispatchSample)
+    lines = lines[:nLines]
+
+    asm = a.Assembler([])
+    for line in ["x1 = 1\n", "x2 = 2\n", "x3 = 3\n"] + lines:
+        asm.pass1line(line)
+    asm.resolveSymbols()
+    prog = asm.program
+
+    def scalar():
+        asm.seg = asm.sections[0] = codegen.Segment()
+        for n in range(len(prog)):
+            a.emitters[prog.kind[n]](asm, prog, n)
+        return asm.seg
+
+    def batched():
+        asm.sections[0] = codegen.Segment()
+        asm.pass3()
+        return asm.seg
+
+    report("pass3 (scalar)", best(scalar), len(prog), "record")
+    report("pass3 (batched, {})".format(
+        "numpy" if codegen.numpy is not None else "pure Python"
+    ), best(batched), len(prog), "record")
+    print("images {}".format(
+        "identical" if scalar().buf == batched().buf else "DIFFER"
+    ))
+
+
+def benchParallel(args):
+    """
+    Assemble a program with serial and parallel lexing, check that both
+    produce the same image, and report the speedup.
+
+    USAGE: bench.py parallel <root.asm> [<jobs>]
+    """
+    root = args[0]
+    jobs = int(args[1]) if len(args) > 1 else multiprocessing.cpu_count()
+    tmp = tempfile.mkdtemp()
+    images = []
+    try:
+        for n in [1, jobs]:
+            output = os.path.join(tmp, "{}.bin".format(n))
+
+            def build():
+                asm = a.Assembler([
+                    "a", "from", root, "to", output, "jobs", str(n), "quiet"
+                ])
+                asm.parseArgs()
+                asm.lexCache = asm.makeLexCache()
+                asm.lexCache.directory = None
+                asm.assemble()
+
+            elapsed = best(build, repeat=3)
+            report("assemble (jobs {})".format(n), elapsed, 1, "build")
+            images.append((elapsed, open(output, "rb").read()))
+    finally:
+        shutil.rmtree(tmp)
+
+    (serial, serialImage), (parallel, parallelImage) = images
+    print("speedup {:.2f}x on {} processors, images {}".format(
+        serial / parallel, multiprocessing.cpu_count(),
+        "identical" if serialImage == parallelImage else "DIFFER"
+    ))
+
+
+class ListSegment(codegen.Segment):
+    """The original Segment backend, holding its image as a list of ints."""
+
+    def __init__(self):
+        codegen.Segment.__init__(self)
+        self.list = []
+
+    def size(self):
+        return len(self.list)
+
+    def byte(self, b):
+        b = b & 255
+        if self.lc < self.size():
+            self.list[self.lc] = b
+        elif self.lc == self.size():
+            self.list.append(b)
+        else:
+            raise Exception("Not implemented")
+        self.lc = self.lc + 1
+
+    def blob(self, data):
+        for b in bytearray(data):
+            self.byte(b)
+
+    def hword(self, h):
+        self.byte(h & 0xFF)
+        self.byte(h >> 8)
+
+    def word(self, w):
+        self.hword(w & 0xFFFF)
+        self.hword(w >> 16)
+
+    def dword(self, d):
+        self.word(d & 0xFFFFFFFF)
+        self.word(d >> 32)
+
+    def advance(self, to, fill):
+        while self.lc < to:
+            self.byte(fill)
+
+    def getByte(self, at):
+        return self.list[at]
+
+
+def benchSegment(args):
+    """Compare the list and bytearray Segment backends, laying down a mix of
+    instructions, data, padding and an included image.
+    """
+    iterations = int(args[0]) if args else 10000
+    image = bytearray(38400)
+
+    def fill(factory):
+        def run():
+            seg = factory()
+            for _ in range(iterations):
+                seg.putI(0x00000013, 1, 2, 0x123)
+                seg.word(0xDEADBEEF)
+                seg.dword(0x0123456789ABCDEF)
+                seg.hword(0x1234)
+                seg.byte(0x56)
+            seg.advance((seg.lc + 4095) & -4096, 0)
+            seg.blob(image)
+            return seg
+        return run
+
+    backends = [("list", ListSegment), ("bytearray", codegen.Segment)]
+    for name, factory in backends:
+        report("segment ({})".format(name), best(fill(factory)),
+               iterations * 5, "store")
+
+    old, new = fill(ListSegment)(), fill(codegen.Segment)()
+    print("images {}".format(
+        "identical" if bytearray(old.list) == new.buf else "DIFFER"
+    ))
+
+
+benchmarks = {
+    "dispatch": benchDispatch,
+    "parallel": benchParallel,
+    "pass1": benchPass1,
+    "pass3": benchPass3,
+    "lexer": benchLexer,
+    "segment": benchSegment,
+}
+
+
+def main(args):
+    if len(args) < 2 or args[1] not in benchmarks:
+        print(__doc__)
+        print("Benchmarks: {}".format(", ".join(sorted(benchmarks))))
+        return 1
+    benchmarks[args[1]](args[2:])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
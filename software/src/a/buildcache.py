@@ -0,0 +1,168 @@
+"""Persistent cache of whole assembler invocations."""
+
+import os
+import shutil
+import tempfile
+
+import atomicfile
+import lexcache
+
+
+# Unless told otherwise, the cache is trimmed to this many bytes of output.
+defaultLimit = 256 * 1024 * 1024
+
+
+class BuildCache(object):
+    """
+    A BuildCache remembers the files written by each invocation of the
+    assembler, together with the symbol dump it printed, so that a later
+    invocation given the same inputs can simply restore them.
+
+    An invocation is keyed by everything which decides its output besides
+    the files it reads: the assembler version, its options, and the names
+    of its root source and output files.  The files it reads are only known
+    once it has run, so for each key the cache keeps a manifest listing the
+    files the last build read, include and incbin files alike.  The digest
+    of the key and the content of those files names the entry holding the
+    outputs.  Should any of those files change, including the list of files
+    itself, which can only change if one of them does, the digest changes
+    with it.
+
+    Entries are trimmed, least recently used first, once their outputs
+    exceed the size limit.
+
+    :param str directory: Where to keep cache entries.
+    :param int limit: How many bytes of outputs to keep, at most.
+    :param bool refresh: If true, existing entries are ignored and replaced,
+        forcing every build to run again.
+    """
+
+    def __init__(self, directory, limit=defaultLimit, refresh=False):
+        self.directory = directory
+        self.limit = limit
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+        Find the entry for the build with the given key, returning its path,
+        or None if its inputs have changed or it was never cached.
+        """
+        entry = None
+        if not self.refresh:
+            digest = self._digest(key, self.manifest(key))
+            if digest is not None:
+                entry = os.path.join(self.directory, digest)
+        if entry is None or not os.path.isdir(entry):
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return entry
+
+    def restore(self, entry, outputs):
+        """
+        Restore the output files listed, in the order they were stored, from
+        a cache entry.  Returns the symbol dump stored with them.
+        """
+        for n, filename in enumerate(outputs):
+            atomicfile.linkOrCopy(os.path.join(entry, str(n)), filename)
+        with open(os.path.join(entry, "symbols"), "r") as f:
+            return f.read()
+
+    def store(self, key, dependencies, outputs, symbols):
+        """
+        Enter the output files of a build just completed, given the files it
+        read, then trim the cache to its size limit.  Failure to write to the
+        cache never fails the build.
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            digest = self._digest(key, dependencies)
+            if digest is None:
+                return
+            tmp = tempfile.mkdtemp(dir=self.directory, suffix=".tmp")
+            try:
+                for n, filename in enumerate(outputs):
+                    shutil.copyfile(filename, os.path.join(tmp, str(n)))
+                with open(os.path.join(tmp, "symbols"), "w") as f:
+                    f.write(symbols)
+                entry = os.path.join(self.directory, digest)
+                if os.path.isdir(entry):
+                    shutil.rmtree(entry)
+                os.rename(tmp, entry)
+            finally:
+                if os.path.isdir(tmp):
+                    shutil.rmtree(tmp)
+            self._writeManifest(key, dependencies)
+            self.trim(keep=entry)
+        except (IOError, OSError):
+            pass
+
+    def trim(self, keep=None):
+        """
+        Remove the least recently used entries until under the limit, except
+        for the entry named keep.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp") or not os.path.isdir(path):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(path, f))
+                for f in os.listdir(path)
+            )
+            total = total + size
+            if path != keep:
+                entries.append((os.path.getmtime(path), size, path))
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total = total - size
+
+    def manifest(self, key):
+        """
+        List the files read by the last build with the given key, or return
+        None if there was none.
+        """
+        try:
+            with open(self._manifestName(key), "r") as f:
+                return f.read().splitlines()
+        except (IOError, OSError):
+            return None
+
+    def _manifestName(self, key):
+        return os.path.join(
+            self.directory, lexcache.digestOf(repr(key)) + ".manifest"
+        )
+
+    def _writeManifest(self, key, dependencies):
+        listing = "".join(path + "\n" for path in dependencies)
+        atomicfile.writeAtomically(
+            self._manifestName(key), lambda f: f.write(listing.encode())
+        )
+
+    def _digest(self, key, dependencies):
+        """
+        Digest the key and the content of every file listed, or return None
+        if there is no list, or a file cannot be read.
+        """
+        if dependencies is None:
+            return None
+        parts = [repr(key)]
+        for path in dependencies:
+            try:
+                with open(path, "rb") as f:
+                    parts.append(path + "=" + lexcache.digestOf(f.read()))
+            except (IOError, OSError):
+                return None
+        return lexcache.digestOf("\n".join(parts))
@@ -3,6 +3,15 @@
 from __future__ import print_function
 
 import abc
+import binascii
+import bisect
+import struct
+
+# NumPy, where available, encodes batches of instructions in bulk.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class CGFileLike(object):
@@ -44,67 +53,442 @@ class RawExporter(object):
     image.
     """
 
-    def __init__(self, f):
+    def __init__(self, f, fill=0):
 #       assert(isinstance(f, CGFileLike))
         self._out = f
+        self._fill = bytearray([fill & 0xFF]) * 65536
 
     def exportSegment(self, seg):
         """
         Attempts to write the contents of the provided segment to the file
-        provided during construction of this object.
+        provided during construction of this object.  Holes in the segment
+        are written out as runs of the fill byte.
+        """
+        self.exportSections([seg])
+
+    def exportSections(self, segs):
+        """
+        Write several segments as a single image beginning at address zero,
+        each at its own base address.  Holes within and between them are
+        written out as runs of the fill byte.
         """
-        self._out.write(bytearray(seg.buf))
+        at = 0
+        for start, run in sectionRuns(segs):
+            while at < start:
+                n = min(start - at, len(self._fill))
+                self._out.write(self._fill[:n])
+                at = at + n
+            self._out.write(run)
+            at = start + len(run)
+
+
+def sectionRuns(segs):
+    """
+    List the stored parts of several segments together, in address order, as
+    (address, bytearray) pairs.  Segments may interleave, but must not
+    overlap.
+    """
+    runs = []
+    for seg in segs:
+        runs.extend((start, run, seg.name) for start, run in seg.runs())
+    runs.sort(key=lambda r: r[0])
+    for (s1, r1, n1), (s2, r2, n2) in zip(runs, runs[1:]):
+        if s1 + len(r1) > s2:
+            raise Exception("Sections {} and {} overlap at {:#x}".format(
+                n1, n2, s2
+            ))
+    return [(start, run) for start, run, _ in runs]
+
+
+def image(segs, fill=0):
+    """
+    Flatten several segments into a single bytearray, beginning at address
+    zero.  Holes within and between them take the fill byte.
+    """
+    runs = sectionRuns(segs)
+    if not runs:
+        return bytearray()
+    start, run = runs[-1]
+    data = bytearray([fill & 0xFF]) * (start + len(run))
+    for start, run in runs:
+        data[start:start + len(run)] = run
+    return data
+
+
+def extents(segs, width=1, fill=0):
+    """
+    List the stored parts of several segments, as (address, bytearray)
+    pairs, widened to whole words of the given width in bytes.  Parts which
+    touch or share a word are joined; bytes added to complete a word take the
+    fill byte.
+    """
+    runs = sectionRuns(segs)
+    bounds = []
+    for start, run in runs:
+        s = start - start % width
+        e = start + len(run)
+        e = e + (-e) % width
+        if bounds and bounds[-1][1] >= s:
+            bounds[-1][1] = max(bounds[-1][1], e)
+        else:
+            bounds.append([s, e])
+
+    result = []
+    i = 0
+    for s, e in bounds:
+        data = bytearray([fill & 0xFF]) * (e - s)
+        while i < len(runs) and runs[i][0] < e:
+            start, run = runs[i]
+            data[start - s:start - s + len(run)] = run
+            i = i + 1
+        result.append((s, data))
+    return result
+
+
+def swapped(data, width):
+    """
+    Reverse the order of bytes within each word of the given width.  A short
+    word at the end is reversed too.
+    """
+    if width < 2:
+        return data
+    out = bytearray(len(data))
+    n = len(data) - len(data) % width
+    for k in range(width):
+        out[k:n:width] = data[width - 1 - k:n:width]
+    out[n:] = data[n:][::-1]
+    return out
+
+
+def hexWords(data, width):
+    """Format data as upper-case hexadecimal, one string per word."""
+    digits = binascii.hexlify(bytes(data)).decode("ascii").upper()
+    step = 2 * width
+    return [digits[i:i + step] for i in range(0, len(digits), step)]
+
+
+class HexExporter(object):
+    """
+    This class writes the contents of segments as a hex file, as read by
+    Verilog's $readmemh, with one word per line.  The bytes of each word
+    appear in address order unless swap is given.
+
+    By default the image is written in full from address zero, with holes
+    taking the fill byte.  If sparse is true, holes are skipped instead, and
+    each stored part of the image begins with an @address line giving its
+    word address.
+    """
+
+    def __init__(self, f, width=1, swap=False, fill=0, sparse=False):
+        self._out = f
+        self._width = width
+        self._swap = swap
+        self._fill = fill
+        self._sparse = sparse
+
+    def exportSegment(self, seg):
+        self.exportSections([seg])
+
+    def exportSections(self, segs):
+        if self._sparse:
+            parts = extents(segs, self._width, self._fill)
+        else:
+            parts = [(0, image(segs, self._fill))]
+        lines = []
+        for start, data in parts:
+            if self._sparse:
+                lines.append("@{:X}".format(start // self._width))
+            if self._swap:
+                data = swapped(data, self._width)
+            lines.extend(hexWords(data, self._width))
+        if lines:
+            self._out.write("\n".join(lines) + "\n")
+
+
+class IntelHexExporter(object):
+    """
+    This class writes the contents of segments as an Intel HEX file.  Only
+    the stored parts of the image are written; holes are skipped.  Extended
+    linear address records are emitted as needed to reach beyond 64KiB.  If
+    swap is given, the bytes within each word of the given width are
+    reversed first.
+    """
+
+    def __init__(self, f, width=1, swap=False, fill=0, recordSize=16):
+        self._out = f
+        self._width = width
+        self._swap = swap
+        self._fill = fill
+        self._recordSize = recordSize
+
+    def exportSegment(self, seg):
+        self.exportSections([seg])
+
+    def exportSections(self, segs):
+        lines = []
+        upper = 0
+        for start, data in extents(segs, self._width, self._fill):
+            if self._swap:
+                data = swapped(data, self._width)
+            offset = 0
+            while offset < len(data):
+                address = start + offset
+                if address >> 16 != upper:
+                    upper = address >> 16
+                    lines.append(_ihexRecord(
+                        0, 4, bytearray(struct.pack(">H", upper & 0xFFFF))
+                    ))
+                n = min(self._recordSize, len(data) - offset,
+                        0x10000 - (address & 0xFFFF))
+                lines.append(_ihexRecord(
+                    address & 0xFFFF, 0, data[offset:offset + n]
+                ))
+                offset = offset + n
+        lines.append(_ihexRecord(0, 1, bytearray()))
+        self._out.write("\n".join(lines) + "\n")
+
+
+def _ihexRecord(address, kind, data):
+    header = bytearray([len(data), address >> 8, address & 0xFF, kind])
+    checksum = -(sum(header) + sum(data)) & 0xFF
+    return ":" + "".join(hexWords(header + data + bytearray([checksum]), 1))
+
+
+class RomExporter(object):
+    """
+    This class writes the contents of segments as a synthesizable Verilog
+    module, which returns one word of the image per address from a case
+    statement.  The image is written in full from address zero, with holes
+    taking the fill byte.  The module's interface is that produced by
+    bin2v's module mode.
+    """
+
+    def __init__(self, f, name, width=1, swap=False, fill=0):
+        self._out = f
+        self._name = name
+        self._width = width
+        self._swap = swap
+        self._fill = fill
+
+    def exportSegment(self, seg):
+        self.exportSections([seg])
+
+    def exportSections(self, segs):
+        data = image(segs, self._fill)
+        if self._swap:
+            data = swapped(data, self._width)
+        words = hexWords(data, self._width)
+
+        dataWidth = 8 * self._width
+        highAddressBit = (len(data) - 1).bit_length() - 1
+        lowAddressBit = self._width.bit_length() - 1
+        addressWidth = highAddressBit - lowAddressBit + 1
+
+        out = [_romHeader % (
+            self._name, highAddressBit, lowAddressBit,
+            dataWidth - 1, dataWidth - 1
+        )]
+        arm = "\t\t%d'd%%d: dat_o = %d'h%%s;\n" % (addressWidth, dataWidth)
+        out.extend(arm % pair for pair in enumerate(words))
+        out.append(_romFooter)
+        self._out.write("".join(out))
+
+
+_romHeader = """`timescale 1ns / 1ps
+
+module %s(
+\tinput\t[%d:%d]\tadr_i,
+\tinput\t\tstb_i,
+\toutput\t\tack_o,
+\toutput\t[%d:0]\tdat_o
+);
+\treg\t[%d:0]\tdat_o;
+\tassign ack_o = stb_i;
+\talways @(*) begin
+\t\tcase(adr_i)
+"""
+
+_romFooter = """\t\tendcase
+\tend
+endmodule
+"""
 
 
 class Segment(object):
-    """A segment contains assembled code and/or data."""
+    """
+    A segment contains assembled code and/or data.  A program may consist of
+    several segments, or sections, each with its own name, base address and
+    location counter.
+
+    The image is kept as one or more runs of bytes, each a bytearray starting
+    at some address.  Writing anywhere in the segment is allowed, including
+    past its current end; whatever lies between the old end and the newly
+    written bytes remains a hole, taking no storage, and reads as zero.
+    """
 
-    def __init__(self):
-        self.lc = 0
-        self.buf = []
+    def __init__(self, name="text", base=0):
+        self.name = name
+        self.base = base
+        self.lc = base
+        self._starts = []
+        self._runs = []
+        self._cur = -1
+
+    def _reserve(self, n):
+        """
+        Find room for n bytes at the location counter, returning the run to
+        write them into and their offset within it.  Runs grow as needed, and
+        runs which the new bytes would touch are merged into one.
+        """
+        at = self.lc
+        i = self._cur
+        if i >= 0:
+            run = self._runs[i]
+            off = at - self._starts[i]
+            if 0 <= off and off + n <= len(run):
+                return run, off
+            if 0 <= off <= len(run) and (
+                i + 1 == len(self._starts) or at + n < self._starts[i + 1]
+            ):
+                run.extend(bytearray(off + n - len(run)))
+                return run, off
+        return self._merge(at, n)
+
+    def _merge(self, at, n):
+        starts = self._starts
+        runs = self._runs
+        first = bisect.bisect_right(starts, at) - 1
+        if first < 0 or starts[first] + len(runs[first]) < at:
+            first = first + 1
+        last = bisect.bisect_right(starts, at + n) - 1
+
+        if first == last and starts[first] <= at and (
+            at + n <= starts[first] + len(runs[first])
+        ):
+            self._cur = first
+            return runs[first], at - starts[first]
+
+        if first > last:
+            starts.insert(first, at)
+            runs.insert(first, bytearray(n))
+            self._cur = first
+            return runs[first], 0
+
+        base = min(starts[first], at)
+        merged = bytearray()
+        for j in range(first, last + 1):
+            gap = starts[j] - (base + len(merged))
+            if gap > 0:
+                merged.extend(bytearray(gap))
+            merged.extend(runs[j])
+        short = at + n - (base + len(merged))
+        if short > 0:
+            merged.extend(bytearray(short))
+        starts[first:last + 1] = [base]
+        runs[first:last + 1] = [merged]
+        self._cur = first
+        return merged, at - base
+
+    def runs(self):
+        """
+        List the stored parts of the segment in address order, as
+        (address, bytearray) pairs.  Holes lie between them.
+        """
+        return list(zip(self._starts, self._runs))
 
     def size(self):
-        """The number of bytes comprising the code segment."""
-        return len(self.buf)
+        """The number of bytes comprising the code segment, holes included."""
+        if not self._runs:
+            return 0
+        return self._starts[-1] + len(self._runs[-1])
+
+    @property
+    def buf(self):
+        """The whole image as a single bytearray, holes filled with zeros."""
+        image = bytearray(self.size())
+        for start, run in self.runs():
+            image[start:start + len(run)] = run
+        return image
 
     def byte(self, b):
         """Lay down a single 8-bit integer."""
-        b = b & 255
-        if self.lc < self.size():
-            self.buf[self.lc] = b
-        elif self.lc == self.size():
-            self.buf.append(b)
-        else:  # self.lc > self.size()
-            raise Exception("Not implemented")
-
+        run, off = self._reserve(1)
+        run[off] = b & 0xFF
         self.lc = self.lc + 1
 
+    def blob(self, data):
+        """Lay down a block of bytes, taken from any object with the buffer
+        interface, in a single operation."""
+        n = len(data)
+        run, off = self._reserve(n)
+        run[off:off + n] = data
+        self.lc = self.lc + n
+
     def hword(self, h):
         """Lay down a single 16-bit integer."""
-        self.byte(h & 0xFF)
-        self.byte(h >> 8)
+        run, off = self._reserve(2)
+        struct.pack_into("<H", run, off, h & 0xFFFF)
+        self.lc = self.lc + 2
 
     def word(self, w):
         """Lay down a single 32-bit integer."""
-        self.hword(w & 0xFFFF)
-        self.hword(w >> 16)
+        run, off = self._reserve(4)
+        struct.pack_into("<I", run, off, w & 0xFFFFFFFF)
+        self.lc = self.lc + 4
 
     def dword(self, d):
         """Lay down a single 64-bit integer."""
-        self.word(d & 0xFFFFFFFF)
-        self.word(d >> 32)
+        run, off = self._reserve(8)
+        struct.pack_into("<Q", run, off, d & 0xFFFFFFFFFFFFFFFF)
+        self.lc = self.lc + 8
 
     def advance(self, to, fill):
         """
         Advance the location counter to the desired address.  Fill in bytes
         as required with the given fill value.
         """
-        while self.lc < to:
-            self.byte(fill)
+        n = to - self.lc
+        if n <= 0:
+            return
+        run, off = self._reserve(n)
+        run[off:off + n] = bytearray([fill & 0xFF]) * n
+        self.lc = to
+
+    def putWords(self, at, words):
+        """
+        Store a sequence of 32-bit words, as returned by the encode*
+        functions, starting at the given address.  The location counter is
+        left unchanged.
+        """
+        if numpy is not None and isinstance(words, numpy.ndarray):
+            data = words.astype("<u4").tobytes()
+        else:
+            data = struct.pack("<{}I".format(len(words)), *words)
+        lc = self.lc
+        self.lc = at
+        try:
+            self.blob(data)
+        finally:
+            self.lc = lc
+
+    def skip(self, to):
+        """
+        Advance the location counter to the desired address, leaving the
+        bytes passed over as a hole.
+        """
+        if to > self.lc:
+            self.lc = to
 
     def getByte(self, at):
         """Retrieves a single byte from the segment."""
-        return self.buf[at]
+        i = bisect.bisect_right(self._starts, at) - 1
+        if i >= 0:
+            off = at - self._starts[i]
+            if off < len(self._runs[i]):
+                return self._runs[i][off]
+        if at >= self.size():
+            raise IndexError("address {} lies past the end".format(at))
+        return 0
 
     def getHWord(self, at):
         """Retrieve a 16-bit word at a given address within the segment."""
@@ -220,3 +604,197 @@ def _toUJ(i, rd, imm21):
 def _toU(i, rd, imm20):
     i = i & ~rdMask & ~imm20Mask
     return i | (rd << 7) | (imm20 & imm20Mask)
+
+
+def _encodeBatch(encoder, fields):
+    if numpy is not None:
+        try:
+            arrays = [numpy.asarray(f, dtype=numpy.int64) for f in fields]
+        except OverflowError:
+            pass
+        else:
+            # The encoders work element by element on arrays as they do on
+            # integers.  Bits shifted beyond 64 are lost, but only the low 32
+            # bits are kept in any case.
+            return (encoder(*arrays) & 0xFFFFFFFF).astype(numpy.uint32)
+    return [w & 0xFFFFFFFF for w in map(encoder, *fields)]
+
+
+def encodeR(i, rd, rs1, rs2):
+    """
+    Encode a batch of R-format instructions at once.  Each argument is a
+    sequence, holding one field of every instruction in the batch, as passed
+    to Segment.putR.  The 32-bit instruction words are returned in a
+    sequence suitable for scatter and Segment.putWords.
+    """
+    return _encodeBatch(_toR, (i, rd, rs1, rs2))
+
+
+def encodeS(i, rs, rb, ofs):
+    """Encode a batch of S-format instructions; see encodeR."""
+    return _encodeBatch(_toS, (i, rs, rb, ofs))
+
+
+def encodeSB(i, r1, r2, ofs):
+    """Encode a batch of SB-format instructions; see encodeR."""
+    return _encodeBatch(_toSB, (i, r1, r2, ofs))
+
+
+def encodeI(i, rd, rs1, imm12):
+    """Encode a batch of I-format instructions; see encodeR."""
+    return _encodeBatch(_toI, (i, rd, rs1, imm12))
+
+
+def encodeUJ(i, rd, imm21):
+    """Encode a batch of UJ-format instructions; see encodeR."""
+    return _encodeBatch(_toUJ, (i, rd, imm21))
+
+
+def encodeU(i, rd, imm20):
+    """Encode a batch of U-format instructions; see encodeR."""
+    return _encodeBatch(_toU, (i, rd, imm20))
+
+
+def wordArray(n):
+    """Create a zeroed array of n instruction words, for scatter."""
+    if numpy is not None:
+        return numpy.zeros(n, dtype=numpy.uint32)
+    return [0] * n
+
+
+def scatter(words, positions, encoded):
+    """Store each encoded word in words, at the matching position."""
+    if numpy is not None and isinstance(encoded, numpy.ndarray):
+        words[numpy.asarray(positions, dtype=numpy.intp)] = encoded
+        return
+    for p, w in zip(positions, encoded):
+        words[p] = w
+
+
+# Instruction templates used by the pseudo-instruction sequences below.
+_LUI = 0x00000037
+_AUIPC = 0x00000017
+_ADDI = 0x00000013
+_ADDIW = 0x0000001B
+_SLLI = 0x00001013
+_SRLI = 0x00005013
+_JAL = 0x0000006F
+_JALR = 0x00000067
+
+
+def _signed(v, bits=64):
+    v = v & ((1 << bits) - 1)
+    return v - (1 << bits) if v >> (bits - 1) else v
+
+
+def _hiLo(v):
+    """
+    Split v into an upper part for LUI or AUIPC and a signed 12-bit lower
+    part, which together sum to v.
+    """
+    lo = _signed(v, 12)
+    return v - lo, lo
+
+
+def _fits(v, bits):
+    return -(1 << (bits - 1)) <= v < (1 << (bits - 1))
+
+
+def _immediateSteps(v, memo):
+    """
+    The shortest sequence found of (template, from x0, immediate) steps
+    which build the signed 64-bit value v in a register.
+    """
+    if v in memo:
+        return memo[v]
+    if _fits(v, 12):
+        steps = [(_ADDI, True, v)]
+    elif _fits(v, 32):
+        hi, lo = _hiLo(v)
+        steps = [(_LUI, True, hi)] + ([(_ADDIW, False, lo)] if lo else [])
+    else:
+        # Build the upper bits, shift them into place, and add the lower
+        # twelve; or shift away trailing or leading zeros.
+        hi, lo = _hiLo(v)
+        hi = hi >> 12
+        shift = 12
+        while not hi & 1:
+            hi, shift = hi >> 1, shift + 1
+        candidates = [
+            _immediateSteps(hi, memo) + [(_SLLI, False, shift)] +
+            ([(_ADDI, False, lo)] if lo else [])
+        ]
+        if not v & 1:
+            zeros = (v & -v).bit_length() - 1
+            candidates.append(
+                _immediateSteps(v >> zeros, memo) + [(_SLLI, False, zeros)]
+            )
+        if v > 0:
+            zeros = 64 - v.bit_length()
+            candidates.append(
+                _immediateSteps(_signed(v << zeros), memo) +
+                [(_SRLI, False, zeros)]
+            )
+        steps = min(candidates, key=len)
+    memo[v] = steps
+    return steps
+
+
+def _encodeSteps(rd, steps):
+    words = []
+    for template, fromZero, imm in steps:
+        opcode = template & 0x7F
+        if opcode in (_LUI, _AUIPC):
+            w = _toU(template, rd, imm)
+        elif opcode == _JAL:
+            w = _toUJ(template, rd, imm)
+        else:
+            w = _toI(template, rd, 0 if fromZero else rd, imm & 0xFFF)
+        words.append(w & 0xFFFFFFFF)
+    return words
+
+
+def loadImmediate(rd, value):
+    """
+    The shortest sequence of instruction words found which loads the 64-bit
+    value into register rd, as for the li pseudo-instruction.
+    """
+    return _encodeSteps(rd, _immediateSteps(_signed(value), {}))
+
+
+def _pcRelativeSteps(offset):
+    """AUIPC and ADDI steps adding offset to the PC, or None if too far."""
+    hi, lo = _hiLo(offset)
+    if not _fits(hi, 32):
+        return None
+    return [(_AUIPC, True, hi)] + ([(_ADDI, False, lo)] if lo else [])
+
+
+def loadAddress(rd, address, pc):
+    """
+    The shortest sequence of instruction words found which loads address into
+    register rd, for the la pseudo-instruction at pc: either the address
+    itself, or its offset from pc.  Ties favour the offset.
+    """
+    absolute = _immediateSteps(_signed(address), {})
+    relative = _pcRelativeSteps(_signed(address - pc))
+    if relative is not None and len(relative) <= len(absolute):
+        return _encodeSteps(rd, relative)
+    return _encodeSteps(rd, absolute)
+
+
+def callSequence(target, pc):
+    """
+    The shortest sequence of instruction words found which calls target,
+    leaving the return address in x1, for the call pseudo-instruction at pc.
+    """
+    offset = _signed(target - pc)
+    if _fits(offset, 21):
+        return _encodeSteps(1, [(_JAL, False, offset)])
+    hi, lo = _hiLo(offset)
+    if _fits(hi, 32):
+        return _encodeSteps(1, [(_AUIPC, True, hi), (_JALR, False, lo)])
+    hi, lo = _hiLo(_signed(target))
+    return _encodeSteps(
+        1, _immediateSteps(hi, {}) + [(_JALR, False, lo)]
+    )
@@ -0,0 +1,104 @@
+"""Intermediate representation of a program awaiting code generation."""
+
+from array import array
+
+
+# Kinds of record held in a Program.
+#
+# IR_DECL lays down a declared constant; its size in bytes is kept in the insn
+# column.  IR_ADVANCE moves the location counter forward to an absolute target
+# address, filling the gap.  IR_ALIGN pads with zeros up to the boundary kept
+# in the insn column.  IR_BLOB lays down a block of bytes included verbatim;
+# the insn column holds its index in the Program's blobs list.  IR_SECTION
+# directs the records which follow into the section numbered in the insn
+# column.  IR_LABEL marks where a label stands while its address may yet
+# change; it lays down nothing.  IR_C lays down the compressed instruction
+# held in the insn column.  IR_PSEUDO lays down the instructions a
+# pseudo-instruction stands for; the insn column says which one it is.
+# IR_DELETED stands where the peephole pass removed an instruction, and lays
+# down nothing.
+#
+# The remaining kinds correspond to RISC-V instruction formats, and are
+# encoded by the matching codegen.Segment.put* method.
+IR_DECL = 1
+IR_ADVANCE = 2
+IR_ALIGN = 3
+IR_R = 4
+IR_I = 5
+IR_IM = 6
+IR_S = 7
+IR_SB = 8
+IR_U = 9
+IR_UJ = 10
+IR_BLOB = 11
+IR_SECTION = 12
+IR_LABEL = 13
+IR_C = 14
+IR_PSEUDO = 15
+IR_DELETED = 16
+
+# Operand columns hold this value when a record lacks that operand.
+NO_OPERAND = -1
+
+
+class Program(object):
+    """
+    A Program holds the deferred work produced by pass one, in source order.
+    Rather than keeping one object per record, each field lives in its own
+    typed array, and record n is the n-th element of every column.
+
+    Operands are expressions, which are kept once in the exprs list; the a, b
+    and c columns hold indices into that list.  Blocks of binary data are
+    kept likewise in the blobs list, usually as views of a mapped file.
+    """
+
+    def __init__(self):
+        self.kind = array('B')
+        self.insn = array('L')
+        self.lc = array('l')
+        self.line = array('l')
+        self.a = array('l')
+        self.b = array('l')
+        self.c = array('l')
+        self.exprs = []
+        self.blobs = []
+
+    def __len__(self):
+        return len(self.kind)
+
+    def expr(self, e):
+        """Add an operand expression, returning its index."""
+        if e is None:
+            return NO_OPERAND
+        self.exprs.append(e)
+        return len(self.exprs) - 1
+
+    def blob(self, data):
+        """Add a block of binary data, returning its index."""
+        self.blobs.append(data)
+        return len(self.blobs) - 1
+
+    def append(self, kind, insn, lc, line, a=None, b=None, c=None):
+        """Append a single record to the program."""
+        self.kind.append(kind)
+        self.insn.append(insn)
+        self.lc.append(lc)
+        self.line.append(line)
+        self.a.append(self.expr(a))
+        self.b.append(self.expr(b))
+        self.c.append(self.expr(c))
+
+    def operands(self, n):
+        """Retrieve the operand expressions of record n, None where absent."""
+        exprs = self.exprs
+        return tuple(
+            exprs[i] if i != NO_OPERAND else None
+            for i in (self.a[n], self.b[n], self.c[n])
+        )
+
+    def nbytes(self):
+        """The number of bytes occupied by the record columns."""
+        columns = [
+            self.kind, self.insn, self.lc, self.line, self.a, self.b, self.c
+        ]
+        return sum(col.itemsize * len(col) for col in columns)
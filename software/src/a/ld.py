@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""Linker for object files produced by the Polaris RISC-V assembler.
+
+USAGE: ld <object> ... to <image> [at <section> <address>] ... [fill <n>]
+
+Relocatable sections of the same name are laid out one after another, in
+the order their objects are given, each aligned as its module requires.
+Sections are placed in order of first appearance, text first; each begins
+where the previous one ends, unless an address is given for it with at.
+Sections with a fixed base stay where they are.  The image is written as a
+plain binary from address zero, as the assembler would write it.
+"""
+
+from __future__ import print_function
+
+import sys
+
+import atomicfile
+import codegen
+import objfile
+
+
+def error(msg):
+    sys.stderr.write(msg + "\n")
+
+
+class Linker(object):
+    """The Linker combines object files into a single image."""
+
+    def __init__(self, args):
+        self.args = args
+        self.objects = []
+        self.placement = {}
+
+    def parseArgs(self):
+        self._from = []
+        self._to = "a.out"
+        self._at = {}
+        self._fill = 0
+
+        argc = len(self.args)
+        i = 1
+        while i < argc:
+            if self.args[i] == "to" and (i + 1) < argc:
+                self._to = self.args[i+1]
+                i = i + 2
+                continue
+            if self.args[i] == "fill" and (i + 1) < argc:
+                self._fill = int(self.args[i+1], 0)
+                i = i + 2
+                continue
+            if self.args[i] == "at" and (i + 2) < argc:
+                self._at[self.args[i+1]] = int(self.args[i+2], 0)
+                i = i + 3
+                continue
+            self._from.append(self.args[i])
+            i = i + 1
+
+    def load(self, filename):
+        """Read an object file, and add it to those being linked."""
+        with open(filename, "rb") as f:
+            self.objects.append(objfile.ObjectFile.read(f, filename))
+
+    def layout(self):
+        """Decide the address of every section of every object."""
+        order = []
+        for obj in self.objects:
+            for s in obj.sections:
+                if s.base is None and s.name not in order:
+                    order.append(s.name)
+        if "text" in order:
+            order.remove("text")
+            order.insert(0, "text")
+
+        address = 0
+        for name in order:
+            address = self._at.get(name, address)
+            for n, obj in enumerate(self.objects):
+                s = obj.section(name)
+                if s is None or s.base is not None:
+                    continue
+                address = (address + s.align - 1) & -s.align
+                self.placement[n, name] = address
+                address = address + s.size
+
+        for n, obj in enumerate(self.objects):
+            for s in obj.sections:
+                if s.base is not None:
+                    self.placement[n, s.name] = s.base
+
+    def address(self, n, target, seen=()):
+        """
+        The address of a relocation or symbol target, as seen from object n.
+        Symbols must be defined by exactly one object.
+        """
+        if target is None:
+            return 0
+        kind, name = target
+        if kind == "section":
+            return self.placement[n, name]
+        if name in seen:
+            raise Exception("Circular definition of {}".format(name))
+        found = [
+            (m, obj.symbols[name]) for m, obj in enumerate(self.objects)
+            if name in obj.symbols
+        ]
+        if not found:
+            raise Exception("Undefined symbol {}".format(name))
+        if len(found) > 1:
+            raise Exception("Symbol {} is defined by more than one object"
+                            .format(name))
+        m, (t, value) = found[0]
+        return self.address(m, t, seen + (name,)) + value
+
+    def link(self):
+        """
+        Place the contents of every section, apply relocations, and return
+        the resulting segments.
+        """
+        self.layout()
+        segs = []
+        for n, obj in enumerate(self.objects):
+            for s in obj.sections:
+                at = self.placement[n, s.name]
+                seg = codegen.Segment(s.name, at)
+                origin = s.segment.base
+                for start, run in s.segment.runs():
+                    seg.lc = at + start - origin
+                    seg.blob(run)
+                for offset, kind, target, addend in s.relocations:
+                    p = at + offset
+                    value = objfile.relocationValue(
+                        kind, self.address(n, target), addend, p
+                    )
+                    objfile.applyRelocation(seg, p, kind, value)
+                segs.append(seg)
+        return segs
+
+    def main(self):
+        self.parseArgs()
+        if not self._from:
+            error(__doc__)
+            return 1
+        for filename in self._from:
+            self.load(filename)
+        segs = self.link()
+        atomicfile.writeAtomically(
+            self._to,
+            lambda f: codegen.RawExporter(f, self._fill).exportSections(segs)
+        )
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Linker(sys.argv).main())
@@ -0,0 +1,154 @@
+"""Persistent cache of lexed source files for the RISC-V assembler."""
+
+import hashlib
+import os
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def digestOf(data):
+    """The content hash used to validate cache entries."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def splitLines(source):
+    """Split source text into lines exactly as file.readlines() would."""
+    lines = [l + "\n" for l in source.split("\n")]
+    last = lines.pop()[:-1]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def asTuples(lines):
+    """Convert lexed lines to plain tuples, for storage or transmission."""
+    return [[(t.tokenType, t.tokenValue, t.string) for t in l] for l in lines]
+
+
+class LexCache(object):
+    """
+    A LexCache remembers the token stream of every source file it lexes,
+    keyed by the file's absolute path, a hash of its content, and a version
+    string identifying the lexer.  A file is only lexed again when its content
+    changes; timestamps play no part in deciding whether an entry is valid.
+
+    Entries are kept in memory for the lifetime of the cache.  If a directory
+    is given, entries are also written there, one file per source path, so
+    that later invocations of the assembler may reuse them.
+
+    :param function lexer: Called with a single line of source, returns the
+        list of tokens for that line.
+    :param function factory: Called with the tokenType, tokenValue and string
+        fields of a token read back from disk, to construct the token again.
+    :param str version: Identifies the lexer and its token numbering.
+    :param str directory: Where to keep cache entries on disk, if anywhere.
+    :param bool refresh: If true, existing entries on disk are ignored and
+        replaced, forcing every file to be lexed again.
+    """
+
+    def __init__(self, lexer, factory, version, directory=None,
+                 refresh=False):
+        self.lexer = lexer
+        self.factory = factory
+        self.version = version
+        self.directory = directory
+        self.refresh = refresh
+        self.memory = {}
+        self.hits = 0
+        self.misses = 0
+
+    def tokens(self, path, source):
+        """
+        Retrieve the lexed form of the source text read from path, as a list
+        holding one list of tokens per line.
+        """
+        path = os.path.abspath(path)
+        digest = digestOf(source)
+
+        entry = self.memory.get(path)
+        if entry and entry[0] == digest:
+            self.hits = self.hits + 1
+            return entry[1]
+
+        lines = self._load(path, digest)
+        if lines is None:
+            self.misses = self.misses + 1
+            lines = [self.lexer(l) for l in splitLines(source)]
+            self._store(path, digest, asTuples(lines))
+        else:
+            self.hits = self.hits + 1
+            factory = self.factory
+            lines = [[factory(*t) for t in l] for l in lines]
+
+        self.memory[path] = (digest, lines)
+        return lines
+
+    def cached(self, path, digest):
+        """True if the cache already holds the lexed form of this content."""
+        path = os.path.abspath(path)
+        entry = self.memory.get(path)
+        if entry and entry[0] == digest:
+            return True
+        lines = self._load(path, digest)
+        if lines is None:
+            return False
+        factory = self.factory
+        lines = [[factory(*t) for t in l] for l in lines]
+        self.memory[path] = (digest, lines)
+        return True
+
+    def seed(self, path, digest, lines):
+        """
+        Enter the lexed form of a file produced elsewhere, for example by a
+        worker process.  Tokens are given as (tokenType, tokenValue, string)
+        tuples, one list per line.
+        """
+        path = os.path.abspath(path)
+        self._store(path, digest, lines)
+        factory = self.factory
+        lines = [[factory(*t) for t in l] for l in lines]
+        self.memory[path] = (digest, lines)
+
+    def _entryName(self, path):
+        return os.path.join(
+            self.directory, digestOf(path) + ".lex"
+        )
+
+    def _load(self, path, digest):
+        if not self.directory or self.refresh:
+            return None
+        try:
+            with open(self._entryName(path), "rb") as f:
+                entry = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if entry.get("version") != self.version:
+            return None
+        if entry.get("path") != path or entry.get("digest") != digest:
+            return None
+        return entry["lines"]
+
+    def _store(self, path, digest, lines):
+        if not self.directory:
+            return
+        entry = {
+            "version": self.version,
+            "path": path,
+            "digest": digest,
+            "lines": lines,
+        }
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self._entryName(path))
+        except (IOError, OSError):
+            # The cache is an optimization only; failing to write an entry
+            # must never fail the build.
+            pass
@@ -0,0 +1,312 @@
+"""Relocatable object files, shared by the assembler and the linker.
+
+An object file holds the sections of a separately assembled module, the
+symbols it defines, and the relocations needed to fix up its references to
+symbols and sections whose addresses are only known once it is linked.  It
+is stored as JSON, with the contents of each section encoded in base64.
+"""
+
+import base64
+import json
+
+import codegen
+
+
+FORMAT = "polaris-object"
+FORMAT_VERSION = 1
+
+# Kinds of relocation.  With S the address of the relocation's target, A its
+# addend and P the address of the field being fixed up, the value placed in
+# the field is S+A for the absolute kinds, S+A-P for SB, and
+# ((S+A) & $3FFFFE)-P for UJ, just as the assembler computes them.
+R_BYTE = "byte"
+R_HWORD = "hword"
+R_WORD = "word"
+R_DWORD = "dword"
+R_I = "I"
+R_S = "S"
+R_SB = "SB"
+R_U = "U"
+R_UJ = "UJ"
+
+# Declared constants are relocated by the kind for their size.
+declarationKinds = {1: R_BYTE, 2: R_HWORD, 4: R_WORD, 8: R_DWORD}
+
+
+class Relocatable(object):
+    """
+    A Relocatable stands for a value which cannot be known until link time:
+    a constant plus a sum of multiples of section and symbol addresses.
+    Terms are keyed ("section", name) or ("symbol", name).  Arithmetic on
+    relocatable values works as it does on integers so long as the result
+    stays linear; once every term cancels out, the result is a plain integer.
+    """
+
+    __slots__ = ('terms', 'const')
+
+    def __init__(self, terms, const=0):
+        self.terms = terms
+        self.const = const
+
+    @classmethod
+    def section(cls, name, offset=0):
+        return cls({("section", name): 1}, offset)
+
+    @classmethod
+    def symbol(cls, name):
+        return cls({("symbol", name): 1}, 0)
+
+    def target(self):
+        """
+        The single term this value refers to, as (kind, name), if it is of
+        the form target+constant; otherwise None.
+        """
+        if len(self.terms) == 1:
+            (term, coeff), = self.terms.items()
+            if coeff == 1:
+                return term
+        return None
+
+    def _combine(self, other, sign):
+        terms = dict(self.terms)
+        if isinstance(other, Relocatable):
+            for term, coeff in other.terms.items():
+                terms[term] = terms.get(term, 0) + sign * coeff
+                if terms[term] == 0:
+                    del terms[term]
+            const = self.const + sign * other.const
+        else:
+            const = self.const + sign * other
+        if not terms:
+            return const
+        return Relocatable(terms, const)
+
+    def _scale(self, factor):
+        if isinstance(factor, Relocatable):
+            raise Exception(
+                "Cannot multiply relocatable values: {} * {}".format(
+                    self, factor
+                )
+            )
+        if factor == 0:
+            return 0
+        terms = dict((t, c * factor) for t, c in self.terms.items())
+        return Relocatable(terms, self.const * factor)
+
+    def __add__(self, other):
+        return self._combine(other, 1)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self._combine(other, -1)
+
+    def __rsub__(self, other):
+        return self._scale(-1)._combine(other, 1)
+
+    def __mul__(self, other):
+        return self._scale(other)
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return self._scale(-1)
+
+    def __floordiv__(self, other):
+        raise Exception("Cannot divide relocatable value {}".format(self))
+
+    __rfloordiv__ = __floordiv__
+    __div__ = __floordiv__
+    __rdiv__ = __floordiv__
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Relocatable) and
+            self.terms == other.terms and self.const == other.const
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((frozenset(self.terms.items()), self.const))
+
+    def __str__(self):
+        parts = []
+        for (kind, name), coeff in sorted(self.terms.items()):
+            parts.append(name if coeff == 1 else "{}*{}".format(coeff, name))
+        if self.const:
+            parts.append(hex(self.const))
+        return "+".join(parts)
+
+    __repr__ = __str__
+
+
+class Section(object):
+    """
+    One section of an object file: its contents as a codegen.Segment, where
+    it must be placed, and the relocations to apply to it.  A section with
+    no fixed base may be placed anywhere suitably aligned; its contents then
+    begin at address zero.
+    """
+
+    def __init__(self, name, base=None, size=0, align=1):
+        self.name = name
+        self.base = base
+        self.size = size
+        self.align = align
+        self.segment = codegen.Segment(name, base or 0)
+        self.relocations = []
+
+    def relocate(self, offset, kind, target, addend):
+        """
+        Record that the field at offset, from the start of the section, must
+        be fixed up.  target is ("section", name), ("symbol", name), or None
+        for an absolute address.
+        """
+        self.relocations.append((offset, kind, target, addend))
+
+
+class ObjectFile(object):
+    """
+    The sections of a module, and the symbols it defines.  Symbols map each
+    name to (target, value), where target is as for Section.relocate and
+    value is the offset from the target's address.
+    """
+
+    def __init__(self):
+        self.sections = []
+        self.symbols = {}
+
+    def section(self, name):
+        for s in self.sections:
+            if s.name == name:
+                return s
+        return None
+
+    def write(self, f):
+        """Write the object file to the file-like object f."""
+        sections = []
+        for s in self.sections:
+            origin = s.segment.base
+            sections.append({
+                "name": s.name,
+                "base": s.base,
+                "size": s.size,
+                "align": s.align,
+                "runs": [
+                    [start - origin, _encode(run)]
+                    for start, run in s.segment.runs()
+                ],
+                "relocations": [
+                    [offset, kind, _target(target), addend]
+                    for offset, kind, target, addend in s.relocations
+                ],
+            })
+        symbols = dict(
+            (name, [_target(target), value])
+            for name, (target, value) in self.symbols.items()
+        )
+        document = {
+            "format": FORMAT,
+            "version": FORMAT_VERSION,
+            "sections": sections,
+            "symbols": symbols,
+        }
+        f.write(json.dumps(document, sort_keys=True).encode("ascii"))
+
+    @classmethod
+    def read(cls, f, name="<object>"):
+        """Read an object file from the file-like object f."""
+        try:
+            document = json.loads(f.read().decode("ascii"))
+        except ValueError:
+            raise Exception("{} is not an object file".format(name))
+        if document.get("format") != FORMAT:
+            raise Exception("{} is not an object file".format(name))
+        if document.get("version") != FORMAT_VERSION:
+            raise Exception("{} has unsupported version {}".format(
+                name, document.get("version")
+            ))
+
+        obj = cls()
+        for d in document["sections"]:
+            s = Section(d["name"], d["base"], d["size"], d["align"])
+            origin = s.segment.base
+            for start, data in d["runs"]:
+                s.segment.lc = origin + start
+                s.segment.blob(_decode(data))
+            s.segment.lc = origin + s.size
+            for offset, kind, target, addend in d["relocations"]:
+                s.relocate(offset, kind, _untarget(target), addend)
+            obj.sections.append(s)
+        for symbol, (target, value) in document["symbols"].items():
+            obj.symbols[symbol] = (_untarget(target), value)
+        return obj
+
+
+def _encode(data):
+    return base64.b64encode(bytes(data)).decode("ascii")
+
+
+def _decode(text):
+    return bytearray(base64.b64decode(text.encode("ascii")))
+
+
+def _target(target):
+    return list(target) if target else None
+
+
+def _untarget(target):
+    return (str(target[0]), str(target[1])) if target else None
+
+
+def applyRelocation(seg, at, kind, value):
+    """
+    Fix up the field at address at in seg with value, which for SB and UJ
+    relocations is already relative to the field's address.  Register and
+    other fields of an instruction are left as they are.
+    """
+    if kind in _declarators:
+        lc = seg.lc
+        seg.lc = at
+        try:
+            _declarators[kind](seg, value)
+        finally:
+            seg.lc = lc
+        return
+
+    word = seg.getWord(at)
+    rd = (word >> 7) & 0x1F
+    rs1 = (word >> 15) & 0x1F
+    rs2 = (word >> 20) & 0x1F
+    if kind == R_I:
+        word = codegen._toI(word, rd, rs1, value & 0xFFF)
+    elif kind == R_S:
+        word = codegen._toS(word, rs2, rs1, value)
+    elif kind == R_SB:
+        word = codegen._toSB(word, rs1, rs2, value)
+    elif kind == R_U:
+        word = codegen._toU(word, rd, value)
+    elif kind == R_UJ:
+        word = codegen._toUJ(word, rd, value)
+    else:
+        raise Exception("Unknown relocation kind {}".format(kind))
+    seg.putWords(at, [word & 0xFFFFFFFF])
+
+
+def relocationValue(kind, s, addend, p):
+    """The value a relocation places in its field; see the R_* kinds."""
+    if kind == R_SB:
+        return s + addend - p
+    if kind == R_UJ:
+        return ((s + addend) & 0x3FFFFE) - p
+    return s + addend
+
+
+_declarators = {
+    R_BYTE: codegen.Segment.byte,
+    R_HWORD: codegen.Segment.hword,
+    R_WORD: codegen.Segment.word,
+    R_DWORD: codegen.Segment.dword,
+}
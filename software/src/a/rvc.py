@@ -0,0 +1,298 @@
+"""Compressed (RVC) instruction encoding for the RISC-V assembler.
+
+Many RV64I instructions have an equivalent 16-bit encoding in the C
+extension.  compress finds that encoding, given an instruction as it would
+otherwise be laid down, and expand recovers the 32-bit instruction from a
+compressed one.  Only those compressed forms which expand to exactly the
+instruction given are used, so expand(compress(w)) == w whenever compress
+succeeds.
+"""
+
+from codegen import _toI, _toR, _toS, _toSB, _toU, _toUJ
+
+
+# The immediate fields of each compressed format, as a list of (top, bits):
+# the instruction bits from top downwards hold the listed immediate bits.
+_CI = [(12, [5]), (6, [4, 3, 2, 1, 0])]
+_CIW = [(12, [5, 4, 9, 8, 7, 6, 2, 3])]
+_CLW = [(12, [5, 4, 3]), (6, [2, 6])]
+_CLD = [(12, [5, 4, 3]), (6, [7, 6])]
+_CJ = [(12, [11, 4, 9, 8, 10, 6, 7, 3, 2, 1, 5])]
+_CB = [(12, [8, 4, 3]), (6, [7, 6, 2, 1, 5])]
+_CADDI16SP = [(12, [9]), (6, [4, 6, 8, 7, 5])]
+_CLUI = [(12, [17]), (6, [16, 15, 14, 13, 12])]
+_CLWSP = [(12, [5]), (6, [4, 3, 2, 7, 6])]
+_CLDSP = [(12, [5]), (6, [4, 3, 8, 7, 6])]
+_CSWSP = [(12, [5, 4, 3, 2, 7, 6])]
+_CSDSP = [(12, [5, 4, 3, 8, 7, 6])]
+
+# Instruction templates for expand.
+_ADDI = 0x00000013
+_ADDIW = 0x0000001B
+_SLLI = 0x00001013
+_SRLI = 0x00005013
+_ANDI = 0x00007013
+_LUI = 0x00000037
+_ADD = 0x00000033
+_LW = 0x00002003
+_LD = 0x00003003
+_SW = 0x00002023
+_SD = 0x00003023
+_JAL = 0x0000006F
+_JALR = 0x00000067
+_BEQ = 0x00000063
+_BNE = 0x00001063
+_EBREAK = 0x00100073
+
+# The register-register operations on x8-x15 (CA format), keyed by their
+# (funct7, funct3, opcode) and by the (bit 12, bits 6:5) of their compressed
+# encoding.
+_arithmetic = [
+    ((0x20, 0, 0x33), (0, 0)),  # SUB
+    ((0x00, 4, 0x33), (0, 1)),  # XOR
+    ((0x00, 6, 0x33), (0, 2)),  # OR
+    ((0x00, 7, 0x33), (0, 3)),  # AND
+    ((0x20, 0, 0x3B), (1, 0)),  # SUBW
+    ((0x00, 0, 0x3B), (1, 1)),  # ADDW
+]
+_compressedArithmetic = dict(_arithmetic)
+_expandedArithmetic = dict((c, e) for e, c in _arithmetic)
+
+
+def _place(imm, fields):
+    h = 0
+    for top, bits in fields:
+        for k, b in enumerate(bits):
+            h |= ((imm >> b) & 1) << (top - k)
+    return h
+
+
+def _gather(h, fields):
+    imm = 0
+    for top, bits in fields:
+        for k, b in enumerate(bits):
+            imm |= ((h >> (top - k)) & 1) << b
+    return imm
+
+
+def _signed(v, bit):
+    """Sign-extend v from the given bit."""
+    v = v & ((2 << bit) - 1)
+    return v - (2 << bit) if v >> bit else v
+
+
+def _prime(r):
+    """True if register r is one of x8-x15, addressable in three bits."""
+    return 8 <= r <= 15
+
+
+def _fits(v, lo, hi, step=1):
+    return lo <= v <= hi and v % step == 0
+
+
+def compress(w):
+    """
+    Return the 16-bit encoding of the 32-bit instruction w, or None if it
+    has none.
+    """
+    opcode = w & 0x7F
+    rd = (w >> 7) & 0x1F
+    f3 = (w >> 12) & 7
+    rs1 = (w >> 15) & 0x1F
+    rs2 = (w >> 20) & 0x1F
+    f7 = w >> 25
+    imm = _signed(w >> 20, 11)
+
+    if opcode == 0x13 and f3 == 0:
+        if rd == rs1 == 0 and imm == 0:
+            return 0x0001
+        if rd != 0 and rs1 == 0 and _fits(imm, -32, 31):
+            return (2 << 13) | _place(imm, _CI) | (rd << 7) | 1
+        if rd == rs1 != 0 and imm != 0 and _fits(imm, -32, 31):
+            return _place(imm, _CI) | (rd << 7) | 1
+        if rd == rs1 == 2 and imm != 0 and _fits(imm, -512, 496, 16):
+            return (3 << 13) | _place(imm, _CADDI16SP) | (2 << 7) | 1
+        if rs1 == 2 and _prime(rd) and _fits(imm, 4, 1020, 4):
+            return _place(imm, _CIW) | ((rd - 8) << 2)
+        return None
+
+    if opcode == 0x13 and f3 in (1, 5):
+        shamt = (w >> 20) & 0x3F
+        top = w >> 26
+        if shamt == 0 or rd != rs1:
+            return None
+        if f3 == 1 and top == 0 and rd != 0:
+            return _place(shamt, _CI) | (rd << 7) | 2
+        if f3 == 5 and top in (0x00, 0x10) and _prime(rd):
+            kind = 1 if top else 0
+            return ((4 << 13) | _place(shamt, _CI) | (kind << 10) |
+                    ((rd - 8) << 7) | 1)
+        return None
+
+    if opcode == 0x13 and f3 == 7:
+        if rd == rs1 and _prime(rd) and _fits(imm, -32, 31):
+            return ((4 << 13) | _place(imm, _CI) | (2 << 10) |
+                    ((rd - 8) << 7) | 1)
+        return None
+
+    if opcode == 0x1B and f3 == 0:
+        if rd == rs1 != 0 and _fits(imm, -32, 31):
+            return (1 << 13) | _place(imm, _CI) | (rd << 7) | 1
+        return None
+
+    if opcode == 0x37:
+        upper = _signed(w >> 12, 19)
+        if rd not in (0, 2) and upper != 0 and _fits(upper, -32, 31):
+            return (3 << 13) | _place(upper << 12, _CLUI) | (rd << 7) | 1
+        return None
+
+    if opcode == 0x33 and f7 == 0 and f3 == 0:
+        if rd != 0 and rs2 != 0 and rs1 == 0:
+            return (4 << 13) | (rd << 7) | (rs2 << 2) | 2
+        if rd != 0 and rs2 != 0 and rs1 == rd:
+            return (4 << 13) | (1 << 12) | (rd << 7) | (rs2 << 2) | 2
+        # Otherwise, ADD may yet be a CA-format operation.
+
+    if opcode in (0x33, 0x3B):
+        c = _compressedArithmetic.get((f7, f3, opcode))
+        if c is None or rd != rs1 or not (_prime(rd) and _prime(rs2)):
+            return None
+        bit12, f2 = c
+        return ((4 << 13) | (bit12 << 12) | (3 << 10) | ((rd - 8) << 7) |
+                (f2 << 5) | ((rs2 - 8) << 2) | 1)
+
+    if opcode == 0x03 and f3 in (2, 3):
+        size = 4 if f3 == 2 else 8
+        sp, cl = (_CLWSP, _CLW) if f3 == 2 else (_CLDSP, _CLD)
+        if rs1 == 2 and rd != 0 and _fits(imm, 0, 63 * size, size):
+            return (f3 << 13) | _place(imm, sp) | (rd << 7) | 2
+        if _prime(rd) and _prime(rs1) and _fits(imm, 0, 31 * size, size):
+            return ((f3 << 13) | _place(imm, cl) | ((rs1 - 8) << 7) |
+                    ((rd - 8) << 2))
+        return None
+
+    if opcode == 0x23 and f3 in (2, 3):
+        imm = _signed(((w >> 25) << 5) | rd, 11)
+        size = 4 if f3 == 2 else 8
+        sp, cl = (_CSWSP, _CLW) if f3 == 2 else (_CSDSP, _CLD)
+        if rs1 == 2 and _fits(imm, 0, 63 * size, size):
+            return ((f3 + 4) << 13) | _place(imm, sp) | (rs2 << 2) | 2
+        if _prime(rs2) and _prime(rs1) and _fits(imm, 0, 31 * size, size):
+            return (((f3 + 4) << 13) | _place(imm, cl) | ((rs1 - 8) << 7) |
+                    ((rs2 - 8) << 2))
+        return None
+
+    if opcode == 0x67 and f3 == 0:
+        if imm == 0 and rs1 != 0 and rd in (0, 1):
+            return (4 << 13) | (rd << 12) | (rs1 << 7) | 2
+        return None
+
+    if opcode == 0x6F:
+        ofs = _signed(
+            ((w >> 31) << 20) | (((w >> 21) & 0x3FF) << 1) |
+            (((w >> 20) & 1) << 11) | (((w >> 12) & 0xFF) << 12),
+            20
+        )
+        if rd == 0 and _fits(ofs, -2048, 2046):
+            return (5 << 13) | _place(ofs, _CJ) | 1
+        return None
+
+    if opcode == 0x63 and f3 in (0, 1):
+        ofs = _signed(
+            ((w >> 31) << 12) | (((w >> 25) & 0x3F) << 5) |
+            (((w >> 8) & 0xF) << 1) | (((w >> 7) & 1) << 11),
+            12
+        )
+        if rs2 == 0 and _prime(rs1) and _fits(ofs, -256, 254):
+            return ((6 + f3) << 13) | _place(ofs, _CB) | ((rs1 - 8) << 7) | 1
+        return None
+
+    if w == _EBREAK:
+        return 0x9002
+
+    return None
+
+
+def expand(h):
+    """
+    Return the 32-bit instruction for the 16-bit encoding h.  Only the
+    compressed forms produced by compress are recognised; anything else
+    raises ValueError.
+    """
+    quadrant = h & 3
+    f3 = h >> 13
+    rd = (h >> 7) & 0x1F
+    rs2 = (h >> 2) & 0x1F
+    rdp = ((h >> 2) & 7) + 8
+    rs1p = ((h >> 7) & 7) + 8
+    ci = _signed(_gather(h, _CI), 5)
+    w = None
+
+    if quadrant == 0:
+        if f3 == 0 and _gather(h, _CIW):
+            w = _toI(_ADDI, rdp, 2, _gather(h, _CIW))
+        elif f3 == 2:
+            w = _toI(_LW, rdp, rs1p, _gather(h, _CLW))
+        elif f3 == 3:
+            w = _toI(_LD, rdp, rs1p, _gather(h, _CLD))
+        elif f3 == 6:
+            w = _toS(_SW, rdp, rs1p, _gather(h, _CLW))
+        elif f3 == 7:
+            w = _toS(_SD, rdp, rs1p, _gather(h, _CLD))
+
+    elif quadrant == 1:
+        if f3 == 0:
+            w = _toI(_ADDI, rd, rd, ci & 0xFFF)
+        elif f3 == 1 and rd != 0:
+            w = _toI(_ADDIW, rd, rd, ci & 0xFFF)
+        elif f3 == 2 and rd != 0:
+            w = _toI(_ADDI, rd, 0, ci & 0xFFF)
+        elif f3 == 3 and rd == 2:
+            w = _toI(_ADDI, 2, 2, _signed(_gather(h, _CADDI16SP), 9) & 0xFFF)
+        elif f3 == 3 and rd != 0:
+            w = _toU(_LUI, rd, _signed(_gather(h, _CLUI), 17))
+        elif f3 == 4:
+            f2 = (h >> 10) & 3
+            shamt = _gather(h, _CI)
+            if f2 == 0:
+                w = _toI(_SRLI, rs1p, rs1p, shamt)
+            elif f2 == 1:
+                w = _toI(_SRLI, rs1p, rs1p, 0x400 | shamt)
+            elif f2 == 2:
+                w = _toI(_ANDI, rs1p, rs1p, ci & 0xFFF)
+            else:
+                e = _expandedArithmetic.get(((h >> 12) & 1, (h >> 5) & 3))
+                if e is not None:
+                    f7, f3, opcode = e
+                    w = _toR((f7 << 25) | (f3 << 12) | opcode, rs1p, rs1p, rdp)
+        elif f3 == 5:
+            w = _toUJ(_JAL, 0, _signed(_gather(h, _CJ), 11))
+        elif f3 in (6, 7):
+            w = _toSB(_BEQ if f3 == 6 else _BNE, rs1p, 0,
+                      _signed(_gather(h, _CB), 8))
+
+    elif quadrant == 2:
+        if f3 == 0 and rd != 0:
+            w = _toI(_SLLI, rd, rd, _gather(h, _CI))
+        elif f3 == 2 and rd != 0:
+            w = _toI(_LW, rd, 2, _gather(h, _CLWSP))
+        elif f3 == 3 and rd != 0:
+            w = _toI(_LD, rd, 2, _gather(h, _CLDSP))
+        elif f3 == 4:
+            link = (h >> 12) & 1
+            if link and rd == 0 and rs2 == 0:
+                w = _EBREAK
+            elif rd != 0 and rs2 == 0:
+                w = _toI(_JALR, link, rd, 0)
+            elif rd != 0:
+                w = _toR(_ADD, rd, rd if link else 0, rs2)
+        elif f3 == 6:
+            w = _toS(_SW, rs2, 2, _gather(h, _CSWSP))
+        elif f3 == 7:
+            w = _toS(_SD, rs2, 2, _gather(h, _CSDSP))
+
+    if w is None:
+        raise ValueError(
+            "{:04X} is not a supported compressed instruction".format(h)
+        )
+    return w & 0xFFFFFFFF
@@ -0,0 +1,770 @@
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import a
+
+
+srcDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def sources():
+    """All assembly listings shipped in the source tree."""
+    for pattern in ["*/*.asm", "*/*.i", "*/*/*.asm", "*/*/*.i", "*/*.inc"]:
+        for name in sorted(glob.glob(os.path.join(srcDir, pattern))):
+            yield name
+
+
+def tokensOf(asm):
+    return [(t.tokenType, t.tokenValue, t.string) for t in asm.tokenStream]
+
+
+class TestLexers(unittest.TestCase):
+    def lexBoth(self, lines):
+        old = a.Assembler([])
+        for line in lines:
+            for c in line:
+                old.lexChar(c)
+        new = a.Assembler([])
+        for line in lines:
+            new.lexLine(line)
+        return tokensOf(old), tokensOf(new)
+
+    def assertSameTokens(self, lines):
+        old, new = self.lexBoth(lines)
+        self.assertEqual(old, new)
+
+    def test_instruction(self):
+        old, new = self.lexBoth(["start:\taddi\tx1, x0, $FF ; comment\n"])
+        self.assertEqual(old, new)
+        self.assertEqual(new[0], (a.identifierToken, "start", "start"))
+        self.assertEqual(new[2], (a.opcodes['ADDI'].token, "addi", "addi"))
+        self.assertEqual(new[-2], (a.integerToken, 255, "FF"))
+        self.assertEqual(new[-1], (a.commentToken, " comment", " comment"))
+
+    def test_expressions(self):
+        self.assertSameTokens(["len = *-start+4*(x/2)\n"])
+
+    def test_strings(self):
+        self.assertSameTokens(['\tbyte "Hello, world!", 13, 10\n'])
+
+    def test_miscellaneous_characters(self):
+        self.assertSameTokens(["\t@#%^&.=:,()[]{}<>?\n"])
+
+    def test_source_tree(self):
+        for name in sources():
+            with open(name, "r") as f:
+                lines = f.readlines()
+            if lines and not lines[-1].endswith("\n"):
+                lines[-1] = lines[-1] + "\n"
+            old, new = self.lexBoth(lines)
+            self.assertEqual(old, new, name)
+
+
+class TestLexerSelection(unittest.TestCase):
+    def test_default_is_line_lexer(self):
+        asm = a.Assembler(["a", "from", "x.asm"])
+        asm.parseArgs()
+        self.assertFalse(asm.options & a.OPT_CHARLEXER)
+
+    def test_charlexer(self):
+        asm = a.Assembler(["a", "from", "x.asm", "charlexer"])
+        asm.parseArgs()
+        self.assertTrue(asm.options & a.OPT_CHARLEXER)
+
+    def test_same_line_numbers(self):
+        for args in [[], ["charlexer"]]:
+            asm = a.Assembler(["a"] + args)
+            asm.parseArgs()
+            asm.pass1line("\n")
+            asm.pass1line("x = 3\n")
+            self.assertEqual(asm.getLine(), 2)
+            self.assertEqual(asm.getSymbol("x").a, 3)
+
+
+def assembleWith(flags, *lines):
+    asm = a.Assembler(["a", "quiet"] + flags)
+    asm.parseArgs()
+    for line in lines:
+        asm.pass1line(line)
+    if asm.options & a.OPT_PEEPHOLE:
+        asm.peephole()
+    if asm.options & a.OPT_RELAXING:
+        asm.relax()
+    else:
+        asm.resolveSymbols()
+    asm.pass2()
+    asm.pass3()
+    return asm
+
+
+def assemble(*lines):
+    return assembleWith([], *lines)
+
+
+class TestOpcodeTable(unittest.TestCase):
+    def test_mnemonics_are_case_insensitive(self):
+        for mnemonic, op in a.opcodes.items():
+            self.assertEqual(a.kindOfIdentifier(mnemonic), op.token)
+            self.assertEqual(a.kindOfIdentifier(mnemonic.lower()), op.token)
+            self.assertEqual(a.kindOfIdentifier(mnemonic.title()), op.token)
+
+    def test_identifiers(self):
+        self.assertEqual(a.kindOfIdentifier("loop"), a.identifierToken)
+        self.assertEqual(a.kindOfIdentifier("Align"), a.alignToken)
+
+    def test_every_format_encodes(self):
+        asm = assemble(
+            "\tadd\t1, 2, 3\n",
+            "\taddi\t1, 2, 3\n",
+            "\tld\t1, 8(2)\n",
+            "\tsd\t1, 8(2)\n",
+            "\tbne\t1, 2, 0\n",
+            "\tlui\t1, $12345000\n",
+            "\tjal\t1, 40\n",
+            "\tecall\n",
+            "\tsfencevm\t5\n",
+        )
+        words = [asm.seg.getWord(i) for i in range(0, asm.seg.size(), 4)]
+        self.assertEqual(words, [
+            0x003100B3, 0x00310093, 0x00813083, 0x00113423,
+            0xFE2098E3, 0x123450B7, 0x010000EF, 0x00000073,
+            0x10428073,
+        ])
+
+    def test_undefined_operand(self):
+        with self.assertRaises(Exception) as cm:
+            assemble("\tadd\t1, 2, 3\n", "\tlui\tnowhere, 0\n")
+        self.assertEqual(str(cm.exception), "Pass 2 error: Undefined symbols?")
+
+
+class TestCompression(unittest.TestCase):
+    def halves(self, asm):
+        seg = asm.seg
+        return [seg.getHWord(i) for i in range(seg.base, seg.lc, 2)]
+
+    def test_eligible_instructions_are_compressed(self):
+        asm = assembleWith(
+            ["compress"],
+            "\taddi\t10, 0, 1\n",
+            "\tadd\t10, 10, 11\n",
+            "\taddi\t10, 11, 1\n",
+            "\tjalr\t0, 0(1)\n",
+        )
+        self.assertEqual(self.halves(asm), [0x4505, 0x952E, 0x8513, 0x0015,
+                                            0x8082])
+        self.assertEqual(asm.savings, {"text": 6})
+
+    def test_labels_follow_compressed_code(self):
+        asm = assembleWith(
+            ["compress"],
+            "\taddi\t10, 0, 1\n",
+            "here:\taddi\t10, 10, 100\n",
+            "there:\tdword\tthere-here\n",
+        )
+        self.assertEqual(asm.values["here"], 2)
+        self.assertEqual(asm.values["there"], 6)
+        self.assertEqual(asm.seg.getWord(8), 4)
+
+    def test_branches_are_recomputed(self):
+        asm = assembleWith(
+            ["compress"],
+            "top:\taddi\t8, 8, -1\n",
+            "\tbne\t8, 0, top\n",
+            "\tjal\t0, *\n",
+            "\tjal\t0, top\n",
+        )
+        self.assertEqual(self.halves(asm), [0x147D, 0xFC7D, 0xA001, 0xBFED])
+
+    def test_distant_branches_keep_their_size(self):
+        body = ["\taddi\t8, 8, 1\n"] * 100
+        asm = assembleWith(
+            ["compress"],
+            *(["\tbeq\t8, 0, near\n", "\tbeq\t8, 0, far\n"] + body +
+              ["near:\n"] + body + ["far:\n"])
+        )
+        self.assertEqual(asm.values["near"], 2 + 4 + 200)
+        self.assertEqual(asm.values["far"], 2 + 4 + 400)
+        self.assertEqual(asm.seg.getHWord(0) & 3, 1)
+        self.assertEqual(asm.seg.getWord(2) & 0x7F, 0x63)
+
+    def test_alignment(self):
+        asm = assembleWith(
+            ["compress"],
+            "\tbyte\t1\n",
+            "\taddi\t10, 10, 1\n",
+            "\talign\t8\n",
+            "end:\n",
+        )
+        self.assertEqual(asm.values["end"], 8)
+        self.assertEqual(self.halves(asm), [0x0001, 0x0505, 0, 0])
+
+    def test_object_files_are_not_compressed(self):
+        asm = a.Assembler(["a", "quiet", "compress", "object"])
+        asm.parseArgs()
+        with self.assertRaises(Exception):
+            asm.assemble()
+
+
+class TestPseudoInstructions(unittest.TestCase):
+    def words(self, asm):
+        seg = asm.seg
+        return [seg.getWord(i) for i in range(seg.base, seg.lc, 4)]
+
+    def test_known_operands_take_the_shortest_sequence(self):
+        asm = assemble(
+            "\tli\t5, 1\n",
+            "\tli\t5, $12345678\n",
+            "here:\tcall\there\n",
+            "\tla\t6, here\n",
+        )
+        self.assertEqual(self.words(asm), [
+            0x00100293, 0x123452B7, 0x6782829B, 0x000000EF, 0x00C00313,
+        ])
+
+    def test_names_remain_free(self):
+        asm = assemble(
+            "call:\tjal\t1, call\n",
+            "li = 3\n",
+            "\tcall\tcall+li+1\n",
+        )
+        self.assertEqual(asm.values["call"], 0)
+        self.assertEqual(asm.values["li"], 3)
+        self.assertEqual(self.words(asm), [0x000000EF, 0x000000EF])
+
+    def test_forward_references_are_padded(self):
+        asm = assemble(
+            "\tcall\tlater\n",
+            "\tli\t5, value\n",
+            "later:\n",
+            "value = 1\n",
+        )
+        self.assertEqual(asm.values["later"], 40)
+        self.assertEqual(self.words(asm), [
+            0x028000EF, 0x00000013, 0x00100293,
+        ] + [0x00000013] * 7)
+
+    def test_relaxation_shrinks_forward_references(self):
+        asm = assembleWith(
+            ["relax"],
+            "\tcall\tlater\n",
+            "\tli\t5, value\n",
+            "later:\tla\t6, later\n",
+            "value = 1\n",
+        )
+        self.assertEqual(asm.values["later"], 8)
+        self.assertEqual(self.words(asm), [0x008000EF, 0x00100293, 0x00000317])
+        self.assertEqual(asm.relaxed, 9)
+
+    def test_relaxation_with_compression(self):
+        asm = assembleWith(
+            ["compress"],
+            "\tli\t10, 1\n",
+            "\tcall\tlater\n",
+            "later:\n",
+        )
+        self.assertEqual(asm.values["later"], 6)
+        self.assertEqual(asm.seg.getHWord(0), 0x4505)
+        self.assertEqual(asm.seg.getWord(2), 0x004000EF)
+
+    def test_out_of_range(self):
+        with self.assertRaises(Exception):
+            assemble("\tla\t5, far\n", "far = $123456789ABC\n")
+
+
+class TestPeephole(unittest.TestCase):
+    def words(self, asm):
+        seg = asm.seg
+        return [seg.getWord(i) for i in range(seg.base, seg.lc, 4)]
+
+    def test_rules(self):
+        asm = assembleWith(
+            ["peephole"],
+            "\taddi\t5, 5, 0\n",
+            "\taddi\t0, 0, 0\n",
+            "\tsd\t6, 8(2)\n",
+            "\tld\t7, 8(2)\n",
+            "\tsw\t6, 0(2)\n",
+            "\tlw\t6, 0(2)\n",
+            "\taddi\t2, 2, -8\n",
+            "\taddi\t2, 2, 8\n",
+            "\taddi\t3, 4, 1\n",
+            "\taddi\t3, 3, 2\n",
+            "\tjal\t0, next\n",
+            "next:\tjal\t0, next\n",
+        )
+        self.assertEqual(self.words(asm), [
+            0x00000013,     # addi 0, 0, 0
+            0x00613423,     # sd 6, 8(2)
+            0x00030393,     # addi 7, 6, 0
+            0x00612023,     # sw 6, 0(2)
+            0x0003031B,     # addiw 6, 6, 0
+            0x00320193,     # addi 3, 4, 3
+            0x0000006F,     # jal 0, next
+        ])
+        self.assertEqual(asm.values["next"], 24)
+        self.assertEqual(asm.peepholeHits, {
+            "identity": 1, "reload": 2, "addi": 2, "jump": 1,
+        })
+
+    def test_labels_and_branches_follow(self):
+        asm = assembleWith(
+            ["peephole"],
+            "top:\taddi\t5, 5, 0\n",
+            "\tbeq\t5, 0, done\n",
+            "\taddi\t5, 5, 1\n",
+            "\tjal\t0, top\n",
+            "\tjal\t0, done\n",
+            "\taddi\t5, 5, 0\n",
+            "done:\taddi\t6, 6, 1\n",
+        )
+        self.assertEqual(asm.values["top"], 0)
+        self.assertEqual(asm.values["done"], 12)
+        self.assertEqual(self.words(asm), [
+            0x00028663,     # beq 5, 0, done
+            0x00128293,     # addi 5, 5, 1
+            0xFF9FF06F,     # jal 0, top
+            0x00130313,     # addi 6, 6, 1
+        ])
+
+    def test_labels_separate_instructions(self):
+        asm = assembleWith(
+            ["peephole"],
+            "\taddi\t2, 2, -8\n",
+            "again:\taddi\t2, 2, 8\n",
+            "\tsd\t6, 0(2)\n",
+            "\tld\t7, 0(2)\n",
+            "\tjal\t0, again\n",
+        )
+        self.assertEqual(self.words(asm), [
+            0xFF810113, 0x00810113, 0x00613023, 0x00030393, 0xFF5FF06F,
+        ])
+        self.assertEqual(asm.peepholeHits["addi"], 0)
+
+    def test_operands_depending_on_labels_are_left_alone(self):
+        asm = assembleWith(
+            ["peephole"],
+            "\taddi\t5, 5, there-here\n",
+            "here:\n",
+            "there:\taddi\t5, 5, 4\n",
+        )
+        self.assertEqual(self.words(asm), [0x00028293, 0x00428293])
+
+
+class TestLexCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.dir, "cache")
+        self.source = os.path.join(self.dir, "x.asm")
+        self.output = os.path.join(self.dir, "x.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        with open(self.source, "w") as f:
+            f.write(text)
+        os.utime(self.source, (0, 0))
+
+    def build(self, *flags):
+        asm = a.Assembler([
+            "a", "from", self.source, "to", self.output,
+            "cache", self.cacheDir, "quiet"
+        ] + list(flags))
+        asm.main()
+        with open(self.output, "rb") as f:
+            return asm, f.read()
+
+    def test_reuses_lexed_files(self):
+        self.write("\tword\t1\n")
+        asm, first = self.build()
+        self.assertEqual((asm.lexCache.hits, asm.lexCache.misses), (0, 1))
+        asm, second = self.build()
+        self.assertEqual((asm.lexCache.hits, asm.lexCache.misses), (1, 0))
+        self.assertEqual(first, second)
+
+    def test_content_change_invalidates(self):
+        self.write("\tword\t1\n")
+        asm, first = self.build()
+        self.write("\tword\t2\n")
+        asm, second = self.build()
+        self.assertEqual(asm.lexCache.misses, 1)
+        self.assertEqual(bytearray(second), bytearray([2, 0, 0, 0]))
+
+    def test_nocache(self):
+        self.write("\tword\t1\n")
+        self.build()
+        asm, _ = self.build("nocache")
+        self.assertEqual((asm.lexCache.hits, asm.lexCache.misses), (0, 1))
+
+
+class TestSymbolResolution(unittest.TestCase):
+    def test_forward_alias_chain(self):
+        asm = assemble(
+            "rt = rp\n",
+            "rp = rsp\n",
+            "\taddi\trt, rt, later-4\n",
+            "rsp = 2\n",
+            "later:\n",
+        )
+        self.assertEqual(asm.values["rt"], 2)
+        self.assertEqual(asm.values["later"], 4)
+        self.assertEqual(asm.seg.getWord(0), 0x00010113)
+
+    def test_cycles_are_reported(self):
+        asm = a.Assembler(["a"])
+        for line in ["a = b + 1\n", "b = c\n", "c = a\n", "d = 7\n"]:
+            asm.pass1line(line)
+        asm.resolveSymbols()
+        # c = a substitutes the definition of a, so the cycle runs through b.
+        self.assertEqual(asm.cycles, [["b", "c", "b"]])
+        self.assertEqual(asm.values, {"d": 7})
+
+    def test_operands_are_resolved_once(self):
+        asm = a.Assembler(["a"])
+        for line in ["\tword\tx*2, x\n", "x = 3\n"]:
+            asm.pass1line(line)
+        asm.resolveSymbols()
+        self.assertEqual(asm.operandValues, [6, 3])
+
+
+class TestIncbin(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.blob = os.path.join(self.dir, "blob.bin")
+        with open(self.blob, "wb") as f:
+            f.write(bytearray(range(1, 11)))
+        self.empty = os.path.join(self.dir, "empty.bin")
+        open(self.empty, "wb").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def image(self, *lines):
+        asm = assemble(*lines)
+        return asm, list(asm.seg.buf)
+
+    def test_whole_file_is_one_record(self):
+        asm, image = self.image(
+            '\tincbin\t"{}"\n'.format(self.blob),
+            "end:\tbyte\tend\n",
+        )
+        self.assertEqual(image, range(1, 11) + [10])
+        self.assertEqual(len(asm.program), 2)
+
+    def test_offset_and_length(self):
+        _, image = self.image(
+            '\tincbin\t"{}", 2, 3\n'.format(self.blob),
+            '\tincbin\t"{}", 8\n'.format(self.blob),
+        )
+        self.assertEqual(image, [3, 4, 5, 9, 10])
+
+    def test_empty_file(self):
+        _, image = self.image('\tincbin\t"{}"\n'.format(self.empty))
+        self.assertEqual(image, [])
+
+    def test_range_outside_file(self):
+        with self.assertRaises(Exception):
+            self.image('\tincbin\t"{}", 8, 3\n'.format(self.blob))
+
+
+class TestSections(unittest.TestCase):
+    def test_sections(self):
+        asm = assemble(
+            "\tbyte\t1\n",
+            "\tsection\tvectors, 16\n",
+            "\tword\t$11223344\n",
+            "\tsection\ttext\n",
+            "\tbyte\t2\n",
+            "\tsection\tbss, $1000\n",
+            "buf:\tadv\tbuf+$100\n",
+            "\tsection\ttext\n",
+            "end:\n",
+        )
+        self.assertEqual(asm.values["end"], 2)
+        self.assertEqual(asm.values["buf"], 0x1000)
+        text, vectors, bss = asm.sections
+        self.assertEqual(text.runs(), [(0, bytearray([1, 2]))])
+        self.assertEqual(vectors.runs(), [
+            (16, bytearray(b"\x44\x33\x22\x11"))
+        ])
+        self.assertEqual((bss.runs(), bss.lc), ([], 0x1100))
+
+    def test_text_may_be_based_before_use(self):
+        asm = assemble("\tsection\ttext, $100\n", "here:\tbyte\t1\n")
+        self.assertEqual(asm.values["here"], 0x100)
+        self.assertEqual(asm.seg.runs(), [(0x100, bytearray([1]))])
+
+    def test_rebasing_a_used_section(self):
+        with self.assertRaises(Exception):
+            assemble("\tbyte\t1\n", "\tsection\ttext, $100\n")
+
+
+class TestExpressionNodes(unittest.TestCase):
+    def setUp(self):
+        self.asm = a.Assembler(["a"])
+
+    def parse(self, text):
+        self.asm.lexLine(text + "\n")
+        return a.expression(self.asm, 0)
+
+    def test_constants_are_folded(self):
+        e = self.parse("-(3+4)*2-10/3")
+        self.assertEqual((e.kind, e.a), (a.EN_INT, -17))
+
+    def test_partial_folding(self):
+        e = self.parse("x+2*3")
+        self.assertEqual(e.kind, a.EN_ADD)
+        self.assertEqual((e.b.kind, e.b.a), (a.EN_INT, 6))
+
+    def test_division_by_zero_is_not_folded(self):
+        self.assertEqual(self.parse("1/0").kind, a.EN_DIV)
+
+    def test_identical_nodes_are_shared(self):
+        self.assertIs(self.parse("x*2+y"), self.parse("x * 2 + y"))
+        self.assertIs(self.parse("4"), self.parse("2+2"))
+
+    def test_nodes_go_with_their_assembler(self):
+        source = ["x = 3\n", "\tdword\tx*2+here, -x\n", "here:\n"]
+        first = assemble(*source)
+        second = assemble(*source)
+        self.assertTrue(first.exprNodes)
+        self.assertEqual(len(second.exprNodes), len(first.exprNodes))
+        self.assertFalse(set(map(id, second.exprNodes.values())) &
+                         set(map(id, first.exprNodes.values())))
+        self.assertFalse(hasattr(a, "exprNodes"))
+
+
+class TestBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.dir, "cache")
+        self.source = os.path.join(self.dir, "x.asm")
+        self.data = os.path.join(self.dir, "x.dat")
+        self.output = os.path.join(self.dir, "x.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        with open(name, "w") as f:
+            f.write(text)
+
+    def build(self, *flags):
+        asm = a.Assembler([
+            "a", "from", self.source, "to", self.output,
+            "cache", self.cacheDir, "quiet", "buildcache"
+        ] + list(flags))
+        asm.main()
+        with open(self.output, "rb") as f:
+            return asm, bytearray(f.read())
+
+    def entries(self):
+        builds = os.path.join(self.cacheDir, "builds")
+        return [
+            name for name in os.listdir(builds)
+            if os.path.isdir(os.path.join(builds, name))
+        ]
+
+    def test_unchanged_build_is_restored(self):
+        self.write(self.source, '\tword\t1\n\tincbin\t"x.dat"\n')
+        self.write(self.data, "AB")
+        asm, first = self.build()
+        self.assertEqual(asm.buildCache.misses, 1)
+        os.unlink(self.output)
+        asm, second = self.build()
+        self.assertEqual(asm.buildCache.hits, 1)
+        self.assertEqual(len(asm.program), 0)
+        self.assertEqual(first, second)
+
+    def test_changed_inputs_rebuild(self):
+        self.write(self.source, '\tword\t1\n\tincbin\t"x.dat"\n')
+        self.write(self.data, "AB")
+        self.build()
+        self.write(self.data, "CD")
+        asm, image = self.build()
+        self.assertEqual(asm.buildCache.misses, 1)
+        self.assertEqual(image, bytearray(b"\x01\x00\x00\x00CD"))
+        self.write(self.data, "AB")
+        asm, image = self.build()
+        self.assertEqual(asm.buildCache.hits, 1)
+        self.assertEqual(image, bytearray(b"\x01\x00\x00\x00AB"))
+
+    def test_options_are_part_of_the_key(self):
+        self.write(self.source, "\tword\t1\n")
+        self.build()
+        asm, _ = self.build("swap")
+        self.assertEqual(asm.buildCache.misses, 1)
+        asm, _ = self.build("nocache")
+        self.assertEqual(asm.buildCache.misses, 1)
+
+    def test_least_recently_used_are_trimmed(self):
+        self.write(self.source, "\tword\t1\n")
+        self.build("cachelimit", "4")
+        self.write(self.source, "\tword\t2\n")
+        self.build("cachelimit", "4")
+        self.assertEqual(len(self.entries()), 1)
+        asm, image = self.build("cachelimit", "4")
+        self.assertEqual(asm.buildCache.hits, 1)
+        self.write(self.source, "\tword\t1\n")
+        asm, image = self.build("cachelimit", "4")
+        self.assertEqual(asm.buildCache.misses, 1)
+
+
+class SourceTreeTestCase(unittest.TestCase):
+    """Builds a root file which includes another from a subdirectory."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, "root.asm")
+        self.sub = os.path.join(self.dir, "sub", "data.asm")
+        self.output = os.path.join(self.dir, "root.bin")
+        os.mkdir(os.path.dirname(self.sub))
+        with open(self.root, "w") as f:
+            f.write('\tinclude "sub/data.asm"\n')
+        self.writeData(1)
+        self.asm = a.Assembler([
+            "a", "from", self.root, "to", self.output, "nocache", "quiet"
+        ])
+        self.asm.parseArgs()
+        self.asm.lexCache = self.asm.makeLexCache()
+        self.asm.lexCache.directory = None
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeData(self, value):
+        with open(self.sub, "w") as f:
+            f.write("\tbyte\t{}\n".format(value))
+
+    def image(self):
+        with open(self.output, "rb") as f:
+            return bytearray(f.read())
+
+
+class TestWatch(SourceTreeTestCase):
+    def test_records_dependencies(self):
+        self.asm.assemble()
+        self.assertEqual(self.asm.dependencies, [self.root, self.sub])
+        self.assertEqual(self.image(), bytearray([1]))
+
+    def test_output_is_replaced_atomically(self):
+        self.asm.assemble()
+        self.asm.assemble()
+        self.assertEqual(
+            sorted(os.listdir(self.dir)), ["root.asm", "root.bin", "sub"]
+        )
+
+    def watchWhile(self, edit):
+        """
+        Watch for two builds, calling edit as the first build ends, before
+        watch mode sees it finish.  Fails rather than hangs should the second
+        build never come.
+        """
+        interval = a.watchInterval
+        assemble = a.Assembler.assemble
+        edits = []
+
+        def assembleThenEdit(asm):
+            assemble(asm)
+            if not edits:
+                edits.append(edit())
+
+        a.watchInterval = 0.02
+        a.Assembler.assemble = assembleThenEdit
+        try:
+            watcher = threading.Thread(target=self.asm.watch, args=(2,))
+            watcher.daemon = True
+            watcher.start()
+            watcher.join(10)
+            self.assertFalse(watcher.is_alive(), "no rebuild after the edit")
+        finally:
+            a.Assembler.assemble = assemble
+            a.watchInterval = interval
+
+    def test_rebuilds_on_change(self):
+        self.watchWhile(lambda: self.writeData(2))
+        self.assertEqual(self.image(), bytearray([2]))
+        # The root file is lexed once; only the changed file is lexed again.
+        cache = self.asm.lexCache
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+
+class TestDependencies(SourceTreeTestCase):
+    def listing(self):
+        with open(self.deps) as f:
+            return f.read().splitlines()
+
+    def test_dependency_file(self):
+        self.deps = os.path.join(self.dir, "root.deps")
+        self.asm._deps = self.deps
+        self.asm.assemble()
+        self.assertEqual(self.listing(), [self.root, self.sub])
+
+    def test_redo(self):
+        calls = []
+        checkCall = a.subprocess.check_call
+        a.subprocess.check_call = calls.append
+        try:
+            self.asm.options = self.asm.options | a.OPT_REDO
+            self.asm.assemble()
+        finally:
+            a.subprocess.check_call = checkCall
+        self.assertEqual(calls, [["redo-ifchange", self.root, self.sub]])
+
+    def test_restored_builds_list_their_dependencies(self):
+        self.deps = os.path.join(self.dir, "root.deps")
+        cacheDir = os.path.join(self.dir, "cache")
+
+        def build():
+            asm = a.Assembler([
+                "a", "from", self.root, "to", self.output, "deps", self.deps,
+                "cache", cacheDir, "buildcache", "quiet"
+            ])
+            asm.main()
+            return asm
+
+        build()
+        os.unlink(self.deps)
+        asm = build()
+        self.assertEqual(asm.buildCache.hits, 1)
+        self.assertEqual(self.listing(), [self.root, self.sub])
+
+
+class TestExporters(SourceTreeTestCase):
+    def test_every_artifact_from_one_invocation(self):
+        hexFile = os.path.join(self.dir, "root.hex")
+        romFile = os.path.join(self.dir, "root.v")
+        self.asm.args.extend(["hex", hexFile, "rom", romFile, "bytes", "1"])
+        self.asm.parseArgs()
+        self.asm.assemble()
+        with open(hexFile) as f:
+            self.assertEqual(f.read(), "01\n")
+        with open(romFile) as f:
+            self.assertIn("module root(", f.read())
+
+
+class TestParallelLexing(SourceTreeTestCase):
+    def test_prelex_finds_every_include(self):
+        self.asm.prelex(self.root, 2)
+        self.assertEqual(
+            sorted(self.asm.lexCache.memory), sorted([self.root, self.sub])
+        )
+        self.asm.assemble()
+        cache = self.asm.lexCache
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+        self.assertEqual(self.image(), bytearray([1]))
+
+    def test_jobs(self):
+        self.asm.args.extend(["jobs", "2"])
+        self.asm.parseArgs()
+        self.asm.assemble()
+        self.assertEqual(self.asm.lexCache.misses, 0)
+        self.assertEqual(self.image(), bytearray([1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import StringIO
+import random
 import unittest
 
 import codegen
@@ -20,6 +21,54 @@ class TestRawExporter(unittest.TestCase):
         x.exportSegment(g)
         self.assertEquals(len(b.getvalue()), 16)
 
+class TestMemoryExporters(unittest.TestCase):
+    def segments(self):
+        text = codegen.Segment()
+        text.word(0x04030201)
+        text.byte(5)
+        vectors = codegen.Segment("vectors", 0x10001)
+        vectors.hword(0xBBAA)
+        return [text, vectors]
+
+    def export(self, exporter, *args):
+        b = StringIO.StringIO()
+        exporter(b, *args).exportSections(self.segments())
+        return b.getvalue()
+
+    def testHex(self):
+        lines = self.export(codegen.HexExporter, 4).split("\n")
+        self.assertEqual(lines[:3], ["01020304", "05000000", "00000000"])
+        self.assertEqual(lines[-2], "00AABB")
+        self.assertEqual(len(lines), 0x10004 // 4 + 1)
+
+    def testSparseSwappedHex(self):
+        self.assertEqual(
+            self.export(codegen.HexExporter, 4, True, 0xFF, True),
+            "@0\n04030201\nFFFFFF05\n@4000\nFFBBAAFF\n"
+        )
+
+    def testIntelHex(self):
+        self.assertEqual(self.export(codegen.IntelHexExporter), "\n".join([
+            ":050000000102030405EC",
+            ":020000040001F9",
+            ":02000100AABB98",
+            ":00000001FF",
+        ]) + "\n")
+
+    def testRom(self):
+        b = StringIO.StringIO()
+        seg = codegen.Segment()
+        seg.word(0x04030201)
+        codegen.RomExporter(b, "rom", 2, True).exportSegment(seg)
+        lines = b.getvalue().split("\n")
+        self.assertEqual(lines[2], "module rom(")
+        self.assertEqual(lines[3], "\tinput\t[1:1]\tadr_i,")
+        self.assertEqual(lines[12:14], [
+            "\t\t1'd0: dat_o = 16'h0201;",
+            "\t\t1'd1: dat_o = 16'h0403;",
+        ])
+
+
 class TestSegment(unittest.TestCase):
     def test_construction(self):
         g = codegen.Segment()
@@ -74,6 +123,60 @@ class TestSegment(unittest.TestCase):
         for i in range(16):
             self.assertEqual(g.buf[i], 0xCC)
 
+    def test_blob(self):
+        g = codegen.Segment()
+        g.byte(9)
+        g.byte(9)
+        g.lc = 1
+        g.blob(buffer("\x01\x02\x03"))
+        self.assertEqual(g.lc, 4)
+        self.assertEqual(list(g.buf[:4]), [9, 1, 2, 3])
+
+    def test_holes(self):
+        g = codegen.Segment()
+        g.byte(1)
+        g.lc = 8
+        g.word(0x05040302)
+        self.assertEqual(g.size(), 12)
+        self.assertEqual([start for start, _ in g.runs()], [0, 8])
+        self.assertEqual(g.getByte(4), 0)
+        self.assertEqual(g.getWord(8), 0x05040302)
+        self.assertEqual(list(g.buf), [1, 0, 0, 0, 0, 0, 0, 0, 2, 3, 4, 5])
+
+    def test_filling_a_hole_merges_runs(self):
+        g = codegen.Segment()
+        g.lc = 4
+        g.byte(2)
+        g.lc = 0
+        g.advance(4, 0xCC)
+        self.assertEqual(len(g.runs()), 1)
+        self.assertEqual(list(g.buf), [0xCC, 0xCC, 0xCC, 0xCC, 2])
+
+    def test_export_holes(self):
+        b = StringIO.StringIO()
+        g = codegen.Segment()
+        g.lc = 3
+        g.byte(7)
+        codegen.RawExporter(b).exportSegment(g)
+        self.assertEqual(b.getvalue(), "\x00\x00\x00\x07")
+
+    def test_export_sections(self):
+        b = StringIO.StringIO()
+        text = codegen.Segment()
+        text.byte(1)
+        vectors = codegen.Segment("vectors", 4)
+        vectors.byte(2)
+        codegen.RawExporter(b, 0xCC).exportSections([vectors, text])
+        self.assertEqual(b.getvalue(), "\x01\xCC\xCC\xCC\x02")
+
+    def test_overlapping_sections(self):
+        text = codegen.Segment()
+        text.word(0)
+        data = codegen.Segment("data", 2)
+        data.byte(0)
+        with self.assertRaises(Exception):
+            codegen.sectionRuns([text, data])
+
     def test_putR(self):
         g = codegen.Segment()
         g.putR(0xFFFFFFFF, 0, 0, 0)
@@ -114,5 +217,155 @@ class TestSegment(unittest.TestCase):
         self.assertEquals(g.getWord(0), 0x1234557F)
 
 
+def randomField(rng):
+    """A field value, usually in range for some instruction field, sometimes
+    wildly out of range or negative."""
+    choice = rng.random()
+    if choice < 0.6:
+        return rng.randrange(1 << rng.choice([5, 12, 13, 21, 32]))
+    if choice < 0.9:
+        return rng.randrange(-(1 << 21), 1 << 21)
+    return rng.randrange(-(1 << 62), 1 << 62)
+
+
+class TestBatchEncoders(unittest.TestCase):
+    """The batch encoders must agree with the scalar ones bit for bit."""
+
+    batches = [
+        (codegen.encodeR, codegen._toR, 4),
+        (codegen.encodeS, codegen._toS, 4),
+        (codegen.encodeSB, codegen._toSB, 4),
+        (codegen.encodeI, codegen._toI, 4),
+        (codegen.encodeUJ, codegen._toUJ, 3),
+        (codegen.encodeU, codegen._toU, 3),
+    ]
+
+    def check(self, seed):
+        rng = random.Random(seed)
+        for batch, scalar, arity in self.batches:
+            fields = [
+                [randomField(rng) for _ in range(500)] for _ in range(arity)
+            ]
+            expected = [w & 0xFFFFFFFF for w in map(scalar, *fields)]
+            self.assertEqual(
+                [int(w) for w in batch(*fields)], expected, scalar.__name__
+            )
+
+    def test_corpus(self):
+        for seed in range(20):
+            self.check(seed)
+
+    def test_corpus_without_numpy(self):
+        numpy = codegen.numpy
+        codegen.numpy = None
+        try:
+            for seed in range(20):
+                self.check(seed)
+        finally:
+            codegen.numpy = numpy
+
+    def test_scatter(self):
+        words = codegen.wordArray(4)
+        codegen.scatter(words, [3, 1], codegen.encodeU(
+            [0x37, 0x37], [1, 2], [0x1000, 0x2000]
+        ))
+        g = codegen.Segment()
+        g.advance(20, 0xFF)
+        g.putWords(4, words)
+        self.assertEqual(g.lc, 20)
+        self.assertEqual(
+            [g.getWord(at) for at in range(4, 20, 4)],
+            [0, 0x00002137, 0, 0x000010B7]
+        )
+
+
+
+def execute(words, pc):
+    """
+    Run a straight-line sequence of the instructions the pseudo-instruction
+    sequences use, returning the registers and where control ends up.
+    """
+    mask = (1 << 64) - 1
+    regs = [0] * 32
+    for w in words:
+        opcode, rd, f3 = w & 0x7F, (w >> 7) & 0x1F, (w >> 12) & 7
+        rs1 = regs[(w >> 15) & 0x1F]
+        imm = codegen._signed(w >> 20, 12)
+        upper = codegen._signed(w & 0xFFFFF000, 32)
+        nextPC = pc + 4
+        if opcode == 0x37:
+            v = upper
+        elif opcode == 0x17:
+            v = pc + upper
+        elif opcode == 0x13 and f3 == 0:
+            v = rs1 + imm
+        elif opcode == 0x1B:
+            v = codegen._signed(rs1 + imm, 32)
+        elif opcode == 0x13 and f3 == 1:
+            v = rs1 << (imm & 0x3F)
+        elif opcode == 0x13 and f3 == 5:
+            v = (rs1 & mask) >> (imm & 0x3F)
+        elif opcode == 0x6F:
+            v, nextPC = pc + 4, pc + codegen._signed(
+                ((w >> 31) << 20) | (((w >> 21) & 0x3FF) << 1) |
+                (((w >> 20) & 1) << 11) | (((w >> 12) & 0xFF) << 12), 21
+            )
+        elif opcode == 0x67:
+            v, nextPC = pc + 4, (rs1 + imm) & ~1
+        else:
+            raise Exception("Unexpected instruction {:08X}".format(w))
+        if rd:
+            regs[rd] = v & mask
+        pc = nextPC & mask
+    return regs, pc
+
+
+class TestPseudoSequences(unittest.TestCase):
+    def values(self, seed, count=5000):
+        rng = random.Random(seed)
+        for _ in range(count):
+            bits = rng.randrange(1, 65)
+            v = rng.getrandbits(bits) << rng.randrange(64 - bits + 1)
+            yield v if rng.random() < 0.5 else -v
+
+    def test_load_immediate(self):
+        mask = (1 << 64) - 1
+        for v in self.values(16):
+            words = codegen.loadImmediate(5, v)
+            self.assertTrue(len(words) <= 8)
+            self.assertEqual(execute(words, 0)[0][5], v & mask, hex(v))
+
+    def test_shortest_sequences(self):
+        lengths = [
+            (0, 1), (-2048, 1), (2047, 1), (2048, 2), (0x12345000, 1),
+            (0x7FFFFFFF, 2), (0x80000000, 2), (0xFFFFFFFF, 3),
+            (-0x100000, 1), (1 << 63, 2), (0xFFFFFFFFFFF00000, 1),
+        ]
+        for v, length in lengths:
+            self.assertEqual(len(codegen.loadImmediate(5, v)), length, hex(v))
+
+    def test_load_address(self):
+        mask = (1 << 64) - 1
+        pc = 0xFFFFFFFFFFF01000
+        for v in self.values(17, 1000):
+            words = codegen.loadAddress(6, v, pc)
+            self.assertEqual(execute(words, pc)[0][6], v & mask, hex(v))
+        # Nearby addresses are reached relative to the PC.
+        self.assertEqual(len(codegen.loadAddress(6, pc + 0x1000, pc)), 1)
+        self.assertEqual(len(codegen.loadAddress(6, pc + 0x1234, pc)), 2)
+
+    def test_call(self):
+        mask = (1 << 64) - 1
+        pc = 0x40000
+        for v in self.values(18, 1000):
+            target = v & mask & ~1
+            words = codegen.callSequence(target, pc)
+            regs, end = execute(words, pc)
+            self.assertEqual(end, target, hex(target))
+            self.assertEqual(regs[1], pc + 4 * len(words))
+        self.assertEqual(len(codegen.callSequence(pc + 0xFFFFE, pc)), 1)
+        self.assertEqual(len(codegen.callSequence(pc - 0x100002, pc)), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
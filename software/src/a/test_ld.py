@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import a
+import ld
+import objfile
+
+
+main = """\
+start:	addi	1, 0, message
+	lui	2, message
+	jal	0, func
+	bne	1, 2, start
+	beq	1, 2, func
+	word	message+4, counter
+"""
+
+lib = """\
+func:	addi	1, 1, 1
+	sd	1, counter(0)
+	jal	0, start
+message: byte	1, 2, 3, 4
+"""
+
+data = """\
+	section	data{}
+counter: dword	start
+	section	vectors, $400
+	jal	0, start
+"""
+
+
+class TestLinker(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, text):
+        with open(self.path(name), "w") as f:
+            f.write(text)
+
+    def assemble(self, source, output, *flags):
+        asm = a.Assembler([
+            "a", "from", self.path(source), "to", self.path(output),
+            "nocache", "quiet"
+        ] + list(flags))
+        asm.main()
+        return asm
+
+    def image(self, name):
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    def test_object_file(self):
+        self.write("main.asm", main + data.format(""))
+        self.assemble("main.asm", "main.o", "object")
+        with open(self.path("main.o"), "rb") as f:
+            obj = objfile.ObjectFile.read(f)
+        text, data_, vectors = obj.sections
+        self.assertEqual((text.base, text.size, text.align), (None, 28, 4))
+        self.assertEqual(vectors.base, 0x400)
+        # The branch back to start lies within the section, so needs none.
+        self.assertEqual(text.relocations, [
+            (0, objfile.R_I, ("symbol", "message"), 0),
+            (4, objfile.R_U, ("symbol", "message"), 0),
+            (8, objfile.R_UJ, ("symbol", "func"), 0),
+            (16, objfile.R_SB, ("symbol", "func"), 0),
+            (20, objfile.R_WORD, ("symbol", "message"), 4),
+            (24, objfile.R_WORD, ("section", "data"), 0),
+        ])
+        self.assertEqual(obj.symbols["start"], (("section", "text"), 0))
+        self.assertEqual(obj.symbols["counter"], (("section", "data"), 0))
+
+    def test_link_matches_whole_program(self):
+        self.write("main.asm", main + data.format(""))
+        self.write("lib.asm", lib)
+        self.write("all.asm", main + lib + data.format(", 48"))
+        self.assemble("main.asm", "main.o", "object")
+        self.assemble("lib.asm", "lib.o", "object")
+        self.assemble("all.asm", "all.bin")
+        linker = ld.Linker([
+            "ld", self.path("main.o"), self.path("lib.o"),
+            "to", self.path("linked.bin")
+        ])
+        self.assertEqual(linker.main(), 0)
+        self.assertEqual(self.image("linked.bin"), self.image("all.bin"))
+
+    def test_failed_link_leaves_output_alone(self):
+        self.write("lib.asm", lib + "start:\ncounter:\n")
+        self.assemble("lib.asm", "lib.o", "object")
+        self.write("linked.bin", "old")
+        export = ld.codegen.RawExporter.exportSections
+
+        def fail(exporter, segs):
+            raise IOError("disk full")
+
+        ld.codegen.RawExporter.exportSections = fail
+        try:
+            linker = ld.Linker([
+                "ld", self.path("lib.o"), "to", self.path("linked.bin")
+            ])
+            self.assertRaises(IOError, linker.main)
+        finally:
+            ld.codegen.RawExporter.exportSections = export
+        self.assertEqual(self.image("linked.bin"), "old")
+        self.assertEqual(sorted(os.listdir(self.dir)), [
+            "lib.asm", "lib.o", "linked.bin",
+        ])
+
+    def test_placement(self):
+        self.write("lib.asm", lib + "start:\ncounter:\n")
+        self.assemble("lib.asm", "lib.o", "object")
+        linker = ld.Linker(["ld", self.path("lib.o"), "at", "text", "0x100"])
+        linker.parseArgs()
+        linker.load(self.path("lib.o"))
+        seg, = linker.link()
+        self.assertEqual(seg.runs()[0][0], 0x100)
+        # jal 0, start: start is at $110, the jal at $108.
+        self.assertEqual(seg.getWord(0x108), 0x0080006F)
+
+    def test_undefined_symbol(self):
+        self.write("main.asm", main + data.format(""))
+        self.assemble("main.asm", "main.o", "object")
+        linker = ld.Linker(["ld", self.path("main.o")])
+        linker.parseArgs()
+        linker.load(self.path("main.o"))
+        with self.assertRaises(Exception):
+            linker.link()
+
+    def test_unrelocatable_expression(self):
+        self.write("main.asm", "\tword\tfunc*2\n")
+        with self.assertRaises(Exception):
+            self.assemble("main.asm", "main.o", "object")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import random
+import unittest
+
+import codegen
+import rvc
+
+
+# Instructions with their compressed encodings, as laid down by the GNU
+# assembler.
+knownPairs = [
+    (0x00000013, 0x0001),   # nop
+    (0x00100513, 0x4505),   # li a0, 1
+    (0xFF010113, 0x1141),   # addi sp, sp, -16
+    (0xFD010113, 0x7179),   # addi sp, sp, -48
+    (0x00810513, 0x0028),   # addi a0, sp, 8
+    (0x00001537, 0x6505),   # lui a0, 1
+    (0x02051513, 0x1502),   # slli a0, a0, 32
+    (0x02055513, 0x9101),   # srli a0, a0, 32
+    (0x00B00533, 0x852E),   # mv a0, a1
+    (0x00B50533, 0x952E),   # add a0, a0, a1
+    (0x00B57533, 0x8D6D),   # and a0, a0, a1
+    (0x00B5053B, 0x9D2D),   # addw a0, a0, a1
+    (0x00052783, 0x411C),   # lw a5, 0(a0)
+    (0x00F52023, 0xC11C),   # sw a5, 0(a0)
+    (0x00813083, 0x60A2),   # ld ra, 8(sp)
+    (0x00113423, 0xE406),   # sd ra, 8(sp)
+    (0x00008067, 0x8082),   # ret
+    (0xFF9FF06F, 0xBFE5),   # j .-8
+    (0x00050363, 0xC119),   # beqz a0, .+6
+    (0x00100073, 0x9002),   # ebreak
+    (0x00A00023, None),     # sb a0, 0(x0)
+    (0x00001137, None),     # lui sp, 1
+    (0x00058513, None),     # addi a0, a1, 0
+]
+
+
+def randomWord(rng):
+    """
+    A random instruction, drawn from the opcodes which may compress, with
+    fields biased towards the ranges which do.
+    """
+    reg = lambda: rng.choice([0, 1, 2, 8, 9, 15, rng.randrange(32)])
+    imm = lambda: rng.choice([0, 4, 8, -16, 1020, rng.randrange(-64, 64),
+                              rng.randrange(-4096, 4096)])
+    kind = rng.randrange(8)
+    rd, rs1, rs2 = reg(), reg(), reg()
+    if rng.random() < 0.5:
+        rs1 = rd
+    if kind == 0:
+        f3 = rng.choice([0, 1, 5, 7])
+        top = rng.choice([0, 0x400]) if f3 == 5 else 0
+        value = rng.randrange(64) | top if f3 in (1, 5) else imm() & 0xFFF
+        opcode = rng.choice([0x13, 0x1B])
+        return codegen._toI(opcode | (f3 << 12), rd, rs1, value)
+    if kind == 1:
+        f7 = rng.choice([0, 0x20])
+        f3 = rng.choice([0, 4, 6, 7])
+        opcode = rng.choice([0x33, 0x3B])
+        return codegen._toR((f7 << 25) | (f3 << 12) | opcode, rd, rs1, rs2)
+    if kind == 2:
+        f3 = rng.choice([2, 3])
+        return codegen._toI(0x03 | (f3 << 12), rd, rs1, imm() & 0xFFF)
+    if kind == 3:
+        f3 = rng.choice([2, 3])
+        return codegen._toS(0x23 | (f3 << 12), rs2, rs1, imm() & 0xFFF)
+    if kind == 4:
+        return codegen._toI(0x67, rng.choice([0, 1, rd]), rs1, imm() & 0xFFF)
+    if kind == 5:
+        return codegen._toUJ(0x6F, rng.choice([0, rd]), imm() * 2) & 0xFFFFFFFF
+    if kind == 6:
+        f3 = rng.choice([0, 1, 4])
+        return codegen._toSB(0x63 | (f3 << 12), rs1, rng.choice([0, rs2]),
+                             imm() & ~1) & 0xFFFFFFFF
+    return codegen._toU(0x37, rd, (rng.randrange(-40, 40) << 12))
+
+
+class TestCompression(unittest.TestCase):
+    def test_known_encodings(self):
+        for word, half in knownPairs:
+            self.assertEqual(rvc.compress(word), half, hex(word))
+            if half is not None:
+                self.assertEqual(rvc.expand(half), word, hex(half))
+
+    def test_round_trip(self):
+        rng = random.Random(15)
+        forms = set()
+        for _ in range(20000):
+            word = randomWord(rng)
+            half = rvc.compress(word)
+            if half is None:
+                continue
+            self.assertTrue(0 <= half < 0x10000 and half & 3 != 3)
+            self.assertEqual(rvc.expand(half), word,
+                             "{:08X} -> {:04X}".format(word, half))
+            forms.add((half & 3, half >> 13))
+        # Every quadrant and funct3 used by compress has been exercised.
+        self.assertEqual(len(forms), 19)
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            rvc.expand(0x0000)
+        with self.assertRaises(ValueError):
+            rvc.expand(0x8002)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""Throughput benchmark for bin2v.
+
+USAGE: bench_bin2v.py [<megabytes>]
+
+Converts an image of random bytes, 4 MB unless told otherwise, to a hex
+file at several widths, with and without byte swapping, and reports the
+best of several runs in MB/s of input.  The original byte-at-a-time
+converter is measured alongside, and its output compared with bin2v's.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+from cStringIO import StringIO
+
+import bin2v
+
+
+def reference_hex(input_file, output_file, width, byte_swap):
+    """The hex converter as bin2v first had it, one line at a time."""
+    while True:
+        input_data = input_file.read(width)
+        if len(input_data) < 1:
+            break
+        input_xform = ["%02X" % (ord(x)) for x in input_data]
+        if byte_swap:
+            input_xform.reverse()
+        output_file.write("%s\n" % (''.join(input_xform)))
+
+
+def best(fn, repeat=3):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def convert(converter, image, width, byte_swap):
+    output = StringIO()
+    converter(StringIO(image), output, width, byte_swap)
+    return output.getvalue()
+
+
+def main(args):
+    megabytes = float(args[1]) if len(args) > 1 else 4
+    image = os.urandom(int(megabytes * 1024 * 1024))
+    for width in (1, 2, 4, 8):
+        for byte_swap in (False, True):
+            name = "bytes {}{}".format(width, " swap" if byte_swap else "")
+            timings = []
+            for converter in (reference_hex, bin2v.write_hex):
+                seconds = best(
+                    lambda: convert(converter, image, width, byte_swap)
+                )
+                timings.append(megabytes / seconds)
+            same = (
+                convert(reference_hex, image, width, byte_swap) ==
+                convert(bin2v.write_hex, image, width, byte_swap)
+            )
+            print("{:<14} {:8.1f} MB/s (was {:6.1f} MB/s) output {}".format(
+                name, timings[1], timings[0],
+                "identical" if same else "DIFFERS"
+            ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,17 +1,374 @@
 #!/usr/bin/env python
 
+import binascii
+import mmap
 import os
+import stat
 import sys
-from math import floor, log
+from fractions import gcd
 
 DEBUG=True
 
+# Hex files are converted this many bytes of input at a time.
+BLOCK_SIZE = 1 << 20
+
+
+def swap_bytes(data, width):
+    """Reverse the order of the bytes within each width-byte word of data,
+    whose length must be a multiple of width."""
+    data = bytearray(data)
+    if width == 1:
+        return data
+    swapped = bytearray(len(data))
+    for k in range(width):
+        swapped[k::width] = data[width-1-k::width]
+    return swapped
+
+
+def hex_words(data, width, byte_swap):
+    """Format data as hex, one width-byte word per line.  The length of
+    data must be a multiple of width.  Rather than formatting each byte in
+    turn, the whole block is converted at once, and each column of digits
+    copied into place with a single slice assignment."""
+    if byte_swap:
+        data = swap_bytes(data, width)
+    digits = binascii.hexlify(data).upper()
+    stride = 2 * width
+    count = len(digits) // stride
+    lines = bytearray(count * (stride + 1))
+    for k in range(stride):
+        lines[k::stride+1] = digits[k::stride]
+    lines[stride::stride+1] = "\n" * count
+    return lines
+
+
+def hex_lines(data, width, byte_swap):
+    """Format data as hex, width bytes per line.  Any bytes left over after
+    the last whole word appear on a shorter line of their own."""
+    whole = len(data) - len(data) % width
+    lines = hex_words(data[:whole], width, byte_swap)
+    if whole < len(data):
+        tail = bytearray(data[whole:])
+        if byte_swap:
+            tail.reverse()
+        lines.extend(binascii.hexlify(tail).upper() + "\n")
+    return lines
+
+
+class Output(object):
+    """One file written from the input.  The input is taken lanes bytes at
+    a time, and the byte at offset lane of each group goes to this output,
+    so that an image can be split into byte lanes; with a single lane, the
+    output sees the whole input.  Those bytes are then written width at a
+    time, either as a Verilog hex file or, in bin format, as raw binary for
+    a device programmer.  With byte_swap, the bytes of each word are
+    written in reverse order."""
+
+    def __init__(self, output_file, width=1, byte_swap=False, lane=0,
+                 lanes=1, format="hex"):
+        self.output_file = output_file
+        self.width = width
+        self.byte_swap = byte_swap
+        self.lane = lane
+        self.lanes = lanes
+        self.format = format
+
+    def group(self):
+        """How many bytes of input make up one word of output."""
+        return self.width * self.lanes
+
+    def write(self, data):
+        """Write the words taken from data.  Only the last data written
+        may fall short of a whole number of groups; the bytes of its last,
+        partial word are written as they are."""
+        if self.lanes > 1:
+            data = data[self.lane::self.lanes]
+        if self.format == "hex":
+            self.output_file.write(hex_lines(data, self.width, self.byte_swap))
+        elif self.byte_swap:
+            whole = len(data) - len(data) % self.width
+            swapped = swap_bytes(data[:whole], self.width)
+            swapped.extend(reversed(bytearray(data[whole:])))
+            self.output_file.write(swapped)
+        else:
+            self.output_file.write(data)
+
+
+def write_outputs(input_file, outputs):
+    """Convert the whole of input_file to every one of outputs in a single
+    pass, reading a block at a time.  Each block handed on holds whole
+    words for every output; what is left of the input at its end is
+    handed on last, partial words and all."""
+    group = 1
+    for output in outputs:
+        group = group * output.group() // gcd(group, output.group())
+    size = max(BLOCK_SIZE - BLOCK_SIZE % group, group)
+    carry = ""
+    while True:
+        block = input_file.read(size)
+        if len(block) < 1:
+            break
+        data = carry + block if carry else block
+        whole = len(data) - len(data) % group
+        for output in outputs:
+            output.write(data[:whole])
+        carry = data[whole:]
+    if carry:
+        for output in outputs:
+            output.write(carry)
+
+
+def write_hex(input_file, output_file, width, byte_swap):
+    """Convert the whole of input_file to a Verilog hex file, width bytes
+    per line, reading, formatting and writing a block at a time."""
+    write_outputs(input_file, [Output(output_file, width, byte_swap)])
+
+
+def case_labels(start, stop, address_width):
+    """Cover the addresses from start up to stop with as few casez labels
+    as possible.  Each label matches an aligned block of a power of two
+    addresses, its low bits left as don't-cares."""
+    labels = []
+    while start < stop:
+        size = start & -start if start else 1 << address_width
+        while size > stop - start:
+            size = size >> 1
+        if size == 1:
+            labels.append("%d'd%d" % (address_width, start))
+        else:
+            free = size.bit_length() - 1
+            prefix = bin(start >> free)[2:].zfill(address_width - free)
+            if free == address_width:
+                prefix = ""
+            labels.append("%d'b%s%s" % (address_width, prefix, "?" * free))
+        start = start + size
+    return labels
+
+
+def compressed_arms(words, address_width, data_width):
+    """Build the case arms for a ROM holding words, with every address of
+    the same value under a single arm.  If the ROM fills the address space,
+    its most common value becomes the default arm, and needs no labels at
+    all; otherwise, addresses past its end must match no arm, as before.
+    Returns the arms, and how many fewer there are than one per word."""
+    first = {}
+    counts = {}
+    for n, word in enumerate(words):
+        first.setdefault(word, n)
+        counts[word] = counts.get(word, 0) + 1
+
+    default = None
+    if len(words) == 1 << address_width:
+        default = max(counts, key=lambda w: (counts[w], -first[w]))
+
+    labels = {}
+    start = 0
+    for n in range(1, len(words) + 1):
+        if n < len(words) and words[n] == words[start]:
+            continue
+        if words[start] != default:
+            labels.setdefault(words[start], []).extend(
+                case_labels(start, n, address_width)
+            )
+        start = n
+
+    arms = [
+        "\t\t%s: dat_o = %d'h%s;\n" % (", ".join(labels[word]), data_width, word)
+        for word in sorted(labels, key=first.get)
+    ]
+    if default is not None:
+        arms.append("\t\tdefault: dat_o = %d'h%s;\n" % (data_width, default))
+    return arms, len(words) - len(arms)
+
+
+# With readmemh, module mode emits a memory array initialized from a hex
+# file instead of a case statement, with a registered read port, so that
+# synthesis infers block RAM.  Each access is acknowledged the cycle after
+# it is strobed, once its data is ready.
+MEMORY_MODULE = """`timescale 1ns / 1ps
+
+module %(name)s(
+\tinput\t\tclk_i,
+\tinput\t[%(high)d:%(low)d]\tadr_i,
+\tinput\t\tstb_i,
+\toutput\t\tack_o,
+\toutput\t[%(msb)d:0]\tdat_o
+);
+\treg\t[%(msb)d:0]\tmem[0:%(last)d];
+\treg\t[%(msb)d:0]\tdat_o;
+\treg\t\tack_o;
+\tinitial $readmemh("%(hex)s", mem);
+\talways @(posedge clk_i) begin
+\t\tdat_o <= mem[adr_i];
+\t\tack_o <= stb_i & ~ack_o;
+\tend
+endmodule
+"""
+
+
+CASE_MODULE_HEADER = """`timescale 1ns / 1ps
+
+module %s(
+\tinput\t[%d:%d]\tadr_i,
+\tinput\t\tstb_i,
+\toutput\t\tack_o,
+\toutput\t[%d:0]\tdat_o
+);
+\treg\t[%d:0]\tdat_o;
+\tassign ack_o = stb_i;
+\talways @(*) begin
+\t\t%s(adr_i)
+"""
+
+CASE_MODULE_FOOTER = """\t\tendcase
+\tend
+endmodule
+"""
+
+
+def image_of(source):
+    """The bytes to convert from source, which is either a bytes-like object
+    or a segment from the assembler.  A segment is anything with a runs()
+    method listing its stored parts as (address, bytes) pairs, in address
+    order.  Its image begins at address zero, holes reading as zero, just
+    as the assembler writes it to a binary file."""
+    if hasattr(source, 'runs'):
+        runs = source.runs()
+        if not runs:
+            return bytearray()
+        start, run = runs[-1]
+        data = bytearray(start + len(run))
+        for start, run in runs:
+            data[start:start + len(run)] = run
+        return data
+    if isinstance(source, memoryview):
+        return source.tobytes()
+    return source
+
+
+def map_input(input_file):
+    """Map the whole of input_file into memory, for module mode, without
+    seeking it.  A regular file is mapped read-only as it stands; anything
+    else, such as a pipe, is spooled a block at a time into an anonymous
+    map, grown as needed and trimmed to fit at the end.  A file-like object
+    with no file descriptor is simply read."""
+    try:
+        status = os.fstat(input_file.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return input_file.read()
+    if stat.S_ISREG(status.st_mode):
+        if status.st_size < 1:
+            return ""
+        return mmap.mmap(input_file.fileno(), status.st_size,
+                         access=mmap.ACCESS_READ)
+
+    spool = None
+    size = 0
+    while True:
+        block = input_file.read(BLOCK_SIZE)
+        if len(block) < 1:
+            break
+        if spool is None:
+            spool = mmap.mmap(-1, BLOCK_SIZE)
+        elif size + len(block) > len(spool):
+            spool = grow_spool(spool, size)
+        spool[size:size + len(block)] = block
+        size = size + len(block)
+    if spool is None:
+        return ""
+    spool.resize(size)
+    return spool
+
+
+def grow_spool(spool, size):
+    """Move the first size bytes of an anonymous map into one twice as
+    large, a block at a time.  A shared anonymous map cannot simply be
+    resized larger: on Linux, touching the new pages raises SIGBUS."""
+    larger = mmap.mmap(-1, 2 * len(spool))
+    for offset in range(0, size, BLOCK_SIZE):
+        end = min(offset + BLOCK_SIZE, size)
+        larger[offset:end] = spool[offset:end]
+    spool.close()
+    return larger
+
+
+def blocks(data, width):
+    """Cut data into blocks of about BLOCK_SIZE bytes, each but the last a
+    whole number of width-byte words, so that a large image, memory mapped,
+    is only ever copied a block at a time."""
+    step = max(BLOCK_SIZE - BLOCK_SIZE % width, width)
+    for offset in range(0, len(data), step):
+        yield data[offset:offset + step]
+
+
+def convert(source, outputs):
+    """Format source, as for image_of, to every one of outputs."""
+    data = image_of(source)
+    for output in outputs:
+        output.write(data)
+
+
+def write_module(source, output_file, name, width=1, byte_swap=False,
+                 compress=False, hex_filename=None, hex_file=None):
+    """Write source, as for image_of, to output_file as a synthesizable
+    Verilog module returning one width-byte word per address.  The module
+    decodes its address with a case statement, compressed if asked; or, if
+    hex_filename is given, reads the ROM from that hex file into block RAM,
+    the hex file itself being written to hex_file.  Returns how many case
+    arms compression removed."""
+    data = image_of(source)
+    rom_size = len(data)
+    data_width = 8 * width
+    high_address_bit = (rom_size - 1).bit_length() - 1
+    low_address_bit = width.bit_length() - 1
+    address_width = high_address_bit - low_address_bit + 1
+
+    if hex_filename:
+        output_file.write(MEMORY_MODULE % {
+            'name': name,
+            'high': high_address_bit,
+            'low': low_address_bit,
+            'msb': data_width - 1,
+            'last': (rom_size - 1) // width,
+            'hex': hex_filename,
+        })
+        for block in blocks(data, width):
+            hex_file.write(hex_lines(block, width, byte_swap))
+        return 0
+
+    output_file.write(CASE_MODULE_HEADER % (
+        name, high_address_bit, low_address_bit, data_width-1, data_width-1,
+        "casez" if compress else "case"
+    ))
+    arm = "\t\t%d'd%%d: dat_o = %d'h%%s;\n" % (address_width, data_width)
+    words = []
+    offset = 0
+    for block in blocks(data, width):
+        block_words = str(hex_lines(block, width, byte_swap)).splitlines()
+        if compress:
+            words.extend(block_words)
+        else:
+            output_file.write("".join(
+                arm % pair for pair in enumerate(block_words, offset)
+            ))
+        offset = offset + len(block_words)
+    removed = 0
+    if compress:
+        arms, removed = compressed_arms(words, address_width, data_width)
+        output_file.write("".join(arms))
+    output_file.write(CASE_MODULE_FOOTER)
+    return removed
+
+
 def main(args):
     input_filename = None
     output_filename = None
     byte_swap = False
     bytes_at_a_time = None
     module_name = None
+    hex_filename = None
+    compress = False
+    outputs = []
 
     def usage():
         cmd = args[0]
@@ -24,6 +381,14 @@ def main(args):
         print "    (keywords required)"
         print "          (byte)swap      - Switch byte arrangement per line"
         print "          module <name>   - Emit synthesizable Verilog module instead of Verilog hex file."
+        print "          readmemh <file> - In module mode, read the ROM from a hex file, also written, into block RAM."
+        print "          compress        - In module mode, give each distinct value one case arm, the commonest as default."
+        print "          output <file>   - Also write file, in the same pass.  The keywords after it, up to the"
+        print "                            next output, describe this file alone:"
+        print "              bytes <n>       - how many bytes per line, or per word in bin format."
+        print "              (byte)swap      - Switch byte arrangement per word."
+        print "              lane <k>/<n>    - Take byte k of each n bytes of input, for byte-laned memories."
+        print "              format <f>      - hex (the default) or bin, for raw binary."
         print "          help            - Produce this message."
 
     i = 1
@@ -39,7 +404,10 @@ def main(args):
             continue
 
         if (args[i] == 'bytes') and (len(args) > i+1):
-            bytes_at_a_time = int(args[i+1])
+            if outputs:
+                outputs[-1]['width'] = int(args[i+1])
+            else:
+                bytes_at_a_time = int(args[i+1])
             i = i + 2
             continue
 
@@ -48,12 +416,52 @@ def main(args):
             i = i + 2
             continue
 
-        if (args[i] in ['from', 'to', 'bytes', 'module']) and (len(args) <= i+1):
+        if (args[i] == 'readmemh') and (len(args) > i+1):
+            hex_filename = args[i+1]
+            i = i + 2
+            continue
+
+        if (args[i] == 'output') and (len(args) > i+1):
+            outputs.append({
+                'filename': args[i+1], 'width': 1, 'byte_swap': False,
+                'lane': 0, 'lanes': 1, 'format': 'hex',
+            })
+            i = i + 2
+            continue
+
+        if (args[i] in ['lane', 'format']) and (len(args) > i+1):
+            if not outputs:
+                sys.stderr.write("%s describes an output; name it first\n" % (args[i]))
+                return 1
+            if args[i] == 'lane':
+                lane, _, lanes = args[i+1].partition('/')
+                if not (lane.isdigit() and lanes.isdigit() and int(lane) < int(lanes)):
+                    sys.stderr.write("Lane expected as <k>/<n>, k < n: %s\n" % (args[i+1]))
+                    return 1
+                outputs[-1]['lane'] = int(lane)
+                outputs[-1]['lanes'] = int(lanes)
+            else:
+                if args[i+1] not in ['hex', 'bin']:
+                    sys.stderr.write("Unknown format: %s\n" % (args[i+1]))
+                    return 1
+                outputs[-1]['format'] = args[i+1]
+            i = i + 2
+            continue
+
+        if (args[i] in ['from', 'to', 'bytes', 'module', 'readmemh', 'output', 'lane', 'format']) and (len(args) <= i+1):
             sys.stderr.write("Argument expected for %s parameter\n" % (args[i]))
             return 1
 
         if args[i] in ['swap', 'byteswap']:
-            byte_swap = True
+            if outputs:
+                outputs[-1]['byte_swap'] = True
+            else:
+                byte_swap = True
+            i = i + 1
+            continue
+
+        if args[i] == 'compress':
+            compress = True
             i = i + 1
             continue
 
@@ -82,68 +490,57 @@ def main(args):
     if not bytes_at_a_time:
         bytes_at_a_time = 1
 
-    if not input_filename:
-        input_file = sys.stdin
-    else:
-        input_file = file(input_filename, "rb")
-
-    if not output_filename:
-        output_file = sys.stdout
-    else:
-        output_file = file(output_filename, "w")
-
-    if not module_name:
-        while True:
-            input_data = input_file.read(bytes_at_a_time)
-            if len(input_data) < 1:
-                break
-            input_xform = ["%02X" % (ord(x)) for x in input_data]
-            if byte_swap:
-                input_xform.reverse()
-            output_file.write("%s\n" % (''.join(input_xform)))
-    else:
-        # Assertion: input_file supports seek and tell.
-        # Assertion: rom_size > 1 and rom_size in set(2, 4, 8, 16, ...)
-        # Assertion: bytes_at_a_time in set(1,2,4,8,...)
-
-        input_file.seek(0, os.SEEK_END)
-        rom_size = input_file.tell()
-        input_file.seek(0, os.SEEK_SET)
-
-        data_width = 8 * bytes_at_a_time
-        high_address_bit = floor(log(rom_size - 1) / log(2))
-        low_address_bit = floor(log(bytes_at_a_time) / log(2))
-        address_width = high_address_bit - low_address_bit + 1
-
-        output_file.write("""`timescale 1ns / 1ps
+    if outputs and module_name:
+        sys.stderr.write("output cannot be used with module\n")
+        return 1
 
-module %s(
-\tinput\t[%d:%d]\tadr_i,
-\tinput\t\tstb_i,
-\toutput\t\tack_o,
-\toutput\t[%d:0]\tdat_o
-);
-\treg\t[%d:0]\tdat_o;
-\tassign ack_o = stb_i;
-\talways @(*) begin
-\t\tcase(adr_i)
-""" % (module_name, high_address_bit, low_address_bit, data_width-1, data_width-1))
-        offset = 0
-        while True:
-            input_data = input_file.read(bytes_at_a_time)
-            if len(input_data) < 1:
-                break
-            input_xform = ["%02X" % (ord(x)) for x in input_data]
-            if byte_swap:
-                input_xform.reverse()
-            output_file.write("\t\t%d'd%d: dat_o = %d'h%s;\n" % (address_width, offset, data_width, ''.join(input_xform)))
-            offset = offset + 1
-        output_file.write("""\t\tendcase
-\tend
-endmodule
-""");
-    return 0
+    opened = []
+    try:
+        if not input_filename:
+            input_file = sys.stdin
+        else:
+            input_file = file(input_filename, "rb")
+            opened.append(input_file)
+
+        if not output_filename:
+            output_file = sys.stdout
+        else:
+            output_file = file(output_filename, "w")
+            opened.append(output_file)
+
+        if module_name:
+            hex_file = None
+            if hex_filename:
+                hex_file = file(hex_filename, "w")
+                opened.append(hex_file)
+            data = map_input(input_file)
+            if isinstance(data, mmap.mmap):
+                opened.append(data)
+            removed = write_module(
+                data, output_file, module_name, bytes_at_a_time, byte_swap,
+                compress, hex_filename, hex_file
+            )
+            if compress and not hex_filename:
+                words = (len(data) + bytes_at_a_time - 1) // bytes_at_a_time
+                sys.stderr.write("%d of %d case arms removed\n" % (removed, words))
+            return 0
 
+        # Extra outputs replace the default hex file on stdout.
+        streams = []
+        if output_filename or not outputs:
+            streams.append(Output(output_file, bytes_at_a_time, byte_swap))
+        for o in outputs:
+            extra = file(o['filename'], "wb" if o['format'] == 'bin' else "w")
+            opened.append(extra)
+            streams.append(Output(
+                extra, o['width'], o['byte_swap'], o['lane'], o['lanes'],
+                o['format']
+            ))
+        write_outputs(input_file, streams)
+        return 0
+    finally:
+        for f in opened:
+            f.close()
 
 if __name__ == '__main__':
     rc = main(sys.argv)
@@ -0,0 +1,308 @@
+import os
+import random
+import re
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import bin2v
+
+
+def hexOf(data, width, swap=False):
+    output = StringIO()
+    bin2v.write_hex(StringIO(data), output, width, swap)
+    return output.getvalue()
+
+
+class TestHex(unittest.TestCase):
+    def test_widths(self):
+        data = "\x01\x23\x45\x67\x89\xAB\xCD\xEF"
+        self.assertEqual(hexOf(data, 1), "01\n23\n45\n67\n89\nAB\nCD\nEF\n")
+        self.assertEqual(hexOf(data, 2), "0123\n4567\n89AB\nCDEF\n")
+        self.assertEqual(hexOf(data, 4, True), "67452301\nEFCDAB89\n")
+        self.assertEqual(hexOf(data, 8, True), "EFCDAB8967452301\n")
+
+    def test_partial_last_line(self):
+        data = "\x01\x02\x03\x04\x05"
+        self.assertEqual(hexOf(data, 2), "0102\n0304\n05\n")
+        self.assertEqual(hexOf(data, 4, True), "04030201\n05\n")
+        self.assertEqual(hexOf(data[:3], 4, True), "030201\n")
+        self.assertEqual(hexOf("", 4), "")
+
+    def test_block_boundaries(self):
+        data = os.urandom(1000)
+        expected = [hexOf(data, w, s) for w in (1, 2, 4, 8) for s in (0, 1)]
+        size = bin2v.BLOCK_SIZE
+        bin2v.BLOCK_SIZE = 7
+        try:
+            found = [hexOf(data, w, s) for w in (1, 2, 4, 8) for s in (0, 1)]
+        finally:
+            bin2v.BLOCK_SIZE = size
+        self.assertEqual(found, expected)
+
+
+class TestOutputs(unittest.TestCase):
+    def convert(self, data, *specs):
+        outputs = [bin2v.Output(StringIO(), *spec) for spec in specs]
+        bin2v.write_outputs(StringIO(data), outputs)
+        return [o.output_file.getvalue() for o in outputs]
+
+    def test_lanes(self):
+        data = "\x01\x02\x03\x04\x05\x06\x07"
+        self.assertEqual(self.convert(data, (1, False, 0, 2), (1, False, 1, 2)), [
+            "01\n03\n05\n07\n", "02\n04\n06\n",
+        ])
+        self.assertEqual(self.convert(data, (2, True, 1, 2, "bin")), [
+            "\x04\x02\x06",
+        ])
+
+    def test_widths_in_one_pass(self):
+        data = "".join(chr(n % 251) for n in range(3 * 4096 + 5))
+        saved = bin2v.BLOCK_SIZE
+        bin2v.BLOCK_SIZE = 4096
+        try:
+            hex2, hex4, odd = self.convert(
+                data, (2, False), (4, True), (3, False, 1, 2, "bin")
+            )
+        finally:
+            bin2v.BLOCK_SIZE = saved
+        self.assertEqual(hex2, hexOf(data, 2))
+        self.assertEqual(hex4, hexOf(data, 4, True))
+        self.assertEqual(odd, data[1::2])
+
+
+class FakeSegment(object):
+    """Stands in for the assembler's codegen.Segment."""
+
+    def __init__(self, runs):
+        self._runs = runs
+
+    def runs(self):
+        return self._runs
+
+
+class TestLibrary(unittest.TestCase):
+    def test_image_of_segment(self):
+        segment = FakeSegment([(2, bytearray("\x01\x02")), (6, bytearray("\x03"))])
+        self.assertEqual(bin2v.image_of(segment), "\x00\x00\x01\x02\x00\x00\x03")
+        self.assertEqual(bin2v.image_of(FakeSegment([])), "")
+        self.assertEqual(bin2v.image_of(memoryview("\x01")), "\x01")
+
+    def test_convert(self):
+        even, odd = StringIO(), StringIO()
+        bin2v.convert(FakeSegment([(1, bytearray("\x01\x02\x03"))]), [
+            bin2v.Output(even, 1, False, 0, 2),
+            bin2v.Output(odd, 1, False, 1, 2, "bin"),
+        ])
+        self.assertEqual(even.getvalue(), "00\n02\n")
+        self.assertEqual(odd.getvalue(), "\x01\x03")
+
+    def test_module_matches_command_line(self):
+        data = "".join(chr(n) for n in range(64))
+        output = StringIO()
+        bin2v.write_module(bytearray(data), output, "rom", 4, True)
+        directory = tempfile.mkdtemp()
+        try:
+            binary = os.path.join(directory, "x.bin")
+            verilog = os.path.join(directory, "x.v")
+            with open(binary, "wb") as f:
+                f.write(data)
+            bin2v.main(["bin2v", binary, verilog, "4", "swap", "module", "rom"])
+            with open(verilog) as f:
+                self.assertEqual(output.getvalue(), f.read())
+        finally:
+            shutil.rmtree(directory)
+        self.assertIn("\t\t4'd15: dat_o = 32'h3F3E3D3C;\n", output.getvalue())
+
+    def test_readmemh_module(self):
+        output, hex_file = StringIO(), StringIO()
+        bin2v.write_module("\x01\x02\x03\x04", output, "rom", 2,
+                           hex_filename="rom.hex", hex_file=hex_file)
+        self.assertIn('$readmemh("rom.hex", mem);', output.getvalue())
+        self.assertEqual(hex_file.getvalue(), "0102\n0304\n")
+
+
+class TestMapInput(unittest.TestCase):
+    def setUp(self):
+        self.saved = bin2v.BLOCK_SIZE
+        bin2v.BLOCK_SIZE = 4096
+
+    def tearDown(self):
+        bin2v.BLOCK_SIZE = self.saved
+
+    def test_regular_file(self):
+        data = os.urandom(10000)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            mapped = bin2v.map_input(f)
+            self.assertIsInstance(mapped, bin2v.mmap.mmap)
+            self.assertEqual(mapped[:], data)
+            mapped.close()
+
+    def test_pipe(self):
+        data = os.urandom(3 * 4096 + 17)
+        r, w = os.pipe()
+        # Small enough to fit in the pipe before anything reads it.
+        os.write(w, data)
+        os.close(w)
+        with os.fdopen(r, "rb") as f:
+            mapped = bin2v.map_input(f)
+        self.assertIsInstance(mapped, bin2v.mmap.mmap)
+        self.assertEqual(len(mapped), len(data))
+        self.assertEqual(mapped[:], data)
+
+    def test_empty_and_unmappable(self):
+        r, w = os.pipe()
+        os.close(w)
+        with os.fdopen(r, "rb") as f:
+            self.assertEqual(bin2v.map_input(f), "")
+        self.assertEqual(bin2v.map_input(StringIO("\x01\x02")), "\x01\x02")
+
+    def test_module_by_blocks(self):
+        data = os.urandom(3 * 4096 + 6)
+        words = [data[n:n+4][::-1].encode("hex").upper()
+                 for n in range(0, len(data), 4)]
+        output = StringIO()
+        bin2v.write_module(data, output, "rom", 4, True)
+        arms = re.findall(r"(\d+)'d(\d+): dat_o = 32'h(\w+);", output.getvalue())
+        self.assertEqual([int(n) for _, n, _ in arms], range(len(words)))
+        self.assertEqual([w for _, _, w in arms], words)
+        self.assertEqual(set(a for a, _, _ in arms), set(["12"]))
+
+
+def caseTable(module, addressWidth):
+    """Evaluate the case statement of a module for every address, giving
+    None where no arm matches."""
+    arms = re.findall(r"\t\t(.*): dat_o = \d+'h(\w+);", module)
+    table = []
+    for address in range(1 << addressWidth):
+        bits = bin(address)[2:].zfill(addressWidth)
+        value = None
+        for labels, word in arms:
+            for label in labels.split(", "):
+                if label == "default":
+                    matched = True
+                elif "'d" in label:
+                    matched = int(label.split("'d")[1]) == address
+                else:
+                    pattern = label.split("'b")[1]
+                    matched = all(p in ("?", b) for p, b in zip(pattern, bits))
+                if matched:
+                    break
+            else:
+                continue
+            value = word
+            break
+        table.append(value)
+    return table
+
+
+class TestCompressedCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def module(self, data, width, *flags):
+        binary = os.path.join(self.dir, "x.bin")
+        verilog = os.path.join(self.dir, "x.v")
+        with open(binary, "wb") as f:
+            f.write(data)
+        bin2v.main(["bin2v", "from", binary, "to", verilog, "bytes",
+                    str(width), "module", "rom"] + list(flags))
+        with open(verilog) as f:
+            return f.read()
+
+    def test_labels(self):
+        self.assertEqual(bin2v.case_labels(0, 16, 4), ["4'b????"])
+        self.assertEqual(bin2v.case_labels(3, 14, 4), [
+            "4'd3", "4'b01??", "4'b10??", "4'b110?",
+        ])
+        self.assertEqual(bin2v.case_labels(5, 6, 4), ["4'd5"])
+
+    def test_equivalent_to_one_arm_per_word(self):
+        rng = random.Random(22)
+        for size in (64, 256, 200):
+            words = []
+            while len(words) < size:
+                words.extend([rng.choice("\x00\xCC\x12\x34")] *
+                             rng.choice([1, 1, 2, 5, 16]))
+            data = "".join(words[:size])
+            for width in (1, 2):
+                plain = self.module(data, width)
+                compressed = self.module(data, width, "compress")
+                addressWidth = (size - 1).bit_length() - width + 1
+                self.assertEqual(
+                    caseTable(compressed, addressWidth),
+                    caseTable(plain, addressWidth)
+                )
+                self.assertLess(len(compressed), len(plain))
+                self.assertIn("casez(adr_i)", compressed)
+                if size in (64, 256):
+                    self.assertIn("default:", compressed)
+                else:
+                    self.assertNotIn("default:", compressed)
+
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_hex_file(self):
+        with open(self.path("x.bin"), "wb") as f:
+            f.write("\x01\x02\x03\x04")
+        rc = bin2v.main([
+            "bin2v", "from", self.path("x.bin"), "to", self.path("x.hex"),
+            "bytes", "2", "swap"
+        ])
+        self.assertEqual(rc, 0)
+        with open(self.path("x.hex")) as f:
+            self.assertEqual(f.read(), "0201\n0403\n")
+
+    def test_several_outputs(self):
+        with open(self.path("x.bin"), "wb") as f:
+            f.write("\x01\x02\x03\x04")
+        rc = bin2v.main([
+            "bin2v", "from", self.path("x.bin"),
+            "output", self.path("even.hex"), "lane", "0/2",
+            "output", self.path("odd.bin"), "lane", "1/2", "format", "bin",
+            "output", self.path("x.hex"), "bytes", "4", "swap",
+        ])
+        self.assertEqual(rc, 0)
+        with open(self.path("even.hex")) as f:
+            self.assertEqual(f.read(), "01\n03\n")
+        with open(self.path("odd.bin"), "rb") as f:
+            self.assertEqual(f.read(), "\x02\x04")
+        with open(self.path("x.hex")) as f:
+            self.assertEqual(f.read(), "04030201\n")
+
+    def test_readmemh_module(self):
+        with open(self.path("x.bin"), "wb") as f:
+            f.write("\x01\x02\x03\x04\x05\x06\x07\x08")
+        rc = bin2v.main([
+            "bin2v", "from", self.path("x.bin"), "to", self.path("x.v"),
+            "bytes", "2", "module", "rom", "readmemh", self.path("x.hex")
+        ])
+        self.assertEqual(rc, 0)
+        with open(self.path("x.v")) as f:
+            module = f.read()
+        self.assertIn("\tinput\t\tclk_i,\n\tinput\t[2:1]\tadr_i,\n", module)
+        self.assertIn("\treg\t[15:0]\tmem[0:3];\n", module)
+        self.assertIn('$readmemh("{}", mem);'.format(self.path("x.hex")), module)
+        self.assertIn("\t\tdat_o <= mem[adr_i];\n", module)
+        self.assertNotIn("case", module)
+        with open(self.path("x.hex")) as f:
+            self.assertEqual(f.read(), "0102\n0304\n0506\n0708\n")
+
+
+if __name__ == '__main__':
+    unittest.main()